@@ -93,15 +93,17 @@ class LlamaLayerBuffer:
 class DistributedLlamaLayer:
     def __init__(self, layer_idx, config: DistributedOffloadingConfig) -> None:
         
-        self.wq :torch.Tensor = None
-        self.wk :torch.Tensor = None
-        self.wv :torch.Tensor = None
+        # q, k, v shards stacked on the output dim (one GEMM), gate and up shards likewise
+        self.wqkv :torch.Tensor = None
         self.wo :torch.Tensor = None
 
-        self.gate_proj :torch.Tensor = None 
-        self.up_proj :torch.Tensor = None
+        self.w_gate_up :torch.Tensor = None
         self.down_proj :torch.Tensor = None
 
+        # unsharded MLP of the 'attn_tp' layout (every rank runs the whole MLP), None unless replicated
+        self.w_gate_up_full :torch.Tensor = None
+        self.down_proj_full :torch.Tensor = None
+
         self.input_layernorm_weight :torch.Tensor = None
         self.input_layernorm_variance_epsilon :float = 0.0
 
@@ -123,28 +125,30 @@ class DistributedLlamaLayer:
         self.mlp_slice = self.intermediate_size // self.world_size
 
     
-    def init_parameters(self, hf_layer: LlamaDecoderLayer):
-
-        self.wq :torch.Tensor= hf_layer.self_attn.q_proj.weight.detach()
-        self.wq :torch.Tensor= self.wq.split((self.num_heads * self.head_dim) // self.world_size, dim=0)[self.local_rank].pin_memory()
-
-        self.wk :torch.Tensor= hf_layer.self_attn.k_proj.weight.detach()
-        self.wk :torch.Tensor= self.wk.split(self.key_value_slicing, dim=0)[self.local_rank].pin_memory()
+    def init_parameters(self, hf_layer: LlamaDecoderLayer, pin_memory=True, replicate_mlp=False):
+        # shards are pinned for async copies to the gpu, on cpu they are cloned so the full weights can be freed
+        shard = (lambda t: t.pin_memory()) if pin_memory else (lambda t: t.clone(memory_format=torch.contiguous_format))
+        # torch.cat already copies, only pin the fused shards
+        fuse = (lambda *ts: torch.cat(ts, dim=0).pin_memory()) if pin_memory else (lambda *ts: torch.cat(ts, dim=0))
 
-        self.wv :torch.Tensor= hf_layer.self_attn.v_proj.weight.detach()
-        self.wv :torch.Tensor= self.wv.split(self.key_value_slicing, dim=0)[self.local_rank].pin_memory()
+        wq = hf_layer.self_attn.q_proj.weight.detach().split((self.num_heads * self.head_dim) // self.world_size, dim=0)[self.local_rank]
+        wk = hf_layer.self_attn.k_proj.weight.detach().split(self.key_value_slicing, dim=0)[self.local_rank]
+        wv = hf_layer.self_attn.v_proj.weight.detach().split(self.key_value_slicing, dim=0)[self.local_rank]
+        self.wqkv :torch.Tensor= fuse(wq, wk, wv) #[(h + 2 * kv_h) // tp, h]
 
         self.wo :torch.Tensor= hf_layer.self_attn.o_proj.weight.detach()
-        self.wo :torch.Tensor=self.wo.split(self.hidden_size // self.world_size, dim=1)[self.local_rank].pin_memory()
+        self.wo :torch.Tensor= shard(self.wo.split(self.hidden_size // self.world_size, dim=1)[self.local_rank])
 
-        self.gate_proj :torch.Tensor= hf_layer.mlp.gate_proj.weight.detach()
-        self.gate_proj :torch.Tensor = self.gate_proj.split(self.mlp_slice, dim=0)[self.local_rank].pin_memory()
+        gate_proj = hf_layer.mlp.gate_proj.weight.detach().split(self.mlp_slice, dim=0)[self.local_rank]
+        up_proj = hf_layer.mlp.up_proj.weight.detach().split(self.mlp_slice, dim=0)[self.local_rank]
+        self.w_gate_up :torch.Tensor= fuse(gate_proj, up_proj) #[2 * intermediate // tp, h]
 
-        self.up_proj :torch.Tensor= hf_layer.mlp.up_proj.weight.detach()
-        self.up_proj :torch.Tensor= self.up_proj.split(self.mlp_slice, dim=0)[self.local_rank].pin_memory()
+        self.down_proj :torch.Tensor= hf_layer.mlp.down_proj.weight.detach()
+        self.down_proj :torch.Tensor= shard(self.down_proj.split(self.mlp_slice, dim=1)[self.local_rank])
 
-        self.down_proj :torch.Tensor= hf_layer.mlp.down_proj.weight.detach().pin_memory()
-        self.down_proj :torch.Tensor= self.down_proj.split(self.mlp_slice, dim=1)[self.local_rank].pin_memory()
+        if replicate_mlp:
+            self.w_gate_up_full :torch.Tensor= fuse(hf_layer.mlp.gate_proj.weight.detach(), hf_layer.mlp.up_proj.weight.detach())
+            self.down_proj_full :torch.Tensor= shard(hf_layer.mlp.down_proj.weight.detach())
 
         self.input_layernorm_weight = hf_layer.input_layernorm.weight.detach()
         if hasattr(hf_layer.input_layernorm, 'variance_epsilon'):
@@ -167,16 +171,19 @@ class DistributedLlamaLayer:
         self.input_layernorm_weight = self.input_layernorm_weight.to(device)
         self.post_attention_layernorm_weight = self.post_attention_layernorm_weight.to(device)
 
+    def weight_names(self):
+        names = ['wqkv', 'wo', 'w_gate_up', 'down_proj']
+        if self.w_gate_up_full is not None:
+            names += ['w_gate_up_full', 'down_proj_full']
+        return names
+
     def to_gpu(self, device:str = 'cuda:0'):
 
-        self.wq = self.wq.to(device)
-        self.wk = self.wk.to(device)
-        self.wv = self.wv.to(device)
-        self.wo = self.wo.to(device)
+        for name in self.weight_names():
+            setattr(self, name, getattr(self, name).to(device))
 
-        self.gate_proj = self.gate_proj.to(device)
-        self.up_proj = self.up_proj.to(device)
-        self.down_proj = self.down_proj.to(device)
+    def weight_bytes(self):
+        return sum(getattr(self, name).numel() * getattr(self, name).element_size() for name in self.weight_names())
 
 
 class DistributedLlamaLayerBuffer:
@@ -186,22 +193,90 @@ class DistributedLlamaLayerBuffer:
 
     def init_space(self, layer: DistributedLlamaLayer):
 
-        self.wq = torch.zeros_like(layer.wq).to(self.device)
-        self.wk = torch.zeros_like(layer.wk).to(self.device)
-        self.wv = torch.zeros_like(layer.wv).to(self.device)
-        self.wo = torch.zeros_like(layer.wo).to(self.device)
-
-        self.gate_proj = torch.zeros_like(layer.gate_proj).to(self.device)
-        self.up_proj = torch.zeros_like(layer.up_proj).to(self.device)
-        self.down_proj = torch.zeros_like(layer.down_proj).to(self.device)
+        self.w_gate_up_full = self.down_proj_full = None
+        self.weight_names = layer.weight_names()
+        for name in self.weight_names:
+            setattr(self, name, torch.zeros_like(getattr(layer, name)).to(self.device))
     
     def sync_copy(self, layer: DistributedLlamaLayer):
 
-        self.wq.copy_(layer.wq, non_blocking=True)
-        self.wk.copy_(layer.wk, non_blocking=True)
-        self.wv.copy_(layer.wv, non_blocking=True)
-        self.wo.copy_(layer.wo, non_blocking=True)
-
-        self.gate_proj.copy_(layer.gate_proj, non_blocking=True)
-        self.up_proj.copy_(layer.up_proj, non_blocking=True)
-        self.down_proj.copy_(layer.down_proj, non_blocking=True)
\ No newline at end of file
+        for name in self.weight_names:
+            getattr(self, name).copy_(getattr(layer, name), non_blocking=True)
+
+def assign_layer_residency(num_layers: int, layer_bytes: int, budget: float, num_buffers: int=2, idle_layers=None):
+    """
+    Layers whose weights are streamed from the host when only `budget` bytes of the device are left for layer weights.
+    The num_buffers rotating buffers are paid for once streaming is needed. Streamed layers are taken from
+    idle_layers first (layers with on-chip kv, where PCIe is otherwise idle) and spread evenly, so every copy
+    hides behind the compute of resident layers.
+    """
+    if budget >= num_layers * layer_bytes:
+        return []
+    resident = int(budget // layer_bytes) - num_buffers
+    assert resident >= 0, f"budget of {budget / 1024**3:.2f} GB does not fit {num_buffers} streaming buffers of {layer_bytes / 1024**3:.2f} GB"
+    num_streamed = num_layers - resident
+
+    idle_layers = sorted(set(idle_layers or []))
+    busy_layers = [idx for idx in range(num_layers) if idx not in idle_layers]
+    streamed = []
+    for candidates in (idle_layers, busy_layers):
+        n = min(num_streamed - len(streamed), len(candidates))
+        streamed.extend(candidates[(i + 1) * len(candidates) // (n + 1)] for i in range(n))
+    return sorted(streamed)
+
+class DistributedLayerStreamer:
+    """
+    Streams the weights of the `streamed` layers (pinned on the host) through rotating DistributedLlamaLayerBuffers.
+
+    The first num_buffers streamed layers are prefetched by start(). Once a streamed layer is computed (release),
+    its buffer is refilled on the copy stream with the streamed layer num_buffers ahead, overlapped with the
+    compute in between. The streams are ordered with events only.
+    """
+    def __init__(self, layers: list[DistributedLlamaLayer], streamed: list[int], config: DistributedOffloadingConfig, num_buffers: int=2) -> None:
+        self.layers = layers
+        self.streamed = streamed
+        self.order = {layer_idx: i for i, layer_idx in enumerate(streamed)}
+        self.num_buffers = min(num_buffers, len(streamed))
+
+        self.buffers = []
+        for _ in range(self.num_buffers):
+            buffer = DistributedLlamaLayerBuffer(config)
+            buffer.init_space(layers[streamed[0]])
+            self.buffers.append(buffer)
+        self.loaded = [None] * self.num_buffers # layer held by each buffer
+
+        self.copy_stream = torch.cuda.Stream(device=self.buffers[0].device)
+        self.ready = [torch.cuda.Event() for _ in range(self.num_buffers)]
+        self.done = [torch.cuda.Event() for _ in range(self.num_buffers)]
+
+    def is_streamed(self, layer_idx):
+        return layer_idx in self.order
+
+    def prefetch(self, i):
+        slot = i % self.num_buffers
+        layer_idx = self.streamed[i]
+        with torch.cuda.stream(self.copy_stream):
+            self.copy_stream.wait_event(self.done[slot])
+            # weights never change, a buffer that still holds the layer is reused as is
+            if self.loaded[slot] != layer_idx:
+                self.buffers[slot].sync_copy(self.layers[layer_idx])
+                self.loaded[slot] = layer_idx
+            self.ready[slot].record(self.copy_stream)
+
+    def start(self):
+        for i in range(self.num_buffers):
+            self.prefetch(i)
+
+    def wait(self, layer_idx):
+        slot = self.order[layer_idx] % self.num_buffers
+        torch.cuda.current_stream().wait_event(self.ready[slot])
+        return self.buffers[slot]
+
+    def release(self, layer_idx):
+        i = self.order[layer_idx]
+        self.done[i % self.num_buffers].record(torch.cuda.current_stream())
+        if i + self.num_buffers < len(self.streamed):
+            self.prefetch(i + self.num_buffers)
+
+    def print_status(self):
+        print(f"[Weight Streaming] Streamed Layers: {len(self.streamed)} / {len(self.layers)} {self.streamed} | Buffers: {self.num_buffers} | Host to Device per Forward: {sum(self.layers[idx].weight_bytes() for idx in self.streamed) / 1024**3:.2f} GB")
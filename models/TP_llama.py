@@ -9,18 +9,23 @@ from typing import List, Optional, Tuple, Union
 import gc
 from tqdm import tqdm
 
-from .TP_layers import DistributedLlamaLayer, DistributedLlamaLayerBuffer, DistributedOffloadingConfig
-from .tensor_op import RMSNorm, TP_MLP, TP_Attention, TP_Attention_Retrieval, TP_Attention_Tree_Retrieval, TP_Attention_ssl
+from .TP_layers import DistributedLlamaLayer, DistributedLlamaLayerBuffer, DistributedOffloadingConfig, DistributedLayerStreamer, assign_layer_residency
+from .tensor_op import RMSNorm, MLP, TP_MLP, LAYOUTS, TP_Attention, TP_Attention_Retrieval, TP_Attention_Tree_Retrieval, TP_Attention_ssl
 import torch.distributed as dist
 from .config_yarn import LlamaConfig
-from .cache import DistributedKVCacheBuffer, DistributedSimpleCache, DistributedRetrievalCache
+from .cache import DistributedKVCacheBuffer, DistributedKVPrefetcher, DistributedSimpleCache, DistributedRetrievalCache
 from utils.sampling import norm_logits
+from utils.prefill import PrefillPlanner
 
-def distributed_init():
-    dist.init_process_group(backend="nccl")
+def distributed_init(backend=None):
+    # nccl across gpus, gloo for tensor parallelism across cpu processes (default when cuda is not available)
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend)
     local_rank = dist.get_rank()
     world_size = dist.get_world_size()
-    torch.cuda.set_device(local_rank)
+    if backend == "nccl":
+        torch.cuda.set_device(local_rank)
 
     return local_rank, world_size
 
@@ -30,6 +35,11 @@ class DistributedLlama:
         dtype = torch.float16,
         kv_offload = False,
         on_chip_layers = 32,
+        kv_bits = None,
+        prefetch_depth = 2,
+        gpu_budget = None,
+        weight_buffers = 2,
+        retrieval_refresh = False,
         local_rank = 0,
         world_size = 1,
         prefill = 32768,
@@ -43,9 +53,12 @@ class DistributedLlama:
         ssl=0,
         draft=None,
         draft_cache=None,
-        flash_attn=True) -> None:
+        flash_attn=True,
+        device=None,
+        layouts=None) -> None:
         
-        self.device  = torch.device("cuda", local_rank)
+        # device: cuda:local_rank by default, with a cpu device (gloo) the whole kv stays in host memory, nothing is offloaded
+        self.device  = torch.device(device) if device is not None else torch.device("cuda", local_rank)
         self.dtype = dtype
         self.local_rank = local_rank
         self.world_size = world_size
@@ -53,8 +66,15 @@ class DistributedLlama:
         self.on_chip_layers = on_chip_layers
         self.ssl = ssl
         self.flash_attn = flash_attn
+        self.gpu_budget = gpu_budget
+        self.weight_buffers = weight_buffers
+        self.weight_streamer = None
+        self.layouts = self.init_layouts(layouts)
         model_config: LlamaConfig = LlamaConfig.from_pretrained(model_name_or_path)
         self.config = DistributedOffloadingConfig(model_config, local_rank, world_size)
+        if self.device.type == 'cpu':
+            self.on_chip_layers = on_chip_layers = model_config.num_hidden_layers
+            self.gpu_budget = None
         self.vocab_size = model_config.vocab_size
         self.prefill_len = prefill
         self.retrieval_budget = retrieval_budget
@@ -62,19 +82,26 @@ class DistributedLlama:
         self.top_p = top_p
         self.gamma = gamma
         self.bsz = bsz
-        self.load_stream = torch.cuda.Stream(device=self.device)
 
         self.draft = draft
         self.draft_cache = draft_cache
+        if draft is not None:
+            # fixed 64 token slices, see InferenceEngine (utils/graph_infer.py)
+            self.draft_prefill_planner = PrefillPlanner.from_config(draft.config, dtype=draft.dtype, multiple=16, min_slice=64, max_slice=64)
         
         if kv_offload:
             assert bsz == 1
-            self.kv_cache =  DistributedSimpleCache(self.config, max_budget=prefill+gen_len+32, device=self.device, on_chip_layers=on_chip_layers, ssl=ssl)
-            self.kv_buffer = [DistributedKVCacheBuffer(self.config, max_budget=prefill+gen_len+32, device=self.device) for _ in range(2)]
-            self.retrieval_cache = DistributedRetrievalCache(self.config, max_budget=retrieval_budget, device=self.device, prefill=prefill, chunk_size=retrieval_chunk_size, gamma=gamma)
+            self.kv_cache =  DistributedSimpleCache(self.config, max_budget=prefill+gen_len+32, device=self.device, on_chip_layers=on_chip_layers, ssl=ssl, kv_bits=kv_bits, chunk_size=retrieval_chunk_size if retrieval_refresh else None, dtype=dtype)
+            offloaded = on_chip_layers < model_config.num_hidden_layers
+            self.kv_buffer = [DistributedKVCacheBuffer(self.config, max_budget=prefill+gen_len+32, device=self.device, kv_bits=kv_bits, dtype=dtype) for _ in range(prefetch_depth if offloaded else 0)]
+            self.retrieval_cache = DistributedRetrievalCache(self.config, max_budget=retrieval_budget, device=self.device, prefill=prefill, chunk_size=retrieval_chunk_size, gamma=gamma, refresh=retrieval_refresh, dtype=dtype)
         else:
             raise NotImplementedError
 
+        # offloaded layers' kv is streamed through kv_buffer once per prefill slice
+        offload_bytes = self.offload_bytes = self.kv_cache.offload_bytes()
+        self.prefill_planner = PrefillPlanner.from_config(model_config, world_size=world_size, dtype=dtype, offload_bytes=offload_bytes, device=self.device, distributed=True)
+
         self.hidden_size = self.config.hidden_size
         self.num_heads = self.config.num_attention_heads
         self.head_dim = self.hidden_size // self.num_heads
@@ -86,6 +113,22 @@ class DistributedLlama:
         self.local_num_heads = self.num_heads // world_size
         self.local_num_key_value_heads = self.num_key_value_heads // world_size
 
+    def init_layouts(self, layouts=None):
+        # parallel layout of every forward type (prefill / verify: target forwards, retrieval: the speculative forwards
+        # over the retrieval cache), see LAYOUTS. The MLP is replicated once any forward uses 'attn_tp'.
+        merged = {'prefill': 'tp', 'verify': 'tp', 'retrieval': 'tp'}
+        merged.update(layouts or {})
+        for forward, layout in merged.items():
+            assert forward in ('prefill', 'verify', 'retrieval'), f"unknown forward type {forward}"
+            assert layout in LAYOUTS, f"unknown layout {layout}, choose from {', '.join(LAYOUTS)}"
+        return merged
+
+    def mlp(self, buffer: Union[DistributedLlamaLayerBuffer, DistributedLlamaLayer], hidden_states: torch.FloatTensor, layout: str='tp'):
+        if layout == 'attn_tp':
+            # hidden_states is identical on every rank after the attention all-reduce, no collective needed
+            return MLP(hidden_states, w_gate_up=buffer.w_gate_up_full, down_proj=buffer.down_proj_full)
+        return TP_MLP(hidden_states=hidden_states, w_gate_up=buffer.w_gate_up, down_proj=buffer.down_proj)
+
     def init_parameters(self, hf_model: LlamaForCausalLM):
 
         self.embed_tokens = hf_model.model.embed_tokens.weight.detach().to(self.device)
@@ -105,25 +148,36 @@ class DistributedLlama:
                 self.sin_cache = hf_layer.self_attn.rotary_emb.sin_cached.to(self.device)
                 self.cos_cache = hf_layer.self_attn.rotary_emb.cos_cached.to(self.device)
             layer = DistributedLlamaLayer(idx, self.config)
-            layer.init_parameters(hf_layer=hf_layer)
+            layer.init_parameters(hf_layer=hf_layer, pin_memory=self.device.type == 'cuda', replicate_mlp='attn_tp' in self.layouts.values())
             layer.init_gpu(self.device)
             self.layers.append(layer)
 
         self.num_layers = len(self.layers)
+        # weights of the layers that do not fit into gpu_budget (GB) stay pinned on the host and are streamed
+        streamed = []
+        if self.gpu_budget is not None:
+            reserve = self.prefill_planner.slice_bytes(self.prefill_planner.min_slice, self.prefill_len)
+            budget = self.gpu_budget * 1024**3 - torch.cuda.memory_allocated(self.device) - reserve
+            streamed = assign_layer_residency(self.num_layers, self.layers[0].weight_bytes(), budget, self.weight_buffers, idle_layers=range(self.on_chip_layers))
         for id in range(self.num_layers):
-            self.layers[id].to_gpu(device=self.device)
+            if id not in streamed:
+                self.layers[id].to_gpu(device=self.device)
+        if len(streamed) > 0:
+            self.weight_streamer = DistributedLayerStreamer(self.layers, streamed, self.config, num_buffers=self.weight_buffers)
+            if self.local_rank == 0:
+                self.weight_streamer.print_status()
+        self.prefetcher = None
+        if self.kv_offload and self.on_chip_layers < self.num_layers:
+            self.prefetcher = DistributedKVPrefetcher(self.kv_cache, self.kv_buffer, self.num_layers, device=self.device)
 
     @torch.inference_mode()
     def draft_run(self, input_ids: torch.LongTensor, gamma_offset: int=0, probs=True, temperature=0.6, top_p=0.9):
         if input_ids.shape[-1] > 64: # prefill
-            iter_prefill = math.ceil(input_ids.shape[1] / 128)
-            for i in range(iter_prefill):
-                self.draft_cache.evict_prefill(128)
-                logits = self.draft(
-                    input_ids=input_ids[:, i*128:(i+1)*128],
-                    kv_cache=self.draft_cache,
-                    graph_cache=None,
-                ).logits
+            logits = self.draft_prefill_planner.run(
+                lambda input_ids: self.draft(input_ids=input_ids, kv_cache=self.draft_cache, graph_cache=None).logits,
+                input_ids,
+                before_slice=self.draft_cache.evict_prefill,
+            )
         else: # decoding
             logits = self.draft(input_ids=input_ids, kv_cache=self.draft_cache, graph_cache=self.draft_cache, gamma_offset=gamma_offset).logits
 
@@ -139,7 +193,8 @@ class DistributedLlama:
             hidden_states: torch.FloatTensor, 
             position_ids: torch.LongTensor=None, 
             attention_mask: torch.FloatTensor=None,
-            retrieval_cache=None):
+            retrieval_cache=None,
+            layout: str='tp'):
 
         residual = hidden_states
 
@@ -154,20 +209,19 @@ class DistributedLlama:
             attention_mask=attention_mask,
             position_ids=position_ids,
             layer_idx=layer_idx,
-            wq=buffer.wq,
-            wk=buffer.wk,
-            wv=buffer.wv,
+            wqkv=buffer.wqkv,
             wo=buffer.wo,
             sin_cache=self.sin_cache,
             cos_cache=self.cos_cache,
-            kv_buffer=self.kv_buffer[(layer_idx) % 2] if (layer_idx >= self.on_chip_layers) else self.kv_cache,
+            kv_buffer=self.kv_buffer[(layer_idx) % len(self.kv_buffer)] if (layer_idx >= self.on_chip_layers) else self.kv_cache,
             hidden_size=self.hidden_size,
             local_num_heads=self.local_num_heads,
             local_num_key_value_heads=self.local_num_key_value_heads,
             num_key_value_groups=self.num_key_value_groups,
             head_dim=self.head_dim,
             flash_attn=self.flash_attn,
-            retrieval_cache=retrieval_cache
+            retrieval_cache=retrieval_cache,
+            query_cache=self.retrieval_cache.query_cache
         )
 
         hidden_states = residual + hidden_states
@@ -179,17 +233,22 @@ class DistributedLlama:
             layernorm_weight=self.layers[layer_idx].post_attention_layernorm_weight
         )
 
-        hidden_states = TP_MLP(
-            hidden_states=hidden_states,
-            up_proj=buffer.up_proj,
-            down_proj=buffer.down_proj,
-            gate_proj=buffer.gate_proj
-        )
+        hidden_states = self.mlp(buffer, hidden_states, layout)
 
         hidden_states = residual + hidden_states
         return hidden_states
 
 
+    def layer_weights(self, idx):
+        # resident weights, or the streaming buffer once the copy of the layer has landed
+        if self.weight_streamer is not None and self.weight_streamer.is_streamed(idx):
+            return self.weight_streamer.wait(idx)
+        return self.layers[idx]
+
+    def release_layer(self, idx):
+        if self.weight_streamer is not None and self.weight_streamer.is_streamed(idx):
+            self.weight_streamer.release(idx)
+
     def reset(self):
         self.kv_cache.reset()
         self.retrieval_cache.reset()
@@ -201,9 +260,15 @@ class DistributedLlama:
             input_ids: torch.LongTensor,
             position_ids: torch.LongTensor=None,
             attention_mask: torch.FloatTensor=None,
-            retrieval_cache=None):
+            retrieval_cache=None,
+            layout: str=None):
         
         # kv_len = self.kv_cache.kv_offset
+        layout = layout if layout is not None else self.layouts['verify']
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+        if self.weight_streamer is not None:
+            self.weight_streamer.start()
         hidden_states = F.embedding(input_ids, self.embed_tokens)
 
         if position_ids is None:
@@ -215,23 +280,21 @@ class DistributedLlama:
                 position_ids = self.kv_cache.seq_len + range_tensor
                 position_ids = position_ids.unsqueeze(0)
 
-        if self.kv_offload:
-            self.kv_buffer[(self.on_chip_layers) % 2].copy_kv(self.kv_cache, self.on_chip_layers)
+        if self.prefetcher is not None:
             for idx in range(self.num_layers):
                 if idx >= self.on_chip_layers:
-                    torch.cuda.synchronize()
-                    with torch.cuda.stream(self.load_stream):
-                        hidden_states = self.layer_compute(self.layers[idx], idx, hidden_states, position_ids, attention_mask, retrieval_cache)
-                        self.kv_cache.copy_back_from_buffer(self.kv_buffer[(idx) % 2], idx)
-                    if idx != self.num_layers - 1:
-                        self.kv_buffer[(idx + 1) % 2].copy_kv(self.kv_cache, idx + 1)
-                    torch.cuda.synchronize()
+                    self.prefetcher.wait(idx)
+                    hidden_states = self.layer_compute(self.layer_weights(idx), idx, hidden_states, position_ids, attention_mask, retrieval_cache, layout)
+                    self.prefetcher.release(idx)
                 else:
-                    hidden_states = self.layer_compute(self.layers[idx], idx, hidden_states, position_ids, attention_mask, retrieval_cache)
+                    hidden_states = self.layer_compute(self.layer_weights(idx), idx, hidden_states, position_ids, attention_mask, retrieval_cache, layout)
+                self.release_layer(idx)
+            self.prefetcher.finish()
 
         else:
             for idx in range(self.num_layers):
-                hidden_states = self.layer_compute(self.layers[idx], idx, hidden_states, position_ids, attention_mask, retrieval_cache)
+                hidden_states = self.layer_compute(self.layer_weights(idx), idx, hidden_states, position_ids, attention_mask, retrieval_cache, layout)
+                self.release_layer(idx)
 
         hidden_states = RMSNorm(
             hidden_states=hidden_states,
@@ -244,10 +307,7 @@ class DistributedLlama:
 
     @torch.inference_mode()
     def prefill(self, input_ids: torch.LongTensor):
-        iter_prefill = math.ceil(input_ids.shape[1] / 128)
-        for i in range(iter_prefill):
-            logits = self.inference(input_ids=input_ids[:, i*128:(i+1)*128])
-        return logits
+        return self.prefill_planner.run(lambda input_ids: self.inference(input_ids=input_ids, layout=self.layouts['prefill']), input_ids, start=self.kv_cache.seq_len)
 
     @torch.inference_mode()
     def build_retrieval_cache(self, input_ids: torch.LongTensor):
@@ -277,9 +337,7 @@ class DistributedLlama:
             attention_mask=attention_mask,
             position_ids=position_ids,
             layer_idx=layer_idx,
-            wq=buffer.wq,
-            wk=buffer.wk,
-            wv=buffer.wv,
+            wqkv=buffer.wqkv,
             wo=buffer.wo,
             sin_cache=self.sin_cache,
             cos_cache=self.cos_cache,
@@ -301,12 +359,7 @@ class DistributedLlama:
             layernorm_weight=self.layers[layer_idx].post_attention_layernorm_weight
         )
 
-        hidden_states = TP_MLP(
-            hidden_states=hidden_states,
-            up_proj=buffer.up_proj,
-            down_proj=buffer.down_proj,
-            gate_proj=buffer.gate_proj
-        )
+        hidden_states = self.mlp(buffer, hidden_states, self.layouts['retrieval'])
 
         hidden_states = residual + hidden_states
         return hidden_states
@@ -332,13 +385,11 @@ class DistributedLlama:
             attention_mask=attention_mask,
             position_ids=position_ids,
             layer_idx=layer_idx,
-            wq=buffer.wq,
-            wk=buffer.wk,
-            wv=buffer.wv,
+            wqkv=buffer.wqkv,
             wo=buffer.wo,
             sin_cache=self.sin_cache,
             cos_cache=self.cos_cache,
-            kv_buffer=self.kv_buffer[(layer_idx) % 2] if (layer_idx >= self.on_chip_layers) else self.kv_cache,
+            kv_buffer=self.kv_buffer[(layer_idx) % len(self.kv_buffer)] if (layer_idx >= self.on_chip_layers) else self.kv_cache,
             hidden_size=self.hidden_size,
             local_num_heads=self.local_num_heads,
             local_num_key_value_heads=self.local_num_key_value_heads,
@@ -356,12 +407,7 @@ class DistributedLlama:
             layernorm_weight=self.layers[layer_idx].post_attention_layernorm_weight
         )
 
-        hidden_states = TP_MLP(
-            hidden_states=hidden_states,
-            up_proj=buffer.up_proj,
-            down_proj=buffer.down_proj,
-            gate_proj=buffer.gate_proj
-        )
+        hidden_states = self.mlp(buffer, hidden_states, self.layouts['retrieval'])
 
         hidden_states = residual + hidden_states
         return hidden_states
@@ -369,10 +415,13 @@ class DistributedLlama:
 
     @torch.inference_mode()
     def retrieval_inference(self, input_ids: torch.LongTensor, position_ids: torch.LongTensor):
+        if self.weight_streamer is not None:
+            self.weight_streamer.start()
         hidden_states = F.embedding(input_ids, self.embed_tokens)
 
         for idx in range(self.num_layers):
-            hidden_states = self.layer_speculation(self.layers[idx], idx, hidden_states, position_ids, attention_mask=None, retrieval_cache=self.retrieval_cache)
+            hidden_states = self.layer_speculation(self.layer_weights(idx), idx, hidden_states, position_ids, attention_mask=None, retrieval_cache=self.retrieval_cache)
+            self.release_layer(idx)
 
         hidden_states = RMSNorm(
             hidden_states=hidden_states,
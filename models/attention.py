@@ -0,0 +1,169 @@
+import os
+import torch
+import torch.nn.functional as F
+
+try:
+    from flash_attn import flash_attn_with_kvcache as _flash_attn_with_kvcache
+except ImportError:
+    _flash_attn_with_kvcache = None
+
+# Attention over a kv cache with the interface of flash_attn_with_kvcache:
+#   q (bsz, q_len, heads, head_dim), k_cache / v_cache (bsz, kv_len, kv_heads, head_dim) or, with block_table,
+#   the block pool (num_blocks, block_size, kv_heads, head_dim); cache_seqlens holds the valid kv length of every row
+#   (new tokens included), causal aligns the queries to the end of the kv (query i sees kv j <= len - q_len + i).
+#
+# Backends, chosen with set_attention_backend() or TRIFORCE_ATTN=flash|sdpa|chunked (default: flash when installed
+# and the tensors are on cuda, else chunked, the faster of the two others on CPU, see test/attention_bench.py):
+#   flash:   flash_attn_with_kvcache
+#   sdpa:    F.scaled_dot_product_attention over blocks of queries, at most max_scores attention scores per call
+#   chunked: pure torch, online softmax over kv blocks of kv_block tokens (fp32 accumulators), never holds more than
+#            q_block x kv_block scores per head
+# The sdpa / chunked backends do not synchronize with the host, so they can be captured in cuda graphs as well.
+
+BACKENDS = ("flash", "sdpa", "chunked")
+
+_config = {
+    "backend": os.environ.get("TRIFORCE_ATTN", "auto"),
+    "q_block": int(os.environ.get("TRIFORCE_ATTN_Q_BLOCK", 256)),
+    "kv_block": int(os.environ.get("TRIFORCE_ATTN_KV_BLOCK", 1024)),
+    "max_scores": int(os.environ.get("TRIFORCE_ATTN_MAX_SCORES", 2**24)),
+}
+
+def set_attention_backend(backend=None, q_block=None, kv_block=None, max_scores=None):
+    if backend is not None:
+        assert backend == "auto" or backend in BACKENDS, f"unknown attention backend {backend}, choose from auto, {', '.join(BACKENDS)}"
+        if backend == "flash" and _flash_attn_with_kvcache is None:
+            raise ImportError("flash_attn is not installed, use the sdpa or chunked attention backend")
+        _config["backend"] = backend
+    for key, value in (("q_block", q_block), ("kv_block", kv_block), ("max_scores", max_scores)):
+        if value is not None:
+            _config[key] = value
+
+def get_attention_backend(device=None):
+    backend = _config["backend"]
+    if backend != "auto":
+        return backend
+    if _flash_attn_with_kvcache is not None and (device is None or torch.device(device).type == "cuda"):
+        return "flash"
+    return "chunked"
+
+def attention_with_kvcache(q, k_cache, v_cache, cache_seqlens=None, block_table=None, softmax_scale=None, causal=True, backend=None):
+    backend = backend if backend is not None else get_attention_backend(q.device)
+    if backend == "flash":
+        if _flash_attn_with_kvcache is None:
+            raise ImportError("flash_attn is not installed, use the sdpa or chunked attention backend")
+        return _flash_attn_with_kvcache(q=q, k_cache=k_cache, v_cache=v_cache, cache_seqlens=cache_seqlens, block_table=block_table, softmax_scale=softmax_scale, causal=causal)
+
+    head_dim = q.shape[-1]
+    scale = float(softmax_scale) if softmax_scale is not None else head_dim ** -0.5
+    if isinstance(cache_seqlens, int):
+        cache_seqlens = torch.full((q.shape[0],), cache_seqlens, dtype=torch.int32, device=q.device)
+    if backend == "sdpa":
+        return sdpa_attention(q, k_cache, v_cache, cache_seqlens, block_table, scale, causal)
+    if backend == "chunked":
+        return chunked_attention(q, k_cache, v_cache, cache_seqlens, block_table, scale, causal)
+    raise ValueError(f"unknown attention backend {backend}")
+
+# flash_attn_with_kvcache drop-in for the existing call sites
+flash_attn_with_kvcache = attention_with_kvcache
+
+def gather_blocks(cache, block_table, start=0, end=None):
+    # pool blocks of block_table[:, start:end] --> (bsz, (end - start) * block_size, kv_heads, head_dim)
+    blocks = cache[block_table[:, start:end].long()]
+    return blocks.flatten(1, 2)
+
+def kv_mask(q_start, q_end, kv_start, kv_end, q_len, kv_len, cache_seqlens, causal, device):
+    # bool (bsz or 1, 1, q, kv) of the visible kv, None when every kv of the range is visible
+    if cache_seqlens is None and (not causal or kv_end - 1 <= kv_len - q_len + q_start):
+        return None
+    kv_idx = torch.arange(kv_start, kv_end, device=device)
+    if cache_seqlens is None:
+        limit = torch.arange(q_start, q_end, device=device) + (kv_len - q_len) # (q)
+        return (kv_idx[None, :] <= limit[:, None])[None, None]
+    lens = cache_seqlens.to(device=device, dtype=torch.long)[:, None, None] # (bsz, 1, 1)
+    limit = lens - q_len + torch.arange(q_start, q_end, device=device)[None, :, None] if causal else (lens - 1).expand(-1, q_end - q_start, -1)
+    return (kv_idx[None, None, :] <= limit)[:, None]
+
+def group_heads(q, num_kv_heads):
+    # (bsz, q, heads, head_dim) --> (bsz, kv_heads, n_rep, q, head_dim), query heads grouped by the kv head they read
+    bsz, q_len, num_heads, head_dim = q.shape
+    return q.reshape(bsz, q_len, num_kv_heads, num_heads // num_kv_heads, head_dim).permute(0, 2, 3, 1, 4)
+
+def group_mask(mask, n_rep):
+    # (bsz or 1, 1, q, kv) --> (bsz or 1, 1, n_rep * q, kv), the row order of a grouped query block
+    if mask is None or n_rep == 1:
+        return mask
+    rows, q_size, kv = mask.shape[0], mask.shape[2], mask.shape[3]
+    return mask[:, :, None].expand(rows, 1, n_rep, q_size, kv).reshape(rows, 1, n_rep * q_size, kv)
+
+def sdpa_attention(q, k_cache, v_cache, cache_seqlens, block_table, scale, causal):
+    bsz, q_len, num_heads, head_dim = q.shape
+    if block_table is not None:
+        k_cache, v_cache = gather_blocks(k_cache, block_table), gather_blocks(v_cache, block_table)
+    kv_len, num_kv_heads = k_cache.shape[1], k_cache.shape[2]
+    n_rep = num_heads // num_kv_heads
+    key = k_cache.transpose(1, 2).expand(bsz, -1, -1, -1).to(q.dtype) # (bsz, kv_heads, kv, head_dim)
+    value = v_cache.transpose(1, 2).expand(bsz, -1, -1, -1).to(q.dtype)
+    query = group_heads(q, num_kv_heads)
+
+    q_block = max(1, min(q_len, _config["max_scores"] // max(bsz * num_heads * kv_len, 1)))
+    output = torch.empty(bsz, num_kv_heads, n_rep, q_len, head_dim, dtype=q.dtype, device=q.device)
+    for q_start in range(0, q_len, q_block):
+        q_end = min(q_start + q_block, q_len)
+        # causal without per-row lengths: the kv after the last query of the block is never visible
+        kv_end = kv_len if cache_seqlens is not None or not causal else kv_len - q_len + q_end
+        mask = group_mask(kv_mask(q_start, q_end, 0, kv_end, q_len, kv_len, cache_seqlens, causal, q.device), n_rep)
+        query_block = query[:, :, :, q_start:q_end].reshape(bsz, num_kv_heads, n_rep * (q_end - q_start), head_dim)
+        out = F.scaled_dot_product_attention(query_block, key[:, :, :kv_end], value[:, :, :kv_end], attn_mask=mask, scale=scale)
+        output[:, :, :, q_start:q_end] = out.view(bsz, num_kv_heads, n_rep, q_end - q_start, head_dim)
+    return output.view(bsz, num_heads, q_len, head_dim).transpose(1, 2)
+
+def chunked_attention(q, k_cache, v_cache, cache_seqlens, block_table, scale, causal):
+    bsz, q_len, num_heads, head_dim = q.shape
+    paged = block_table is not None
+    if paged:
+        block_size = k_cache.shape[1]
+        kv_len = block_table.shape[1] * block_size
+        kv_block = max(1, _config["kv_block"] // block_size) * block_size
+    else:
+        kv_len = k_cache.shape[1]
+        kv_block = _config["kv_block"]
+    num_kv_heads = k_cache.shape[2]
+    n_rep = num_heads // num_kv_heads
+    q_block = _config["q_block"]
+
+    query = group_heads(q.float() * scale, num_kv_heads)
+    output = torch.empty(bsz, num_kv_heads, n_rep, q_len, head_dim, dtype=q.dtype, device=q.device)
+    for q_start in range(0, q_len, q_block):
+        q_end = min(q_start + q_block, q_len)
+        rows = n_rep * (q_end - q_start)
+        query_block = query[:, :, :, q_start:q_end].reshape(bsz, num_kv_heads, rows, head_dim)
+        kv_end = kv_len if cache_seqlens is not None or not causal else kv_len - q_len + q_end
+        row_max = torch.full((bsz, num_kv_heads, rows, 1), float("-inf"), device=q.device)
+        row_sum = torch.zeros(bsz, num_kv_heads, rows, 1, device=q.device)
+        acc = torch.zeros(bsz, num_kv_heads, rows, head_dim, device=q.device)
+        for kv_start in range(0, kv_end, kv_block):
+            kv_stop = min(kv_start + kv_block, kv_end)
+            if paged:
+                first, last = kv_start // block_size, -(-kv_stop // block_size)
+                key = gather_blocks(k_cache, block_table, first, last)[:, :kv_stop - kv_start]
+                value = gather_blocks(v_cache, block_table, first, last)[:, :kv_stop - kv_start]
+            else:
+                key, value = k_cache[:, kv_start:kv_stop], v_cache[:, kv_start:kv_stop]
+            key = key.transpose(1, 2).float() # (bsz or 1, kv_heads, kv, head_dim)
+            value = value.transpose(1, 2).float()
+            scores = torch.matmul(query_block, key.transpose(-1, -2)) # (bsz, kv_heads, n_rep * q, kv)
+            mask = group_mask(kv_mask(q_start, q_end, kv_start, kv_stop, q_len, kv_len, cache_seqlens, causal, q.device), n_rep)
+            if mask is not None:
+                scores = scores.masked_fill(~mask, float("-inf"))
+            block_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # rows with nothing visible yet keep -inf, shift them by 0 so exp() stays 0 instead of nan
+            shift = torch.where(torch.isinf(block_max), torch.zeros_like(block_max), block_max)
+            correction = torch.exp(row_max - shift)
+            probs = torch.exp(scores - shift)
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+            acc = acc * correction + torch.matmul(probs, value)
+            row_max = block_max
+        out = acc / row_sum.clamp(min=1e-30)
+        output[:, :, :, q_start:q_end] = out.view(bsz, num_kv_heads, n_rep, q_end - q_start, head_dim).to(q.dtype)
+    return output.view(bsz, num_heads, q_len, head_dim).transpose(1, 2)
@@ -2,6 +2,27 @@ from typing import Any, Dict, List, Optional, Tuple
 from numpy import dtype
 import torch
 import math
+from .kv_quant import KEY_GROUP, KeyTail, packed_dim, key_groups, check_kv_bits, quantize_kv, dequantize_kv, quantize_keys, dequantize_keys
+
+def gather_chunk_tokens(cache, topk_idx, chunks, chunk_size):
+    # cache: (bsz, tokens, 32, dim), topk_idx: (bsz, 32, select_sets) --> (bsz, select_sets*chunk_size, 32, dim)
+    bsz, _, num_heads, dim = cache.shape
+    select_sets = topk_idx.shape[-1]
+    expanded_index_tensor = topk_idx.permute(0, 2, 1).unsqueeze(-1).unsqueeze(-1).expand(-1, -1, -1, chunk_size, dim).to(cache.device)
+
+    # (bsz, prefill, 32, dim) --> (bsz, chunks, chunk_size, 32, dim) --> (bsz, chunks, 32, chunk_size, dim)
+    cache_ = cache[:, :chunks*chunk_size].reshape(-1, chunks, chunk_size, num_heads, dim)
+    cache_ = cache_.permute(0, 1, 3, 2, 4)
+    result_tensor = torch.gather(cache_, 1, expanded_index_tensor) # (bsz, select_sets, 32, chunk_size, dim)
+    # (bsz, select_sets, 32, chunk_size, dim) --> (bsz, select_sets*chunk_size, 32, dim)
+    return result_tensor.permute(0, 1, 3, 2, 4).reshape(-1, select_sets*chunk_size, num_heads, dim)
+
+def gather_chunk_groups(groups, topk_idx, chunk_size):
+    # per key group scale / zero (bsz, groups, 32, dim), topk_idx: (bsz, 32, select_sets) --> per token of the chunks (bsz, select_sets*chunk_size, 32, dim)
+    dim = groups.shape[-1]
+    positions = topk_idx.unsqueeze(-1) * chunk_size + torch.arange(chunk_size, device=topk_idx.device)
+    index = (positions // KEY_GROUP).flatten(-2).unsqueeze(-1).expand(-1, -1, -1, dim).to(groups.device)
+    return torch.gather(groups.permute(0, 2, 1, 3), 2, index).permute(0, 2, 1, 3)
 
 class Cache:
     """
@@ -18,9 +39,11 @@ class Cache:
 
 ############## Single GPU Cache ###############
 class FlashSimpleCache(Cache):
-    def __init__(self, model, max_budget=1024) -> None:
+    def __init__(self, model, max_budget=1024, chunk_size=8, bsz=1) -> None:
         self.seq_len = 0
         self.max_budget = max_budget
+        self.chunk_size = chunk_size
+        self.bsz = bsz
 
         self.hidden_size = model.config.hidden_size
         self.num_heads = model.config.num_key_value_heads
@@ -29,19 +52,62 @@ class FlashSimpleCache(Cache):
 
         dtype = model.model.layers[0].self_attn.q_proj.weight.dtype
 
-        self.key_cache = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
-        self.value_cache = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+        self.key_cache = torch.zeros([self.layers, bsz, self.max_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+        self.value_cache = torch.zeros([self.layers, bsz, self.max_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+
+        # chunk summary index (mean key of every complete chunk), read directly by retrieval
+        self.chunk_k = torch.zeros([self.layers, bsz, self.max_budget // self.chunk_size, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
 
         self.scores = []
 
     def print_status(self):
-        print("[Full Cache] Cached:", self.seq_len, "| Budget:", self.max_budget)
+        print("[Full Cache] Cached:", self.seq_len, "| Budget:", self.max_budget, "| Chunk Size:", self.chunk_size)
     
     def reset(self):
         self.seq_len = 0
         for i in range(self.layers):
             self.key_cache[i].zero_()
             self.value_cache[i].zero_()
+        self.chunk_k.zero_()
+
+    def update_chunk_k(self, key_cache, layer_idx, start, end):
+        # refresh the summaries of the chunks completed by tokens [start, end)
+        lo = start // self.chunk_size
+        hi = end // self.chunk_size
+        if hi > lo:
+            self.chunk_k[layer_idx][:, lo:hi] = key_cache[:, lo*self.chunk_size:hi*self.chunk_size].view(self.bsz, hi-lo, self.chunk_size, self.num_heads, self.head_dim).mean(dim=-3)
+
+    def chunk_summary(self, layer_idx, chunks):
+        return self.chunk_k[layer_idx, :, :chunks]
+
+    def gather_chunks(self, layer_idx, topk_idx, end, chunk_size):
+        # topk_idx: (bsz, 32, select_sets) chunk ids per head --> (bsz, select_sets*chunk_size, 32, head_dim)
+        # gathered where the keys live, only the selected chunks are moved
+        key = gather_chunk_tokens(self.key_cache[layer_idx], topk_idx, end // chunk_size, chunk_size)
+        value = gather_chunk_tokens(self.value_cache[layer_idx], topk_idx, end // chunk_size, chunk_size)
+        return key, value
+
+    def read_range(self, start, end, layer_idx=None):
+        # (layers, bsz, end-start, 32, head_dim), or a single layer
+        if layer_idx is None:
+            return self.key_cache[:, :, start:end], self.value_cache[:, :, start:end]
+        return self.key_cache[layer_idx, :, start:end], self.value_cache[layer_idx, :, start:end]
+
+    def prefix_state(self, length):
+        # first length tokens of the sequence, (layers, ...) per tensor, see utils/prefix_store.py
+        return {
+            "key": self.key_cache[:, 0, :length],
+            "value": self.value_cache[:, 0, :length],
+            "chunk_k": self.chunk_k[:, 0, :length // self.chunk_size],
+        }
+
+    def load_prefix(self, state, length):
+        chunks = length // self.chunk_size
+        for i in range(self.layers):
+            self.key_cache[i, 0, :length].copy_(state["key"][i, :length])
+            self.value_cache[i, 0, :length].copy_(state["value"][i, :length])
+            self.chunk_k[i, 0, :chunks].copy_(state["chunk_k"][i, :chunks])
+        self.seq_len = length
 
     def update(
         self,
@@ -51,6 +117,7 @@ class FlashSimpleCache(Cache):
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         self.key_cache[layer_idx][:, self.seq_len : self.seq_len + key_states.shape[-3]] = key_states
         self.value_cache[layer_idx][:, self.seq_len : self.seq_len + value_states.shape[-3]] = value_states
+        self.update_chunk_k(self.key_cache[layer_idx], layer_idx, self.seq_len, self.seq_len + key_states.shape[-3])
 
         key = self.key_cache[layer_idx][:, :self.seq_len + value_states.shape[-3]]
         value = self.value_cache[layer_idx][:, :self.seq_len + value_states.shape[-3]]
@@ -60,10 +127,70 @@ class FlashSimpleCache(Cache):
 
         return key, value
 
-class OffloadingFlashSimpleCache(Cache):
-    def __init__(self, model, max_budget=1024) -> None:
+class BatchFlashSimpleCache(FlashSimpleCache):
+    """
+    Full target cache for a batch of independent sequences. seq_lens holds the committed length
+    of every row, new tokens are written at each row's own end and attention reads the first
+    cache_seqlens tokens of every row, so rows can accept different numbers of tokens per round.
+    seq_len is the longest row.
+    """
+    def __init__(self, model, max_budget=1024, chunk_size=8, bsz=1) -> None:
+        super().__init__(model, max_budget=max_budget, chunk_size=chunk_size, bsz=bsz)
+        self.device = model.device
+        self.seq_lens = torch.zeros([bsz], dtype=torch.long, device=self.device)
+        self.cache_seqlens = torch.zeros([bsz], dtype=torch.int32, device=self.device)
+        self.batch_idx = torch.arange(bsz, device=self.device).unsqueeze(-1)
+
+    def print_status(self):
+        print("[Batch Full Cache] Cached:", self.seq_lens.tolist(), "| Budget:", self.max_budget, "| Chunk Size:", self.chunk_size, "| Batch Size:", self.bsz)
+
+    def reset(self):
+        super().reset()
+        self.seq_lens.zero_()
+        self.cache_seqlens.zero_()
+
+    def rollback(self, seq_lens):
+        # keep the first seq_lens tokens of every row, the rest is overwritten by the next update
+        self.seq_lens.copy_(seq_lens)
+        self.seq_len = int(self.seq_lens.max())
+
+    def update_chunk_k(self, key_cache, layer_idx, start, end):
+        # recompute every chunk touched by the rows' writes [seq_lens, seq_lens + incoming);
+        # partial chunks hold junk until the write that completes them
+        incoming = end - start
+        n_chunks = incoming // self.chunk_size + 2
+        chunk_ids = (self.seq_lens.unsqueeze(-1) // self.chunk_size + torch.arange(n_chunks, device=self.device)).clamp(max=self.max_budget // self.chunk_size - 1)
+        positions = (chunk_ids.unsqueeze(-1) * self.chunk_size + torch.arange(self.chunk_size, device=self.device)).flatten(1)
+        chunk_k = key_cache[self.batch_idx, positions].view(self.bsz, n_chunks, self.chunk_size, self.num_heads, self.head_dim).mean(dim=-3)
+        self.chunk_k[layer_idx][self.batch_idx, chunk_ids] = chunk_k
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        incoming = key_states.shape[-3]
+        if layer_idx == 0:
+            self.write_pos = self.seq_lens.unsqueeze(-1) + torch.arange(incoming, device=self.device)
+            self.cache_seqlens.copy_(self.seq_lens + incoming)
+
+        self.key_cache[layer_idx][self.batch_idx, self.write_pos] = key_states
+        self.value_cache[layer_idx][self.batch_idx, self.write_pos] = value_states
+        self.update_chunk_k(self.key_cache[layer_idx], layer_idx, 0, incoming)
+
+        if layer_idx == self.layers-1:
+            self.seq_lens += incoming
+            self.seq_len += incoming
+
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+class OffloadingFlashSimpleCache(FlashSimpleCache):
+    def __init__(self, model, max_budget=1024, chunk_size=8, kv_bits=None) -> None:
         self.seq_len = 0
         self.max_budget = max_budget
+        self.chunk_size = chunk_size
+        self.bsz = 1
 
         self.hidden_size = model.config.hidden_size
         self.num_heads = model.config.num_key_value_heads
@@ -73,23 +200,85 @@ class OffloadingFlashSimpleCache(Cache):
         dtype = model.model.layers[0].self_attn.q_proj.weight.dtype
         self.device = model.device
 
-        self.key_cache = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device='cpu').pin_memory()
-        self.value_cache = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device='cpu').pin_memory()
+        # int8 / int4 host kv (models/kv_quant.py), dequantized on chip: values with per token-head scales,
+        # keys with per channel scales of every KEY_GROUP tokens
+        self.kv_bits = kv_bits
+        if kv_bits is not None:
+            check_kv_bits(kv_bits)
+        cpu_dim = self.head_dim if kv_bits is None else packed_dim(self.head_dim, kv_bits)
+        cpu_dtype = dtype if kv_bits is None else torch.uint8
+        self.key_cache = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, cpu_dim], dtype=cpu_dtype, device='cpu').pin_memory()
+        self.value_cache = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, cpu_dim], dtype=cpu_dtype, device='cpu').pin_memory()
+        if kv_bits is not None:
+            self.key_scale = torch.zeros([self.layers, 1, key_groups(self.max_budget), self.num_heads, self.head_dim], dtype=dtype, device='cpu').pin_memory()
+            self.key_zero = torch.zeros([self.layers, 1, key_groups(self.max_budget), self.num_heads, self.head_dim], dtype=dtype, device='cpu').pin_memory()
+            self.value_scale = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, 1], dtype=dtype, device='cpu').pin_memory()
+            self.value_zero = torch.zeros([self.layers, 1, self.max_budget, self.num_heads, 1], dtype=dtype, device='cpu').pin_memory()
+            self.key_q_buffer = torch.zeros([1, self.max_budget, self.num_heads, cpu_dim], dtype=torch.uint8, device=self.device)
+            self.value_q_buffer = torch.zeros([1, self.max_budget, self.num_heads, cpu_dim], dtype=torch.uint8, device=self.device)
+            self.key_tail = KeyTail(self.layers, self.num_heads, self.head_dim, dtype, self.device)
 
         # init layer cache buffer on chip
         self.key_cache_buffer = torch.zeros([1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device=self.device)
         self.value_cache_buffer = torch.zeros([1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device=self.device)
 
+        # chunk summary index stays on chip, so retrieval never scans the offloaded keys
+        self.chunk_k = torch.zeros([self.layers, 1, self.max_budget // self.chunk_size, self.num_heads, self.head_dim], dtype=dtype, device=self.device)
+
         self.load_stream = torch.cuda.Stream(device=self.device)
 
     def print_status(self):
-        print("[Offloading Flash Simple Cache] Cached Size:", self.seq_len, "| Budget:", self.max_budget)
-    
-    def reset(self):
-        self.seq_len = 0
-        for i in range(self.layers):
-            self.key_cache[i].zero_()
-            self.value_cache[i].zero_()
+        print("[Offloading Flash Simple Cache] Cached Size:", self.seq_len, "| Budget:", self.max_budget, "| Chunk Size:", self.chunk_size, "| Offloaded KV:", "fp16" if self.kv_bits is None else f"int{self.kv_bits}", f"{self.offload_bytes() / 1024**3:.2f} GB")
+
+    def cpu_tensors(self):
+        if self.kv_bits is None:
+            return [self.key_cache, self.value_cache]
+        return [self.key_cache, self.value_cache, self.key_scale, self.key_zero, self.value_scale, self.value_zero]
+
+    def offload_bytes(self):
+        return sum(t.numel() * t.element_size() for t in self.cpu_tensors())
+
+    def load_quantized(self, layer_idx, start, end):
+        # compressed [start, end) of a layer --> fp16 on chip
+        groups = slice(start // KEY_GROUP, key_groups(end))
+        key = dequantize_keys(self.key_cache[layer_idx][:, start:end].to(self.device, non_blocking=True), self.key_scale[layer_idx][:, groups].to(self.device, non_blocking=True), self.key_zero[layer_idx][:, groups].to(self.device, non_blocking=True), self.kv_bits, start)
+        value = dequantize_kv(self.value_cache[layer_idx][:, start:end].to(self.device, non_blocking=True), self.value_scale[layer_idx][:, start:end].to(self.device, non_blocking=True), self.value_zero[layer_idx][:, start:end].to(self.device, non_blocking=True), self.kv_bits)
+        return key, value
+
+    def gather_chunks(self, layer_idx, topk_idx, end, chunk_size):
+        if self.kv_bits is None:
+            return super().gather_chunks(layer_idx, topk_idx, end, chunk_size)
+        chunks = end // chunk_size
+        key = dequantize_kv(gather_chunk_tokens(self.key_cache[layer_idx], topk_idx, chunks, chunk_size).to(self.device), *[gather_chunk_groups(t[layer_idx], topk_idx, chunk_size).to(self.device) for t in (self.key_scale, self.key_zero)], self.kv_bits)
+        value = dequantize_kv(*[gather_chunk_tokens(t[layer_idx], topk_idx, chunks, chunk_size).to(self.device) for t in (self.value_cache, self.value_scale, self.value_zero)], self.kv_bits)
+        return key, value
+
+    def read_range(self, start, end, layer_idx=None):
+        if self.kv_bits is None:
+            return super().read_range(start, end, layer_idx)
+        if layer_idx is None:
+            kv = [self.load_quantized(i, start, end) for i in range(self.layers)]
+            return torch.stack([k for k, _ in kv]), torch.stack([v for _, v in kv])
+        return self.load_quantized(layer_idx, start, end)
+
+    def prefix_state(self, length):
+        state = super().prefix_state(length)
+        if self.kv_bits is not None:
+            state.update({
+                "key_scale": self.key_scale[:, 0, :key_groups(length)],
+                "key_zero": self.key_zero[:, 0, :key_groups(length)],
+                "value_scale": self.value_scale[:, 0, :length],
+                "value_zero": self.value_zero[:, 0, :length],
+            })
+        return state
+
+    def load_prefix(self, state, length):
+        super().load_prefix(state, length)
+        if self.kv_bits is not None:
+            for name, t, n in (("key_scale", self.key_scale, key_groups(length)), ("key_zero", self.key_zero, key_groups(length)), ("value_scale", self.value_scale, length), ("value_zero", self.value_zero, length)):
+                for i in range(self.layers):
+                    t[i, 0, :n].copy_(state[name][i, :n])
+            self.key_tail.reset()
 
     def update(
         self,
@@ -97,7 +286,9 @@ class OffloadingFlashSimpleCache(Cache):
         value_states: torch.Tensor,
         layer_idx: int,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        
+        if self.kv_bits is not None:
+            return self.update_quantized(key_states, value_states, layer_idx)
+
         # copy incoming k v cache to cpu
         self.key_cache[layer_idx][:, self.seq_len : self.seq_len + key_states.shape[-3]] = key_states.cpu()
         self.value_cache[layer_idx][:, self.seq_len : self.seq_len + value_states.shape[-3]] = value_states.cpu()
@@ -105,6 +296,7 @@ class OffloadingFlashSimpleCache(Cache):
         # copy k v cache to buffer
         self.key_cache_buffer.copy_(self.key_cache[layer_idx], non_blocking=True)
         self.value_cache_buffer.copy_(self.value_cache[layer_idx], non_blocking=True)
+        self.update_chunk_k(self.key_cache_buffer, layer_idx, self.seq_len, self.seq_len + key_states.shape[-3])
         
         key = self.key_cache_buffer[:, :self.seq_len + value_states.shape[-3]]
         value = self.value_cache_buffer[:, :self.seq_len + value_states.shape[-3]]
@@ -114,9 +306,239 @@ class OffloadingFlashSimpleCache(Cache):
 
         return key, value
 
+    def update_quantized(self, key_states, value_states, layer_idx):
+        start = self.seq_len
+        end = self.seq_len + key_states.shape[-3]
+
+        # the cached prefix crosses pcie compressed and is dequantized on chip, the incoming tokens stay exact
+        if start > 0:
+            self.key_q_buffer[:, :start].copy_(self.key_cache[layer_idx][:, :start], non_blocking=True)
+            dequantize_keys(self.key_q_buffer[:, :start], self.key_scale[layer_idx][:, :key_groups(start)].to(self.device, non_blocking=True), self.key_zero[layer_idx][:, :key_groups(start)].to(self.device, non_blocking=True), self.kv_bits, out=self.key_cache_buffer[:, :start])
+            self.value_q_buffer[:, :start].copy_(self.value_cache[layer_idx][:, :start], non_blocking=True)
+            dequantize_kv(self.value_q_buffer[:, :start], self.value_scale[layer_idx][:, :start].to(self.device, non_blocking=True), self.value_zero[layer_idx][:, :start].to(self.device, non_blocking=True), self.kv_bits, out=self.value_cache_buffer[:, :start])
+        self.key_cache_buffer[:, start:end] = key_states
+        self.value_cache_buffer[:, start:end] = value_states
+        self.update_chunk_k(self.key_cache_buffer, layer_idx, start, end)
+
+        # store the incoming tokens compressed, the key group they continue is requantized with them
+        first, keys = self.key_tail.group_keys(layer_idx, self.key_cache_buffer, start, end)
+        q, scale, zero = quantize_keys(keys, self.kv_bits)
+        self.key_cache[layer_idx][:, first:end].copy_(q)
+        self.key_scale[layer_idx][:, first // KEY_GROUP:key_groups(end)].copy_(scale)
+        self.key_zero[layer_idx][:, first // KEY_GROUP:key_groups(end)].copy_(zero)
+        q, scale, zero = quantize_kv(value_states, self.kv_bits)
+        self.value_cache[layer_idx][:, start:end].copy_(q)
+        self.value_scale[layer_idx][:, start:end].copy_(scale)
+        self.value_zero[layer_idx][:, start:end].copy_(zero)
+
+        if layer_idx == self.layers-1:
+            self.seq_len = end
+
+        return self.key_cache_buffer[:, :end], self.value_cache_buffer[:, :end]
+
+class KVBlockPool:
+    """
+    Fixed-size KV blocks shared by every PagedFlashSimpleCache built on it. Blocks are
+    handed out as sequences grow and returned on reset, so memory follows the real
+    sequence lengths instead of the longest prompt. Each block also keeps the chunk
+    summaries of its block_size // chunk_size chunks.
+    """
+    def __init__(self, model, num_blocks, block_size=256, chunk_size=8) -> None:
+        assert block_size % chunk_size == 0, f"block_size should be multiple of chunk_size, got {block_size} % {chunk_size}"
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+
+        self.hidden_size = model.config.hidden_size
+        self.num_heads = model.config.num_key_value_heads
+        self.head_dim = self.hidden_size // model.config.num_attention_heads
+        self.layers = model.config.num_hidden_layers
+        self.device = model.device
+
+        dtype = model.model.layers[0].self_attn.q_proj.weight.dtype
+
+        # (layers, num_blocks, block_size, 32, head_dim), the paged layout of flash_attn_with_kvcache
+        self.key_blocks = torch.zeros([self.layers, num_blocks, block_size, self.num_heads, self.head_dim], dtype=dtype, device=self.device)
+        self.value_blocks = torch.zeros([self.layers, num_blocks, block_size, self.num_heads, self.head_dim], dtype=dtype, device=self.device)
+        self.chunk_k_blocks = torch.zeros([self.layers, num_blocks, block_size // chunk_size, self.num_heads, self.head_dim], dtype=dtype, device=self.device)
+
+        self.free_blocks = list(range(num_blocks))
+
+    @classmethod
+    def from_budget(cls, model, max_tokens, block_size=256, chunk_size=8):
+        return cls(model, math.ceil(max_tokens / block_size), block_size=block_size, chunk_size=chunk_size)
+
+    def print_status(self):
+        print("[KV Block Pool] Blocks:", self.num_blocks, "| Free:", len(self.free_blocks), "| Block Size:", self.block_size, "| Chunk Size:", self.chunk_size)
+
+    def allocate(self, n):
+        if n > len(self.free_blocks):
+            raise RuntimeError(f"KV block pool exhausted, need {n} blocks, {len(self.free_blocks)} free")
+        blocks = self.free_blocks[:n]
+        self.free_blocks = self.free_blocks[n:]
+        return blocks
+
+    def free(self, blocks):
+        self.free_blocks.extend(blocks)
+
+class LayerReader:
+    """
+    Stands in for a (layers, ...) tensor that is not stored contiguously: only shape / dtype are
+    known up front and reader(i) materializes layer i.
+    """
+    def __init__(self, reader, shape, dtype) -> None:
+        self.reader = reader
+        self.shape = torch.Size(shape)
+        self.dtype = dtype
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            return self.reader(idx[0])[idx[1:]]
+        return self.reader(idx)
+
+    def numel(self):
+        return self.shape.numel()
+
+    def element_size(self):
+        return torch.tensor([], dtype=self.dtype).element_size()
+
+class PagedFlashSimpleCache(FlashSimpleCache):
+    """
+    Full target cache stored in KVBlockPool blocks and addressed through a per-sequence block table.
+    Attention reads the blocks directly (block_table / cache_seqlens of flash_attn_with_kvcache),
+    retrieval gathers whole chunks through the same table.
+    """
+    def __init__(self, model, pool: KVBlockPool, max_budget=1024) -> None:
+        self.seq_len = 0
+        self.max_budget = max_budget
+        self.pool = pool
+        self.paged = True
+        self.block_size = pool.block_size
+        self.chunk_size = pool.chunk_size
+        self.chunks_per_block = self.block_size // self.chunk_size
+
+        self.hidden_size = model.config.hidden_size
+        self.num_heads = model.config.num_key_value_heads
+        self.head_dim = self.hidden_size // model.config.num_attention_heads
+        self.layers = model.config.num_hidden_layers
+        self.device = model.device
+
+        self.max_blocks = math.ceil(max_budget / self.block_size)
+        self.blocks = []
+        self.block_table = torch.zeros([1, self.max_blocks], dtype=torch.int32, device=self.device)
+        self.cache_seqlens = torch.zeros([1], dtype=torch.int32, device=self.device)
+
+    def print_status(self):
+        print("[Paged Cache] Cached:", self.seq_len, "| Budget:", self.max_budget, "| Blocks:", len(self.blocks), "| Block Size:", self.block_size, "| Chunk Size:", self.chunk_size)
+
+    def reset(self):
+        self.seq_len = 0
+        self.pool.free(self.blocks)
+        self.blocks = []
+        self.block_table.zero_()
+        self.cache_seqlens.zero_()
+
+    def reserve(self, length):
+        needed = math.ceil(length / self.block_size) - len(self.blocks)
+        assert len(self.blocks) + needed <= self.max_blocks, f"sequence exceeds max_budget {self.max_budget}"
+        if needed > 0:
+            new_blocks = self.pool.allocate(needed)
+            self.block_table[0, len(self.blocks):len(self.blocks) + needed] = torch.tensor(new_blocks, dtype=torch.int32, device=self.device)
+            self.blocks.extend(new_blocks)
+
+    def slots(self, start, end):
+        # physical token slots of logical positions [start, end), empty when end <= start like slicing
+        pos = torch.arange(start, max(start, end), device=self.device)
+        return self.block_table[0, pos // self.block_size].long() * self.block_size + pos % self.block_size
+
+    def chunk_slots(self, start, end):
+        # physical chunk-summary slots of logical chunks [start, end)
+        chunk = torch.arange(start, max(start, end), device=self.device)
+        return self.block_table[0, chunk // self.chunks_per_block].long() * self.chunks_per_block + chunk % self.chunks_per_block
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        incoming = key_states.shape[-3]
+        if layer_idx == 0:
+            self.reserve(self.seq_len + incoming)
+            self.write_slots = self.slots(self.seq_len, self.seq_len + incoming)
+            self.cache_seqlens.fill_(self.seq_len + incoming)
+
+        key_blocks = self.pool.key_blocks[layer_idx]
+        value_blocks = self.pool.value_blocks[layer_idx]
+        key_blocks.view(-1, self.num_heads, self.head_dim).index_copy_(0, self.write_slots, key_states[0])
+        value_blocks.view(-1, self.num_heads, self.head_dim).index_copy_(0, self.write_slots, value_states[0])
+        self.update_chunk_k(None, layer_idx, self.seq_len, self.seq_len + incoming)
+
+        if layer_idx == self.layers-1:
+            self.seq_len += incoming
+
+        return key_blocks, value_blocks
+
+    def prefix_state(self, length):
+        # read from the blocks one layer at a time, a whole long prefix does not fit on chip twice
+        shape = [self.layers, length, self.num_heads, self.head_dim]
+        chunk_shape = [self.layers, length // self.chunk_size, self.num_heads, self.head_dim]
+        dtype = self.pool.key_blocks.dtype
+        return {
+            "key": LayerReader(lambda i: self.read_range(0, length, i)[0][0], shape, dtype),
+            "value": LayerReader(lambda i: self.read_range(0, length, i)[1][0], shape, dtype),
+            "chunk_k": LayerReader(lambda i: self.chunk_summary(i, length // self.chunk_size)[0], chunk_shape, dtype),
+        }
+
+    def load_prefix(self, state, length):
+        chunks = length // self.chunk_size
+        self.reserve(length)
+        slots = self.slots(0, length)
+        chunk_slots = self.chunk_slots(0, chunks)
+        for i in range(self.layers):
+            self.pool.key_blocks[i].view(-1, self.num_heads, self.head_dim).index_copy_(0, slots, state["key"][i, :length].to(self.device))
+            self.pool.value_blocks[i].view(-1, self.num_heads, self.head_dim).index_copy_(0, slots, state["value"][i, :length].to(self.device))
+            self.pool.chunk_k_blocks[i].view(-1, self.num_heads, self.head_dim).index_copy_(0, chunk_slots, state["chunk_k"][i, :chunks].to(self.device))
+        self.seq_len = length
+        self.cache_seqlens.fill_(length)
+
+    def update_chunk_k(self, key_cache, layer_idx, start, end):
+        lo = start // self.chunk_size
+        hi = end // self.chunk_size
+        if hi > lo:
+            key = self.read_range(lo*self.chunk_size, hi*self.chunk_size, layer_idx)[0]
+            chunk_k = key.view(hi-lo, self.chunk_size, self.num_heads, self.head_dim).mean(dim=-3)
+            self.pool.chunk_k_blocks[layer_idx].view(-1, self.num_heads, self.head_dim).index_copy_(0, self.chunk_slots(lo, hi), chunk_k)
+
+    def chunk_summary(self, layer_idx, chunks):
+        return self.pool.chunk_k_blocks[layer_idx].view(-1, self.num_heads, self.head_dim)[self.chunk_slots(0, chunks)].unsqueeze(0)
+
+    def gather_chunks(self, layer_idx, topk_idx, end, chunk_size):
+        # topk_idx: (bsz, 32, select_sets) --> token slots (32, select_sets*chunk_size)
+        offsets = torch.arange(chunk_size, device=self.device)
+        positions = (topk_idx[0].to(self.device).unsqueeze(-1) * chunk_size + offsets).flatten(1)
+        slots = self.block_table[0, positions // self.block_size].long() * self.block_size + positions % self.block_size
+        heads = torch.arange(self.num_heads, device=self.device).unsqueeze(-1)
+
+        key = self.pool.key_blocks[layer_idx].view(-1, self.num_heads, self.head_dim)[slots, heads]
+        value = self.pool.value_blocks[layer_idx].view(-1, self.num_heads, self.head_dim)[slots, heads]
+        # (32, select_sets*chunk_size, head_dim) --> (bsz, select_sets*chunk_size, 32, head_dim)
+        return key.transpose(0, 1).unsqueeze(0), value.transpose(0, 1).unsqueeze(0)
+
+    def read_range(self, start, end, layer_idx=None):
+        slots = self.slots(start, end)
+        if layer_idx is None:
+            key = self.pool.key_blocks.view(self.layers, -1, self.num_heads, self.head_dim)[:, slots].unsqueeze(1)
+            value = self.pool.value_blocks.view(self.layers, -1, self.num_heads, self.head_dim)[:, slots].unsqueeze(1)
+            return key, value
+        key = self.pool.key_blocks[layer_idx].view(-1, self.num_heads, self.head_dim)[slots].unsqueeze(0)
+        value = self.pool.value_blocks[layer_idx].view(-1, self.num_heads, self.head_dim)[slots].unsqueeze(0)
+        return key, value
+
 class RetrievalCache(Cache):
-    def __init__(self, model, max_budget=1024, prefill=1024, chunk_size=8, gamma=6) -> None:
+    def __init__(self, model, max_budget=1024, prefill=1024, chunk_size=8, gamma=6, bsz=1) -> None:
         
+        self.bsz = bsz
         self.chunk_size = chunk_size
         self.prefill = prefill
         self.chunks = prefill // self.chunk_size
@@ -135,14 +557,34 @@ class RetrievalCache(Cache):
 
         dtype = model.model.layers[0].self_attn.q_proj.weight.dtype
 
-        self.key_cache = torch.zeros([self.layers, 1, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
-        self.value_cache = torch.zeros([self.layers, 1, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+        self.key_cache = torch.zeros([self.layers, bsz, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+        self.value_cache = torch.zeros([self.layers, bsz, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+
+        # tokens before retrieval_end are selected by chunks, tokens after it form the recent tail
+        self.retrieval_end = prefill
+
+        # queries of the latest target verification, used to refresh the selection
+        self.query_cache = torch.zeros([self.layers, bsz, gamma + 2, model.config.num_attention_heads, self.head_dim], dtype=dtype).to(model.device)
 
         self.init_graph = False
 
     def print_status(self):
         print("[Retrieval Cache] Budget:", self.max_budget, " | PreFill:", self.prefill, " | Chunk Size:", self.chunk_size, " | Chunks:", self.chunks, " | Select Sets:", self.select_sets)
 
+    def tail_len(self, kv_cache):
+        return kv_cache.seq_len - self.retrieval_end
+
+    def record_query(self, query_states, layer_idx):
+        self.query_cache[layer_idx][:, :query_states.shape[1]] = query_states
+
+    def refresh(self, kv_cache, position):
+        # re-select chunks with the query recorded at `position` of the last verification,
+        # folding every complete chunk generated so far into the retrievable range
+        self.retrieval_end = max(self.prefill, (kv_cache.seq_len // self.chunk_size) * self.chunk_size)
+        for layer_idx in range(self.layers):
+            self.init_graph_cache(kv_cache, self.query_cache[layer_idx][:, position:position+1], layer_idx)
+        self.update_graph_cache(kv_cache)
+
     def init_graph_cache(self, kv_cache, query_states, layer_idx):
 
         # query_states: (bsz, 1, 32, head_dim) --> (bsz, 32, 1, head_dim)
@@ -151,7 +593,13 @@ class RetrievalCache(Cache):
 
         assert 1 == query_states.shape[1], "query_states should be 1 for init"
 
-        chunk_k = kv_cache.key_cache[layer_idx,:,:self.prefill].cuda().view(1, self.chunks, self.chunk_size, self.num_heads, self.head_dim).mean(dim=-3)
+        chunks = self.retrieval_end // self.chunk_size
+
+        if getattr(kv_cache, 'chunk_size', None) == self.chunk_size:
+            # O(chunks) read of the persistent summary index
+            chunk_k = kv_cache.chunk_summary(layer_idx, chunks)
+        else:
+            chunk_k = kv_cache.read_range(0, self.retrieval_end, layer_idx)[0].to(query_states.device).view(1, chunks, self.chunk_size, self.num_heads, self.head_dim).mean(dim=-3)
         
         # (bsz, 32, chunks)
         chunk_attn = torch.matmul(query_states.permute(0, 2, 1, 3), chunk_k.permute(0, 2, 3, 1)).squeeze(2)
@@ -160,47 +608,57 @@ class RetrievalCache(Cache):
         topk_idx_rest += 1
         topk_idx_first = torch.zeros((topk_idx_rest.shape[0], topk_idx_rest.shape[1], 1), device=topk_idx_rest.device, dtype=topk_idx_rest.dtype)
         topk_idx = torch.cat([topk_idx_first, topk_idx_rest], dim=-1)  # (bsz, 32, select_sets)
-        expanded_index_tensor = topk_idx.permute(0, 2, 1).unsqueeze(-1).unsqueeze(-1).expand(-1, -1, -1, self.chunk_size, self.head_dim)
 
-        # (bsz, prefill, 32, head_dim) --> (bsz, chunks, chunk_size, 32, head_dim) --> (bsz, chunks, 32, chunk_size, head_dim)
-        key_ = kv_cache.key_cache[layer_idx][:, :self.prefill].reshape(1, self.chunks, self.chunk_size, self.num_heads, self.head_dim).cuda()
-        key_ = key_.permute(0, 1, 3, 2, 4)
-        result_tensor = torch.gather(key_, 1, expanded_index_tensor) # (bsz, select_sets, 32, chunk_size, head_dim)
-        # (bsz, select_sets, 32, chunk_size, head_dim) --> (bsz, select_sets*chunk_size, 32, head_dim)
-        self.key_cache[layer_idx][:,:self.max_budget] = result_tensor.permute(0, 1, 3, 2, 4).reshape(1, self.select_sets*self.chunk_size, self.num_heads, self.head_dim).clone()
-
-        value_ = kv_cache.value_cache[layer_idx][:, :self.prefill].reshape(1, self.chunks, self.chunk_size, self.num_heads, self.head_dim).cuda()
-        value_ = value_.permute(0, 1, 3, 2, 4)
-        result_tensor = torch.gather(value_, 1, expanded_index_tensor)
-        self.value_cache[layer_idx][:,:self.max_budget] = result_tensor.permute(0, 1, 3, 2, 4).reshape(1, self.select_sets*self.chunk_size, self.num_heads, self.head_dim).clone()
+        key, value = kv_cache.gather_chunks(layer_idx, topk_idx, self.retrieval_end, self.chunk_size)
+        self.key_cache[layer_idx][:,:self.max_budget] = key.to(self.key_cache.device)
+        self.value_cache[layer_idx][:,:self.max_budget] = value.to(self.value_cache.device)
 
         if layer_idx == self.layers-1:
             self.init_graph = True
 
     def update_graph_cache(self, kv_cache=None):
-        self.value_cache[:,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget] = kv_cache.value_cache[:,:, self.prefill:kv_cache.seq_len].clone()
-        self.key_cache[:,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget] = kv_cache.key_cache[:,:, self.prefill:kv_cache.seq_len].clone()
+        key, value = kv_cache.read_range(self.retrieval_end, kv_cache.seq_len)
+        self.value_cache[:,:,self.max_budget-(kv_cache.seq_len-self.retrieval_end):self.max_budget] = value
+        self.key_cache[:,:,self.max_budget-(kv_cache.seq_len-self.retrieval_end):self.max_budget] = key
+
+    def update_graph_cache_batch(self, kv_cache):
+        # per-row tails of a BatchFlashSimpleCache, each right-aligned at max_budget
+        width = kv_cache.seq_len - self.retrieval_end
+        tail = kv_cache.seq_lens - self.retrieval_end
+        offset = torch.arange(width, device=tail.device) - (width - tail).unsqueeze(-1)
+        positions = self.retrieval_end + offset.clamp(min=0)
+        mask = (offset >= 0)[None, :, :, None, None]
+
+        key = kv_cache.key_cache[:, kv_cache.batch_idx, positions]
+        value = kv_cache.value_cache[:, kv_cache.batch_idx, positions]
+        self.key_cache[:,:,self.max_budget-width:self.max_budget] = torch.where(mask, key, self.key_cache[:,:,self.max_budget-width:self.max_budget])
+        self.value_cache[:,:,self.max_budget-width:self.max_budget] = torch.where(mask, value, self.value_cache[:,:,self.max_budget-width:self.max_budget])
 
     def update(self, new_k_cache :torch.Tensor, new_v_cache :torch.Tensor, layer_idx :int):
+        # q <= gamma + 1 speculated tokens right after the budget, so any captured speculation length fits
+        q = new_k_cache.shape[1]
+        self.key_cache[layer_idx][:, self.max_budget:self.max_budget+q] = new_k_cache.clone()
+        self.value_cache[layer_idx][:, self.max_budget:self.max_budget+q] = new_v_cache.clone()
 
-        self.key_cache[layer_idx][:, self.real_budget-self.gamma-1:] = new_k_cache.clone()
-        self.value_cache[layer_idx][:, self.real_budget-self.gamma-1:] = new_v_cache.clone()
-
-        return self.key_cache[layer_idx][:,:self.real_budget], self.value_cache[layer_idx][:,:self.real_budget]
+        return self.key_cache[layer_idx][:,:self.max_budget+q], self.value_cache[layer_idx][:,:self.max_budget+q]
 
     def update_graph_cache_retrieval(self, kv_cache, query_states, layer_idx):
         self.init_graph_cache(kv_cache, query_states, layer_idx)
-        self.value_cache[layer_idx,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget] = kv_cache.value_cache[layer_idx,:, self.prefill:kv_cache.seq_len].clone()
-        self.key_cache[layer_idx,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget] = kv_cache.key_cache[layer_idx,:, self.prefill:kv_cache.seq_len].clone()
+        key, value = kv_cache.read_range(self.retrieval_end, kv_cache.seq_len, layer_idx)
+        self.value_cache[layer_idx,:,self.max_budget-(kv_cache.seq_len-self.retrieval_end):self.max_budget] = value
+        self.key_cache[layer_idx,:,self.max_budget-(kv_cache.seq_len-self.retrieval_end):self.max_budget] = key
 
     def reset(self):
         self.key_cache.zero_()
         self.value_cache.zero_()
+        self.query_cache.zero_()
+        self.retrieval_end = self.prefill
 
 class StreamingLLMEvictionCache(Cache):
 
-    def __init__(self, model, gamma=6, start_size=16, recent_size=496) -> None:
+    def __init__(self, model, gamma=6, start_size=16, recent_size=496, bsz=1) -> None:
 
+        self.bsz = bsz
         self.gamma = gamma
         self.start_size = start_size
         self.recent_size = recent_size
@@ -213,8 +671,18 @@ class StreamingLLMEvictionCache(Cache):
         self.head_dim = self.hidden_size // model.config.num_attention_heads
         self.layers = model.config.num_hidden_layers
 
-        self.key_cache = torch.zeros([self.layers, 1, self.real_budget, self.num_heads, self.head_dim], dtype=torch.float16).to(model.device)
-        self.value_cache = torch.zeros([self.layers, 1, self.real_budget, self.num_heads, self.head_dim], dtype=torch.float16).to(model.device)
+        dtype = model.model.layers[0].self_attn.q_proj.weight.dtype
+
+        self.key_cache = torch.zeros([self.layers, bsz, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+        self.value_cache = torch.zeros([self.layers, bsz, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(model.device)
+        self.batch_idx = torch.arange(bsz, device=model.device).unsqueeze(-1)
+
+        # the recent window [start_size, start_size + recent_size) is a ring buffer: head is the slot of its oldest entry,
+        # key_position_ids the rope position of every slot (static, updated in place for captured draft graphs)
+        assert self.recent_size >= self.gamma + 3
+        self.ring_idx = torch.arange(self.recent_size, device=model.device)
+        self.head = torch.zeros(bsz, dtype=torch.long, device=model.device)
+        self.key_position_ids = torch.arange(self.real_budget, device=model.device).repeat(bsz, 1)
     
     def print_status(self):
         print("[StreamingLLM Cache] Start Size:", self.start_size, "| Recent Size:", self.recent_size, "| Gamma:", self.gamma, "| Real Budget:", self.real_budget, "| Cached:", self.seq_len)
@@ -248,8 +716,12 @@ class StreamingLLMEvictionCache(Cache):
         for i in range(self.layers):
             self.key_cache[i].zero_()
             self.value_cache[i].zero_()
+        self.seq_len = 0
+        self.head.zero_()
+        self.key_position_ids.copy_(torch.arange(self.real_budget, device=self.head.device).expand_as(self.key_position_ids))
 
     def evict_prefill(self, incoming):
+        # prefill keeps the window contiguous (the incoming slice must come last for the causal mask), the ring starts after it
         # evict
         if self.seq_len + incoming <= self.start_size + self.recent_size:
             return
@@ -261,12 +733,29 @@ class StreamingLLMEvictionCache(Cache):
         self.seq_len = self.start_size + self.recent_size - incoming
 
     def evict_for_spec(self, current_seq_len):
-        self.key_cache[:,:,self.start_size:self.start_size+self.recent_size] = self.key_cache[:,:, current_seq_len-self.recent_size:current_seq_len].clone()
-        self.value_cache[:,:, self.start_size:self.start_size+self.recent_size] = self.value_cache[:,:, current_seq_len-self.recent_size:current_seq_len].clone()
+        # keep the last recent_size of [window, spec tokens): the first `count` spec tokens overwrite the oldest
+        # ring slots and the head moves past them, the rest of the window is not copied
+        spec = self.start_size + self.recent_size
+        count = current_seq_len - spec
+        if isinstance(count, torch.Tensor):
+            # per-row lengths (bsz,)
+            steps = torch.arange(self.real_budget - spec, device=count.device)
+            moved = (steps < count.unsqueeze(-1))[None, :, :, None, None]
+        else:
+            steps = self.ring_idx[:count]
+        dest = self.start_size + (self.head.unsqueeze(-1) + steps) % self.recent_size
+        for cache in (self.key_cache, self.value_cache):
+            new = cache[:, :, spec:spec + steps.shape[0]]
+            if isinstance(count, torch.Tensor):
+                new = torch.where(moved, new, cache[:, self.batch_idx, dest])
+            cache[:, self.batch_idx, dest] = new
+
+        self.head.add_(count).remainder_(self.recent_size)
+        self.key_position_ids[:, self.start_size:spec] = self.start_size + (self.ring_idx - self.head.unsqueeze(-1)) % self.recent_size
 
 ############## Dist Cache ###############
 class DistributedSimpleCache(Cache):
-    def __init__(self, config, max_budget=1024, device=None, on_chip_layers=0, ssl=0):
+    def __init__(self, config, max_budget=1024, device=None, on_chip_layers=0, ssl=0, kv_bits=None, chunk_size=None, dtype=torch.float16):
         self.config = config
         self.world_size = self.config.world_size
         self.local_rank = self.config.local_rank
@@ -281,29 +770,141 @@ class DistributedSimpleCache(Cache):
         self.layers = self.config.num_hidden_layers
         
         self.seq_len = 0
-        dtype=torch.float16
         self.on_chip_layers = on_chip_layers
+        # host kv is pinned for async copies to the gpu, with a cpu device every layer is "on chip"
+        pin_memory = torch.device(device).type == 'cuda'
 
         self.key_cache = torch.zeros([self.on_chip_layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device=device)
         self.value_cache = torch.zeros([self.on_chip_layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device=device)
 
-        self.cpu_key_cache=torch.zeros([self.layers-self.on_chip_layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device='cpu', pin_memory=True)
-        self.cpu_value_cache=torch.zeros([self.layers-self.on_chip_layers, 1, self.max_budget, self.num_heads, self.head_dim], dtype=dtype, device='cpu', pin_memory=True)
+        # offloaded layers, optionally int8 / int4 (models/kv_quant.py): values with per token-head scales,
+        # keys with per channel scales of every KEY_GROUP tokens
+        self.kv_bits = kv_bits
+        cpu_shape = [self.layers-self.on_chip_layers, 1, self.max_budget, self.num_heads]
+        if kv_bits is None:
+            self.cpu_key_cache=torch.zeros(cpu_shape + [self.head_dim], dtype=dtype, device='cpu', pin_memory=pin_memory)
+            self.cpu_value_cache=torch.zeros(cpu_shape + [self.head_dim], dtype=dtype, device='cpu', pin_memory=pin_memory)
+        else:
+            check_kv_bits(kv_bits)
+            self.cpu_key_cache=torch.zeros(cpu_shape + [packed_dim(self.head_dim, kv_bits)], dtype=torch.uint8, device='cpu', pin_memory=pin_memory)
+            self.cpu_value_cache=torch.zeros(cpu_shape + [packed_dim(self.head_dim, kv_bits)], dtype=torch.uint8, device='cpu', pin_memory=pin_memory)
+            group_shape = [self.layers-self.on_chip_layers, 1, key_groups(self.max_budget), self.num_heads, self.head_dim]
+            self.cpu_key_scale=torch.zeros(group_shape, dtype=dtype, device='cpu', pin_memory=pin_memory)
+            self.cpu_key_zero=torch.zeros(group_shape, dtype=dtype, device='cpu', pin_memory=pin_memory)
+            self.cpu_value_scale=torch.zeros(cpu_shape + [1], dtype=dtype, device='cpu', pin_memory=pin_memory)
+            self.cpu_value_zero=torch.zeros(cpu_shape + [1], dtype=dtype, device='cpu', pin_memory=pin_memory)
+            self.key_tail = KeyTail(self.layers-self.on_chip_layers, self.num_heads, self.head_dim, dtype, device)
+
+        # chunk summaries of every layer stay on chip, so retrieval can re-select chunks without reading offloaded keys
+        self.chunk_size = chunk_size
+        self.chunk_k = None
+        if chunk_size is not None:
+            self.chunk_k = torch.zeros([self.layers, 1, self.max_budget // chunk_size, self.num_heads, self.head_dim], dtype=dtype, device=device)
+
+    def cpu_tensors(self):
+        if self.kv_bits is None:
+            return [self.cpu_key_cache, self.cpu_value_cache]
+        return [self.cpu_key_cache, self.cpu_value_cache, self.cpu_key_scale, self.cpu_key_zero, self.cpu_value_scale, self.cpu_value_zero]
+
+    def offload_bytes(self):
+        # host memory that is streamed to the gpu by a full forward
+        return sum(t.numel() * t.element_size() for t in self.cpu_tensors())
+
+    def offloaded_token_bytes(self):
+        # host bytes of one token of one head (key + value), the key scales amortized over their group
+        if self.kv_bits is None:
+            return 2 * self.head_dim * self.cpu_key_cache.element_size()
+        return 2 * packed_dim(self.head_dim, self.kv_bits) + 2 * self.cpu_key_scale.element_size() * (1 + self.head_dim / KEY_GROUP)
+
+    def load_offloaded(self, start, end):
+        # tokens [start, end) of all offloaded layers --> (layers-on_chip_layers, 1, end-start, heads, head_dim) on chip
+        if self.kv_bits is None:
+            return self.cpu_key_cache[:, :, start:end].to(self.device, non_blocking=True), self.cpu_value_cache[:, :, start:end].to(self.device, non_blocking=True)
+        groups = slice(start // KEY_GROUP, key_groups(end))
+        key = dequantize_keys(self.cpu_key_cache[:, :, start:end].to(self.device, non_blocking=True), *[t[:, :, groups].to(self.device, non_blocking=True) for t in (self.cpu_key_scale, self.cpu_key_zero)], self.kv_bits, start)
+        value = dequantize_kv(*[t[:, :, start:end].to(self.device, non_blocking=True) for t in (self.cpu_value_cache, self.cpu_value_scale, self.cpu_value_zero)], self.kv_bits)
+        return key, value
+
+    def gather_offloaded(self, layer_idx, positions, heads):
+        # positions: (n, chunk_size) tokens of heads: (n, 1) in an offloaded layer --> (n, chunk_size, head_dim) on chip
+        idx = layer_idx - self.on_chip_layers
+        if self.kv_bits is None:
+            return self.cpu_key_cache[idx, 0][positions, heads].to(self.device), self.cpu_value_cache[idx, 0][positions, heads].to(self.device)
+        key = dequantize_kv(self.cpu_key_cache[idx, 0][positions, heads].to(self.device), *[t[idx, 0][positions // KEY_GROUP, heads].to(self.device) for t in (self.cpu_key_scale, self.cpu_key_zero)], self.kv_bits)
+        value = dequantize_kv(*[t[idx, 0][positions, heads].to(self.device) for t in (self.cpu_value_cache, self.cpu_value_scale, self.cpu_value_zero)], self.kv_bits)
+        return key, value
+
+    def update_chunk_k(self, key_cache, layer_idx, start, end):
+        # refresh the summaries of the chunks completed by tokens [start, end)
+        lo = start // self.chunk_size
+        hi = end // self.chunk_size
+        if hi > lo:
+            self.chunk_k[layer_idx][:, lo:hi] = key_cache[:, lo*self.chunk_size:hi*self.chunk_size].view(1, hi-lo, self.chunk_size, self.num_heads, self.head_dim).mean(dim=-3)
 
     def print_status(self):
-        print("Cached Size:", self.seq_len, "| Max Budget:", self.max_budget)
+        print("Cached Size:", self.seq_len, "| Max Budget:", self.max_budget, "| Offloaded KV:", "fp16" if self.kv_bits is None else f"int{self.kv_bits}", f"{self.offload_bytes() / 1024**3:.2f} GB")
 
     def reset(self):
         self.seq_len = 0
-        self.cpu_key_cache.zero_()
-        self.cpu_value_cache.zero_()
+        for t in self.cpu_tensors():
+            t.zero_()
+        if self.kv_bits is not None:
+            self.key_tail.reset()
         self.key_cache.zero_()
         self.value_cache.zero_()
+        if self.chunk_k is not None:
+            self.chunk_k.zero_()
+
+    def prefix_state(self, length):
+        # on-chip layers and offloaded layers of this rank's heads
+        state = {
+            "key": self.key_cache[:, 0, :length],
+            "value": self.value_cache[:, 0, :length],
+            "cpu_key": self.cpu_key_cache[:, 0, :length],
+            "cpu_value": self.cpu_value_cache[:, 0, :length],
+        }
+        if self.kv_bits is not None:
+            state.update({
+                "cpu_key_scale": self.cpu_key_scale[:, 0, :key_groups(length)],
+                "cpu_key_zero": self.cpu_key_zero[:, 0, :key_groups(length)],
+                "cpu_value_scale": self.cpu_value_scale[:, 0, :length],
+                "cpu_value_zero": self.cpu_value_zero[:, 0, :length],
+            })
+        if self.chunk_k is not None:
+            state["chunk_k"] = self.chunk_k[:, 0, :length // self.chunk_size]
+        return state
+
+    def load_prefix(self, state, length):
+        for i in range(self.on_chip_layers):
+            self.key_cache[i, 0, :length].copy_(state["key"][i, :length])
+            self.value_cache[i, 0, :length].copy_(state["value"][i, :length])
+        for i in range(self.layers - self.on_chip_layers):
+            self.cpu_key_cache[i, 0, :length].copy_(state["cpu_key"][i, :length])
+            self.cpu_value_cache[i, 0, :length].copy_(state["cpu_value"][i, :length])
+            if self.kv_bits is not None:
+                self.cpu_key_scale[i, 0, :key_groups(length)].copy_(state["cpu_key_scale"][i, :key_groups(length)])
+                self.cpu_key_zero[i, 0, :key_groups(length)].copy_(state["cpu_key_zero"][i, :key_groups(length)])
+                self.cpu_value_scale[i, 0, :length].copy_(state["cpu_value_scale"][i, :length])
+                self.cpu_value_zero[i, 0, :length].copy_(state["cpu_value_zero"][i, :length])
+        if self.chunk_k is not None:
+            chunks = length // self.chunk_size
+            for i in range(self.layers):
+                self.chunk_k[i, 0, :chunks].copy_(state["chunk_k"][i, :chunks])
+        if self.kv_bits is not None:
+            self.key_tail.reset()
+        self.seq_len = length
+        self.ssl_cur = 0
 
     def normal_(self, seq_len=1024*127):
         self.seq_len = seq_len
-        self.cpu_key_cache.normal_()
-        self.cpu_value_cache.normal_()
+        if self.kv_bits is None:
+            self.cpu_key_cache.normal_()
+            self.cpu_value_cache.normal_()
+        else:
+            self.cpu_key_cache.random_(0, 256)
+            self.cpu_value_cache.random_(0, 256)
+            for t in self.cpu_tensors()[2:]:
+                t.normal_()
         self.key_cache.normal_()
         self.value_cache.normal_()
 
@@ -312,9 +913,17 @@ class DistributedSimpleCache(Cache):
         self.key_cache[layer_idx][:, self.seq_len : self.seq_len + key_states.shape[1]] = key_states.clone()
         self.value_cache[layer_idx][:, self.seq_len : self.seq_len + value_states.shape[1]] = value_states.clone()
 
+        if self.chunk_k is not None:
+            self.update_chunk_k(self.key_cache[layer_idx], layer_idx, self.seq_len, self.seq_len + key_states.shape[1])
+
         key = self.key_cache[layer_idx][:, :self.seq_len + value_states.shape[1]]
         value = self.value_cache[layer_idx][:, :self.seq_len + value_states.shape[1]]
 
+        if layer_idx == self.layers - 1:
+            # every layer is on chip (cpu device), no copy back from a kv buffer advances the length
+            self.seq_len += key_states.shape[1]
+            self.ssl_cur = 0
+
         return key, value
 
     def ssl_update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int,) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -336,27 +945,59 @@ class DistributedSimpleCache(Cache):
         self.key_cache[:,:, offset:offset + len(indices)].copy_(self.key_cache[:,:, indices].clone(), non_blocking=True)
         self.value_cache[:,:, offset:offset + len(indices)].copy_(self.value_cache[:,:, indices].clone(), non_blocking=True)
 
-        self.cpu_key_cache[:, :, offset:offset + len(indices)].copy_(self.cpu_key_cache[:, :, indices].clone(), non_blocking=True)
-        self.cpu_value_cache[:, :, offset:offset + len(indices)].copy_(self.cpu_value_cache[:, :, indices].clone(), non_blocking=True)
+        if self.kv_bits is None:
+            for t in self.cpu_tensors():
+                t[:, :, offset:offset + len(indices)].copy_(t[:, :, indices].clone(), non_blocking=True)
+        else:
+            for t in (self.cpu_value_cache, self.cpu_value_scale, self.cpu_value_zero):
+                t[:, :, offset:offset + len(indices)].copy_(t[:, :, indices].clone(), non_blocking=True)
+            # keys share scales within a group: requantize the reordered groups from their dequantized keys
+            first = offset // KEY_GROUP * KEY_GROUP
+            end = max(indices) + 1
+            groups = slice(first // KEY_GROUP, key_groups(end))
+            keys = dequantize_keys(self.cpu_key_cache[:, :, first:end].to(self.device), *[t[:, :, groups].to(self.device) for t in (self.cpu_key_scale, self.cpu_key_zero)], self.kv_bits, first)
+            keys = torch.cat([keys[:, :, :offset - first], keys[:, :, [i - first for i in indices]]], dim=2)
+            q, scale, zero = quantize_keys(keys, self.kv_bits)
+            end = offset + len(indices)
+            self.cpu_key_cache[:, :, first:end].copy_(q)
+            self.cpu_key_scale[:, :, first // KEY_GROUP:key_groups(end)].copy_(scale)
+            self.cpu_key_zero[:, :, first // KEY_GROUP:key_groups(end)].copy_(zero)
+            self.key_tail.reset()
 
         self.seq_len = offset + len(indices)
         self.ssl_cur = 0
 
     def copy_back_from_buffer(self, kv_buffer, layer_idx:int):
-        self.cpu_key_cache[layer_idx-self.on_chip_layers][:,self.seq_len: kv_buffer.seq_len].copy_(kv_buffer.key_cache[:, self.seq_len: kv_buffer.seq_len], non_blocking=True)
-        self.cpu_value_cache[layer_idx-self.on_chip_layers][:,self.seq_len: kv_buffer.seq_len].copy_(kv_buffer.value_cache[:, self.seq_len: kv_buffer.seq_len], non_blocking=True)
+        idx = layer_idx-self.on_chip_layers
+        if self.chunk_k is not None:
+            self.update_chunk_k(kv_buffer.key_cache, layer_idx, self.seq_len, kv_buffer.seq_len)
+        if self.kv_bits is None:
+            self.cpu_key_cache[idx][:,self.seq_len: kv_buffer.seq_len].copy_(kv_buffer.key_cache[:, self.seq_len: kv_buffer.seq_len], non_blocking=True)
+            self.cpu_value_cache[idx][:,self.seq_len: kv_buffer.seq_len].copy_(kv_buffer.value_cache[:, self.seq_len: kv_buffer.seq_len], non_blocking=True)
+        else:
+            # quantize the new tokens on chip, only the compressed bytes go back to the host; the key group
+            # they continue is requantized with them
+            first, keys = self.key_tail.group_keys(idx, kv_buffer.key_cache, self.seq_len, kv_buffer.seq_len)
+            q, scale, zero = quantize_keys(keys, self.kv_bits)
+            self.cpu_key_cache[idx][:,first: kv_buffer.seq_len].copy_(q, non_blocking=True)
+            self.cpu_key_scale[idx][:,first // KEY_GROUP: key_groups(kv_buffer.seq_len)].copy_(scale, non_blocking=True)
+            self.cpu_key_zero[idx][:,first // KEY_GROUP: key_groups(kv_buffer.seq_len)].copy_(zero, non_blocking=True)
+            q, scale, zero = quantize_kv(kv_buffer.value_cache[:, self.seq_len: kv_buffer.seq_len], self.kv_bits)
+            self.cpu_value_cache[idx][:,self.seq_len: kv_buffer.seq_len].copy_(q, non_blocking=True)
+            self.cpu_value_scale[idx][:,self.seq_len: kv_buffer.seq_len].copy_(scale, non_blocking=True)
+            self.cpu_value_zero[idx][:,self.seq_len: kv_buffer.seq_len].copy_(zero, non_blocking=True)
 
         if layer_idx == self.layers - 1:
             self.seq_len = kv_buffer.seq_len
             self.ssl_cur = 0
 
 class DistributedKVCacheBuffer:
-    def __init__(self, config, max_budget=1024, device=None) -> None:
+    def __init__(self, config, max_budget=1024, device=None, kv_bits=None, dtype=torch.float16) -> None:
 
         self.config = config
         self.max_budget = max_budget
         self.device = device
-        self.dtype = torch.float16
+        self.dtype = dtype
 
         self.world_size = config.world_size
         self.local_rank = config.local_rank
@@ -369,11 +1010,33 @@ class DistributedKVCacheBuffer:
         self.value_cache = torch.zeros(1, self.max_budget, self.num_heads, self.head_dim, device=self.device,dtype=self.dtype)
         self.seq_len = 0
 
+        # landing buffers of the compressed kv, dequantized into key_cache / value_cache
+        self.kv_bits = kv_bits
+        if kv_bits is not None:
+            self.key_q = torch.zeros(1, self.max_budget, self.num_heads, packed_dim(self.head_dim, kv_bits), device=self.device, dtype=torch.uint8)
+            self.value_q = torch.zeros(1, self.max_budget, self.num_heads, packed_dim(self.head_dim, kv_bits), device=self.device, dtype=torch.uint8)
+            self.key_scale = torch.zeros(1, key_groups(self.max_budget), self.num_heads, self.head_dim, device=self.device, dtype=self.dtype)
+            self.key_zero = torch.zeros(1, key_groups(self.max_budget), self.num_heads, self.head_dim, device=self.device, dtype=self.dtype)
+            self.value_scale = torch.zeros(1, self.max_budget, self.num_heads, 1, device=self.device, dtype=self.dtype)
+            self.value_zero = torch.zeros(1, self.max_budget, self.num_heads, 1, device=self.device, dtype=self.dtype)
+
     def copy_kv(self, kv_cache, layer_idx):
         on_chip_layers = kv_cache.on_chip_layers
-        self.key_cache[:,:kv_cache.seq_len].copy_(kv_cache.cpu_key_cache[layer_idx-on_chip_layers][:,:kv_cache.seq_len], non_blocking=True)
-        self.value_cache[:,:kv_cache.seq_len].copy_(kv_cache.cpu_value_cache[layer_idx-on_chip_layers][:,:kv_cache.seq_len], non_blocking=True)
-        self.seq_len = kv_cache.seq_len
+        idx = layer_idx-on_chip_layers
+        seq_len = kv_cache.seq_len
+        if kv_cache.kv_bits is None:
+            self.key_cache[:,:seq_len].copy_(kv_cache.cpu_key_cache[idx][:,:seq_len], non_blocking=True)
+            self.value_cache[:,:seq_len].copy_(kv_cache.cpu_value_cache[idx][:,:seq_len], non_blocking=True)
+        else:
+            self.key_q[:,:seq_len].copy_(kv_cache.cpu_key_cache[idx][:,:seq_len], non_blocking=True)
+            self.key_scale[:,:key_groups(seq_len)].copy_(kv_cache.cpu_key_scale[idx][:,:key_groups(seq_len)], non_blocking=True)
+            self.key_zero[:,:key_groups(seq_len)].copy_(kv_cache.cpu_key_zero[idx][:,:key_groups(seq_len)], non_blocking=True)
+            self.value_q[:,:seq_len].copy_(kv_cache.cpu_value_cache[idx][:,:seq_len], non_blocking=True)
+            self.value_scale[:,:seq_len].copy_(kv_cache.cpu_value_scale[idx][:,:seq_len], non_blocking=True)
+            self.value_zero[:,:seq_len].copy_(kv_cache.cpu_value_zero[idx][:,:seq_len], non_blocking=True)
+            dequantize_keys(self.key_q[:,:seq_len], self.key_scale[:,:key_groups(seq_len)], self.key_zero[:,:key_groups(seq_len)], kv_cache.kv_bits, out=self.key_cache[:,:seq_len])
+            dequantize_kv(self.value_q[:,:seq_len], self.value_scale[:,:seq_len], self.value_zero[:,:seq_len], kv_cache.kv_bits, out=self.value_cache[:,:seq_len])
+        self.seq_len = seq_len
 
     def update(self, key_states :torch.Tensor, value_states :torch.Tensor, layer_idx :int):
         input_length = key_states.shape[1]
@@ -382,6 +1045,103 @@ class DistributedKVCacheBuffer:
         self.seq_len += input_length
         return self.key_cache[:,:self.seq_len], self.value_cache[:,:self.seq_len]
 
+class DistributedKVPrefetcher:
+    """
+    Streams the kv of the offloaded layers through the len(kv_buffer) on-chip buffers.
+
+    Layer i computes on the current stream from kv_buffer[i % depth]. Once it is done, the copy stream
+    copies its new tokens back to the host and refills the buffer with layer i + depth, so copy back and
+    prefetch overlap with the compute of the next layers. The streams are ordered with events only, the
+    host never synchronizes. With record_stats, per layer copy / compute / stall times are kept for report().
+    """
+    def __init__(self, kv_cache: DistributedSimpleCache, kv_buffer: list[DistributedKVCacheBuffer], num_layers: int, device=None) -> None:
+        self.kv_cache = kv_cache
+        self.kv_buffer = kv_buffer
+        self.depth = len(kv_buffer)
+        self.on_chip_layers = kv_cache.on_chip_layers
+        self.num_layers = num_layers
+
+        self.copy_stream = torch.cuda.Stream(device=device)
+        self.ready = [torch.cuda.Event() for _ in range(self.depth)] # buffer filled
+        self.done = [torch.cuda.Event() for _ in range(self.depth)] # buffer consumed by compute
+
+        self.record_stats = False
+        self.pending = {}
+        self.records = []
+
+    def timing_event(self, stream=None):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(stream)
+        return event
+
+    def prefetch(self, layer_idx):
+        slot = layer_idx % self.depth
+        with torch.cuda.stream(self.copy_stream):
+            if self.record_stats:
+                start = self.timing_event(self.copy_stream)
+            self.kv_buffer[slot].copy_kv(self.kv_cache, layer_idx)
+            self.ready[slot].record(self.copy_stream)
+            if self.record_stats:
+                self.pending[layer_idx] = [start, self.timing_event(self.copy_stream)]
+
+    def start(self):
+        # fill the pipeline, overlapping with the embedding and the on-chip layers
+        self.copy_stream.wait_stream(torch.cuda.current_stream())
+        for idx in range(self.on_chip_layers, min(self.on_chip_layers + self.depth, self.num_layers)):
+            self.prefetch(idx)
+
+    def wait(self, layer_idx):
+        stream = torch.cuda.current_stream()
+        record = self.record_stats and layer_idx in self.pending
+        if record:
+            self.pending[layer_idx].append(self.timing_event(stream))
+        stream.wait_event(self.ready[layer_idx % self.depth])
+        if record:
+            self.pending[layer_idx].append(self.timing_event(stream))
+        return self.kv_buffer[layer_idx % self.depth]
+
+    def release(self, layer_idx):
+        # layer_idx is computed: copy back its new tokens, then reuse its buffer for layer_idx + depth
+        slot = layer_idx % self.depth
+        stream = torch.cuda.current_stream()
+        if self.record_stats and layer_idx in self.pending:
+            self.records.append((layer_idx, *self.pending.pop(layer_idx), self.timing_event(stream)))
+        self.done[slot].record(stream)
+        with torch.cuda.stream(self.copy_stream):
+            self.copy_stream.wait_event(self.done[slot])
+            self.kv_cache.copy_back_from_buffer(self.kv_buffer[slot], layer_idx)
+        if layer_idx + self.depth < self.num_layers:
+            self.prefetch(layer_idx + self.depth)
+
+    def finish(self):
+        # later readers of the host kv on the current stream see the copied back tokens
+        torch.cuda.current_stream().wait_stream(self.copy_stream)
+
+    def report(self):
+        # per offloaded layer: mean copy (prefetch), compute and stall ms, overlap = hidden share of the copy
+        torch.cuda.synchronize()
+        layers = {}
+        for layer_idx, copy_start, copy_end, wait_start, compute_start, compute_end in self.records:
+            layers.setdefault(layer_idx, []).append((copy_start.elapsed_time(copy_end), compute_start.elapsed_time(compute_end), wait_start.elapsed_time(compute_start)))
+        self.records = []
+        report = {}
+        for layer_idx, samples in sorted(layers.items()):
+            copy_ms, compute_ms, stall_ms = [sum(x) / len(samples) for x in zip(*samples)]
+            report[layer_idx] = {"copy_ms": copy_ms, "compute_ms": compute_ms, "stall_ms": stall_ms, "overlap": 1 - stall_ms / copy_ms if copy_ms > 0 else 1.0}
+        return report
+
+    def print_report(self):
+        report = self.report()
+        if not report:
+            print("[KV Prefetcher] no records")
+            return
+        for layer_idx, r in report.items():
+            print(f"  layer {layer_idx:>3} | copy {r['copy_ms']:8.3f} ms | compute {r['compute_ms']:8.3f} ms | stall {r['stall_ms']:8.3f} ms | overlap {100 * r['overlap']:5.1f}%")
+        stall = sum(r["stall_ms"] for r in report.values())
+        copy = sum(r["copy_ms"] for r in report.values())
+        # every layer moved on chip saves its stall, at the cost of its kv memory
+        print(f"[KV Prefetcher] Depth: {self.depth} | Offloaded Layers: {len(report)} | Copy: {copy:.3f} ms | Exposed Stall: {stall:.3f} ms per forward | Overlap: {100 * (1 - stall / copy) if copy > 0 else 100:.1f}%")
+
 class DistributedRetrievalCache_Seqouia:
 
     def __init__(self, config, max_budget=1024, device=None, prefill=1024, chunk_size=8, tree_size=128) -> None:
@@ -483,7 +1243,16 @@ class DistributedRetrievalCache_Seqouia:
         self.value_cache.normal_()
 
 class DistributedRetrievalCache:
-    def __init__(self, config, max_budget=1024, device=None, prefill=1024, chunk_size=8, gamma=6) -> None:
+    """
+    Retrieval (middle level) cache of the tensor parallel target. Slots [0, max_budget) hold the selected
+    chunks of every head, the tokens generated after retrieval_end fill [max_budget - tail, max_budget)
+    and the speculated tokens the last gamma+1 slots.
+
+    Only deltas cross PCIe: the tail is shifted on chip and just the newly committed tokens are copied,
+    and with refresh=True a re-selection moves only the chunks that are not resident yet. `resident`
+    maps every (layer, head, slot) to the chunk it holds (-1 if none).
+    """
+    def __init__(self, config, max_budget=1024, device=None, prefill=1024, chunk_size=8, gamma=6, refresh=False, dtype=torch.float16) -> None:
 
         self.config = config
         self.world_size = self.config.world_size
@@ -507,12 +1276,31 @@ class DistributedRetrievalCache:
         self.real_budget = max_budget + gamma + 1
         self.init_graph = False
         self.device=device
-        dtype=torch.float16
         self.key_cache=torch.zeros([self.layers, 1, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(device)
         self.value_cache=torch.zeros([self.layers, 1, self.real_budget, self.num_heads, self.head_dim], dtype=dtype).to(device)
 
+        # tokens before retrieval_end are selected by chunks, [retrieval_end, synced_len) is the tail on chip
+        self.retrieval_end = prefill
+        self.synced_len = prefill
+        self.resident = torch.full([self.layers, self.num_heads, self.select_sets], -1, dtype=torch.long, device=device)
+
+        # queries of the latest target verification, used to refresh the selection
+        self.query_cache = None
+        if refresh:
+            self.query_cache = torch.zeros([self.layers, 1, gamma + 2, config.num_attention_heads // self.world_size, self.head_dim], dtype=dtype, device=device)
+
+        # host --> device bytes of the offloaded layers, by tail updates and by refreshes
+        self.tail_bytes = 0
+        self.refresh_bytes = 0
+
     def print_status(self):
-        print("Budget:", self.max_budget, " | Real Budget:", self.real_budget, " | PreFill:", self.prefill, " | Chunk Size:", self.chunk_size, " | Chunks:", self.chunks, " | Select Sets:", self.select_sets)
+        print("Budget:", self.max_budget, " | Real Budget:", self.real_budget, " | PreFill:", self.prefill, " | Chunk Size:", self.chunk_size, " | Chunks:", self.chunks, " | Select Sets:", self.select_sets, f" | H2D Tail: {self.tail_bytes / 1024**2:.2f} MB | H2D Refresh: {self.refresh_bytes / 1024**2:.2f} MB")
+
+    def tail_len(self, kv_cache):
+        return kv_cache.seq_len - self.retrieval_end
+
+    def record_query(self, query_states, layer_idx):
+        self.query_cache[layer_idx][:, :query_states.shape[1]] = query_states
 
     def init_graph_cache(self, kv_cache, query_states, layer_idx):
 
@@ -541,19 +1329,24 @@ class DistributedRetrievalCache:
         key_ = key_.permute(0, 1, 3, 2, 4)
         result_tensor = torch.gather(key_, 1, expanded_index_tensor) # (bsz, select_sets, 32, chunk_size, head_dim)
         # (bsz, select_sets, 32, chunk_size, head_dim) --> (bsz, select_sets*chunk_size, 32, head_dim)
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        if self.key_cache.is_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
         self.key_cache[layer_idx][:,:self.max_budget].copy_(result_tensor.permute(0, 1, 3, 2, 4).reshape(1, self.select_sets*self.chunk_size, self.num_heads, self.head_dim))
 
         value_ = value_cache[:, :self.prefill].reshape(1, self.chunks, self.chunk_size, self.num_heads, self.head_dim)
         value_ = value_.permute(0, 1, 3, 2, 4)
         result_tensor = torch.gather(value_, 1, expanded_index_tensor)
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        if self.key_cache.is_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
         self.value_cache[layer_idx][:,:self.max_budget].copy_(result_tensor.permute(0, 1, 3, 2, 4).reshape(1, self.select_sets*self.chunk_size, self.num_heads, self.head_dim))
 
+        self.resident[layer_idx] = topk_idx[0]
         if layer_idx == self.layers-1:
             self.init_graph = True
+            self.retrieval_end = self.prefill
+            self.synced_len = self.prefill
 
 
     def update(self, key_states :torch.Tensor, value_states :torch.Tensor, layer_idx :int):
@@ -564,21 +1357,100 @@ class DistributedRetrievalCache:
         return self.key_cache[layer_idx][:,:self.real_budget], self.value_cache[layer_idx][:,:self.real_budget]
 
     def update_graph_cache(self, kv_cache=None):
+        # the tail [retrieval_end, seq_len) stays right-aligned at max_budget: shift what is already
+        # on chip and copy only the tokens committed since the last update
+        old_tail = self.synced_len - self.retrieval_end
+        new_tail = kv_cache.seq_len - self.retrieval_end
+        if new_tail < old_tail:
+            old_tail = 0
+        if old_tail > 0 and new_tail > old_tail:
+            self.key_cache[:,:,self.max_budget-new_tail:self.max_budget-new_tail+old_tail] = self.key_cache[:,:,self.max_budget-old_tail:self.max_budget].clone()
+            self.value_cache[:,:,self.max_budget-new_tail:self.max_budget-new_tail+old_tail] = self.value_cache[:,:,self.max_budget-old_tail:self.max_budget].clone()
+        start = self.retrieval_end + old_tail
+        delta = new_tail - old_tail
 
         # on-chip layers
         on_chip_layers = kv_cache.on_chip_layers
-        self.value_cache[:on_chip_layers,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget].copy_(kv_cache.value_cache[:,:,self.prefill:kv_cache.seq_len], non_blocking=True)
-        self.key_cache[:on_chip_layers,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget].copy_(kv_cache.key_cache[:,:,self.prefill:kv_cache.seq_len], non_blocking=True)
-
-        # cpu layers
-        self.value_cache[on_chip_layers:,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget].copy_(kv_cache.cpu_value_cache[:,:,self.prefill:kv_cache.seq_len], non_blocking=True)
-        self.key_cache[on_chip_layers:,:,self.max_budget-(kv_cache.seq_len-self.prefill):self.max_budget].copy_(kv_cache.cpu_key_cache[:,:,self.prefill:kv_cache.seq_len], non_blocking=True)
+        self.value_cache[:on_chip_layers,:,self.max_budget-delta:self.max_budget].copy_(kv_cache.value_cache[:,:,start:kv_cache.seq_len], non_blocking=True)
+        self.key_cache[:on_chip_layers,:,self.max_budget-delta:self.max_budget].copy_(kv_cache.key_cache[:,:,start:kv_cache.seq_len], non_blocking=True)
+
+        # cpu layers, int8 / int4 keys of the group continued by the new tokens were requantized, so it is reloaded
+        if kv_cache.kv_bits is not None:
+            start = max(self.retrieval_end, start // KEY_GROUP * KEY_GROUP)
+        loaded = kv_cache.seq_len - start
+        key, value = kv_cache.load_offloaded(start, kv_cache.seq_len)
+        self.value_cache[on_chip_layers:,:,self.max_budget-loaded:self.max_budget].copy_(value, non_blocking=True)
+        self.key_cache[on_chip_layers:,:,self.max_budget-loaded:self.max_budget].copy_(key, non_blocking=True)
+        self.tail_bytes += (self.layers - on_chip_layers) * loaded * self.num_heads * kv_cache.offloaded_token_bytes()
+
+        # chunks overlapped by the tail are gone
+        self.resident[:, :, (self.max_budget-new_tail) // self.chunk_size:] = -1
+        self.synced_len = kv_cache.seq_len
+
+    def refresh(self, kv_cache, position):
+        # re-select chunks with the query recorded at `position` of the last verification, folding every
+        # complete generated chunk into the retrievable range; only chunks that are not resident are moved
+        assert self.query_cache is not None and kv_cache.chunk_k is not None, "refresh needs refresh=True and chunk summaries in the kv cache"
+        assert kv_cache.chunk_size == self.chunk_size
+        self.retrieval_end = max(self.prefill, (kv_cache.seq_len // self.chunk_size) * self.chunk_size)
+        chunks = self.retrieval_end // self.chunk_size
+        tail = kv_cache.seq_len - self.retrieval_end
+        # slots left to chunks once the tail is written
+        select_sets = min((self.max_budget - tail) // self.chunk_size, chunks)
+
+        slot_ids = torch.arange(self.select_sets, device=self.device)
+        offsets = torch.arange(self.chunk_size, device=self.device)
+        for layer_idx in range(self.layers):
+            query_states = self.query_cache[layer_idx][:, position:position+1]
+            chunk_attn = torch.matmul(query_states.permute(0, 2, 1, 3), kv_cache.chunk_k[layer_idx][:, :chunks].permute(0, 2, 3, 1)).squeeze(2)
+            _, topk_idx_rest = torch.topk(chunk_attn[0, :, 1:], k=select_sets-1, dim=-1)
+            selected = torch.cat([torch.zeros_like(topk_idx_rest[:, :1]), topk_idx_rest + 1], dim=-1) # (32, select_sets)
+
+            # slots past select_sets are overwritten by the tail and never hold a chunk
+            usable = slot_ids < select_sets
+            resident = torch.where(usable, self.resident[layer_idx], -1)
+            keep = (resident.unsqueeze(-1) == selected.unsqueeze(-2)).any(dim=-1) | ~usable # slot keeps its chunk
+            present = (selected.unsqueeze(-1) == resident.unsqueeze(-2)).any(dim=-1) # chunk already resident
+
+            # pair the k-th missing chunk of every head with its k-th free slot
+            missing = torch.argsort(present.to(torch.int8), dim=-1, stable=True)
+            free = torch.argsort(keep.to(torch.int8), dim=-1, stable=True)
+            n_missing = (~present).sum(dim=-1, keepdim=True)
+            valid = torch.arange(missing.shape[-1], device=self.device) < n_missing
+            heads = torch.arange(self.num_heads, device=self.device).unsqueeze(-1).expand_as(missing)[valid]
+            chunk_ids = selected.gather(-1, missing)[valid]
+            slots = free[:, :missing.shape[-1]][valid]
+            if chunk_ids.numel() == 0:
+                continue
+
+            positions = chunk_ids.unsqueeze(-1) * self.chunk_size + offsets # (n, chunk_size)
+            if layer_idx < kv_cache.on_chip_layers:
+                key = kv_cache.key_cache[layer_idx][0][positions, heads.unsqueeze(-1)]
+                value = kv_cache.value_cache[layer_idx][0][positions, heads.unsqueeze(-1)]
+            else:
+                key, value = kv_cache.gather_offloaded(layer_idx, positions.cpu(), heads.unsqueeze(-1).cpu())
+                self.refresh_bytes += positions.numel() * kv_cache.offloaded_token_bytes()
+            slot_positions = slots.unsqueeze(-1) * self.chunk_size + offsets
+            self.key_cache[layer_idx][0][slot_positions, heads.unsqueeze(-1)] = key
+            self.value_cache[layer_idx][0][slot_positions, heads.unsqueeze(-1)] = value
+            self.resident[layer_idx][heads, slots] = chunk_ids
+
+        # the tail restarts at the new retrieval_end
+        self.synced_len = self.retrieval_end
+        self.update_graph_cache(kv_cache)
 
     def reset(self):
         self.key_cache.zero_()
         self.value_cache.zero_()
         self.init_graph = False
+        self.retrieval_end = self.prefill
+        self.synced_len = self.prefill
+        self.resident.fill_(-1)
+        if self.query_cache is not None:
+            self.query_cache.zero_()
+        self.tail_bytes = 0
+        self.refresh_bytes = 0
 
     def normal_(self):
         self.key_cache.normal_()
-        self.value_cache.normal_()
\ No newline at end of file
+        self.value_cache.normal_()
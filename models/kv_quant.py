@@ -0,0 +1,95 @@
+import torch
+import warnings
+
+# Asymmetric min / max quantization of offloaded kv. Values get one (scale, zero) pair per token and head.
+# Keys have outlier channels, so they are quantized per channel over groups of KEY_GROUP tokens (as in KIVI):
+# one (scale, zero) per group, head and channel. int4 packs two values per byte along head_dim, so with fp16
+# scales a 128-dim head takes 132 + 144 bytes (int8) or 68 + 80 bytes (int4) of value + key instead of 512.
+#
+# Attention output error against fp16 on test/kv_quant.py: about 1% with int8, about 15% with int4, which is
+# why int4 is experimental.
+
+KEY_GROUP = 32
+
+def packed_dim(head_dim, bits):
+    assert bits in (4, 8), f"only int8 / int4 kv is supported, got {bits}"
+    return head_dim * bits // 8
+
+def check_kv_bits(bits):
+    if bits not in (4, 8):
+        raise ValueError(f"only int8 / int4 kv is supported, got {bits}")
+    if bits == 4:
+        warnings.warn("int4 offloaded kv is experimental, attention output is ~15% off fp16 (test/kv_quant.py)")
+
+def key_groups(tokens):
+    return (tokens + KEY_GROUP - 1) // KEY_GROUP
+
+def quantize_kv(x: torch.Tensor, bits: int, dim: int=-1):
+    # x: (..., head_dim) --> q: uint8 (..., packed_dim), scale / zero: min / max over dim (kept) in x.dtype
+    qmax = 2 ** bits - 1
+    x_ = x.float()
+    zero = x_.amin(dim=dim, keepdim=True)
+    scale = (x_.amax(dim=dim, keepdim=True) - zero).clamp(min=1e-6) / qmax
+    # quantize against the stored (rounded) scale / zero
+    scale = scale.to(x.dtype)
+    zero = zero.to(x.dtype)
+    q = ((x_ - zero.float()) / scale.float()).round_().clamp_(0, qmax).to(torch.uint8)
+    if bits == 4:
+        q = q[..., 0::2] | (q[..., 1::2] << 4)
+    return q, scale, zero
+
+def dequantize_kv(q: torch.Tensor, scale: torch.Tensor, zero: torch.Tensor, bits: int, out: torch.Tensor=None):
+    # inverse of quantize_kv, written into out when given
+    if bits == 4:
+        q = torch.stack((q & 15, q >> 4), dim=-1).flatten(-2)
+    q = q.to(scale.dtype)
+    if out is None:
+        return torch.addcmul(zero, q, scale)
+    return torch.addcmul(zero, q, scale, out=out)
+
+def quantize_keys(x: torch.Tensor, bits: int):
+    # x: (..., tokens, heads, head_dim) from a group boundary --> q: uint8 (..., tokens, heads, packed_dim),
+    # scale / zero: (..., key_groups(tokens), heads, head_dim); the last group may be incomplete
+    tokens = x.shape[-3]
+    groups = key_groups(tokens)
+    if groups * KEY_GROUP > tokens:
+        # pad with the last token, min / max are unchanged
+        pad = x[..., -1:, :, :].expand(*x.shape[:-3], groups * KEY_GROUP - tokens, *x.shape[-2:])
+        x = torch.cat([x, pad], dim=-3)
+    q, scale, zero = quantize_kv(x.unflatten(-3, (groups, KEY_GROUP)), bits, dim=-3)
+    return q.flatten(-4, -3)[..., :tokens, :, :], scale.squeeze(-3), zero.squeeze(-3)
+
+def key_scales(t: torch.Tensor, start: int, end: int):
+    # per group scale / zero (..., groups from start // KEY_GROUP, heads, head_dim) --> per token [start, end)
+    first = start % KEY_GROUP
+    return t.repeat_interleave(KEY_GROUP, dim=-3)[..., first:first + end - start, :, :]
+
+def dequantize_keys(q: torch.Tensor, scale: torch.Tensor, zero: torch.Tensor, bits: int, start: int=0, out: torch.Tensor=None):
+    # q: tokens [start, start + n), scale / zero: their groups --> (..., n, heads, head_dim)
+    end = start + q.shape[-3]
+    return dequantize_kv(q, key_scales(scale, start, end), key_scales(zero, start, end), bits, out=out)
+
+class KeyTail:
+    """
+    Exact keys of the last, incomplete group of every layer. A write into that group requantizes the whole
+    group, from these keys rather than from their dequantized copy, so rounding errors do not pile up
+    over decoding steps. After a rollback into an earlier group or a reorder the dequantized keys are used.
+    """
+    def __init__(self, layers, num_heads, head_dim, dtype, device) -> None:
+        self.keys = torch.zeros([layers, 1, KEY_GROUP, num_heads, head_dim], dtype=dtype, device=device)
+        self.starts = [-1] * layers # first token of the group held per layer
+
+    def reset(self):
+        self.starts = [-1] * len(self.starts)
+
+    def group_keys(self, layer_idx, keys, start, end):
+        # keys: (1, >= end, heads, head_dim), exact in [start, end) --> first token of the group of start,
+        # keys [first, end) to quantize
+        first = start // KEY_GROUP * KEY_GROUP
+        x = keys[:, first:end]
+        if start > first and self.starts[layer_idx] == first:
+            x = torch.cat([self.keys[layer_idx][:, :start - first], keys[:, start:end]], dim=1)
+        last = end // KEY_GROUP * KEY_GROUP
+        self.keys[layer_idx][:, :end - last].copy_(x[:, last - first:])
+        self.starts[layer_idx] = last
+        return first, x
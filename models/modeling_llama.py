@@ -13,7 +13,7 @@ from transformers.models.llama.modeling_llama import(
 
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
-from flash_attn import flash_attn_with_kvcache
+from models.attention import attention_with_kvcache
 
 from .config_yarn import LlamaConfig
 from models.cache import Cache, RetrievalCache
@@ -229,6 +229,9 @@ class LlamaAttention(nn.Module):
             # update kv cache first
             key_states, value_states = kv_cache.update(key_states, value_states, layer_idx=self.layer_idx)
 
+            if isinstance(graph_cache, RetrievalCache) and query_states.shape[1] <= graph_cache.query_cache.shape[2]:
+                graph_cache.record_query(query_states, self.layer_idx)
+
             if query_states.shape[1] == 1 and (isinstance(graph_cache, RetrievalCache)): 
                 if graph_cache.init_graph == False:
                     # init graph cache
@@ -237,7 +240,11 @@ class LlamaAttention(nn.Module):
                     # update graph cache (customized)
                     graph_cache.update_graph_cache_retrieval(kv_cache, query_states, self.layer_idx)
 
-        attn_output = flash_attn_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float16)), causal=True)
+        if not spec and hasattr(kv_cache, 'cache_seqlens'):
+            # per-row lengths (batched cache) or pool blocks addressed through the block table (paged cache)
+            attn_output = attention_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, cache_seqlens=kv_cache.cache_seqlens, block_table=getattr(kv_cache, 'block_table', None), softmax_scale=1/torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float16)), causal=True)
+        else:
+            attn_output = attention_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float16)), causal=True)
 
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
         attn_output = self.o_proj(attn_output)
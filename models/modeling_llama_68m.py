@@ -16,7 +16,7 @@ from transformers.models.llama.modeling_llama import(
 
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
-from flash_attn import flash_attn_with_kvcache
+from models.attention import attention_with_kvcache
 
 from .config_yarn import LlamaConfig
 from models.cache import Cache
@@ -158,7 +158,7 @@ class LlamaAttention(nn.Module):
 
             position_ids = torch.arange(graph_cache.real_budget-graph_cache.gamma-1, graph_cache.real_budget-graph_cache.gamma+gamma_offset, device=position_ids.device).unsqueeze(0)
             query_states = apply_rotary_pos_emb_single(query_states, cos, sin, position_ids)
-            key_position_ids = torch.arange(kv_seq_len, device=position_ids.device).unsqueeze(0)
+            key_position_ids = graph_cache.key_position_ids[:, :kv_seq_len] # ring buffer slot -> position
             key_states = apply_rotary_pos_emb_single(key_states, cos, sin, key_position_ids)
         
         else: # prefill
@@ -183,7 +183,7 @@ class LlamaAttention(nn.Module):
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-        attn_output = flash_attn_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float16)), causal=True)
+        attn_output = attention_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float16)), causal=True)
 
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
         attn_output = self.o_proj(attn_output)
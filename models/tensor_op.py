@@ -1,7 +1,7 @@
 import torch
 import torch.nn.functional as F
 import math
-from flash_attn import flash_attn_with_kvcache
+from models.attention import attention_with_kvcache
 import torch.distributed as dist
 from typing import List, Optional, Tuple, Union
 
@@ -118,13 +118,45 @@ def Attention(
 
     return hidden_states
 
+# Row-parallel outputs (o_proj, down_proj) are summed over the ranks. Inputs longer than ALL_REDUCE_CHUNK tokens
+# (prefill slices) are computed and reduced chunk by chunk: every chunk is reduced asynchronously (nccl stream /
+# gloo worker thread) while the next one is computed, and all of them are waited for once at the end.
+# Decoding and verification (q_len <= ALL_REDUCE_CHUNK) keep a single all-reduce per call.
+ALL_REDUCE_CHUNK = 512
+
+def set_all_reduce_chunk(tokens: int):
+    global ALL_REDUCE_CHUNK
+    ALL_REDUCE_CHUNK = tokens
+
+def chunked_all_reduce(fn, hidden_states: torch.Tensor, chunk: int=None):
+    # fn: (bsz, tokens, ...) --> (bsz, tokens, h) partial sums of this rank, row-wise independent
+    chunk = chunk or ALL_REDUCE_CHUNK
+    q_len = hidden_states.shape[1]
+    if q_len <= chunk:
+        output = fn(hidden_states)
+        dist.all_reduce(output, dist.ReduceOp.SUM)
+        return output
+    outputs, works = [], []
+    for start in range(0, q_len, chunk):
+        output = fn(hidden_states[:, start:start + chunk]).contiguous()
+        works.append(dist.all_reduce(output, dist.ReduceOp.SUM, async_op=True))
+        outputs.append(output)
+    for work in works:
+        work.wait()
+    return torch.cat(outputs, dim=1)
+
+def linear_all_reduce(hidden_states: torch.Tensor, weight: torch.Tensor):
+    return chunked_all_reduce(lambda x: F.linear(x, weight), hidden_states)
+
+def qkv_proj(hidden_states: torch.Tensor, wqkv: torch.Tensor, q_size: int, kv_size: int):
+    # one GEMM against the stacked q / k / v shards, [bsz, q_len, q_size + 2 * kv_size] split into views
+    return F.linear(hidden_states, wqkv).split((q_size, kv_size, kv_size), dim=-1)
+
 def TP_Attention(
     hidden_states: torch.FloatTensor,
     position_ids: torch.LongTensor,
     layer_idx: int,
-    wq: torch.FloatTensor,
-    wk: torch.FloatTensor,
-    wv: torch.FloatTensor,
+    wqkv: torch.FloatTensor,
     wo: torch.FloatTensor,
     sin_cache: torch.FloatTensor,
     cos_cache: torch.FloatTensor,
@@ -136,13 +168,12 @@ def TP_Attention(
     head_dim: int,
     attention_mask: torch.FloatTensor=None,
     flash_attn: bool=True,
-    retrieval_cache=None
+    retrieval_cache=None,
+    query_cache=None
 ):
     bsz, q_len, _ = hidden_states.size()
 
-    query_states = F.linear(hidden_states, wq) #[bsz, q_len, h // tp]
-    key_states = F.linear(hidden_states, wk) #[bsz, q_len, h // tp]
-    value_states = F.linear(hidden_states, wv) #[bsz, q_len, h // tp]
+    query_states, key_states, value_states = qkv_proj(hidden_states, wqkv, local_num_heads * head_dim, local_num_key_value_heads * head_dim)
 
     query_states = query_states.view(bsz, q_len, local_num_heads, head_dim).transpose(1, 2)
     #[bsz, local_num_heads, q_len, head_dim]
@@ -161,22 +192,23 @@ def TP_Attention(
     if retrieval_cache is not None:
         retrieval_cache.init_graph_cache(kv_buffer, query_states, layer_idx)
 
+    # keep the queries of a verification for retrieval refresh
+    if query_cache is not None and q_len <= query_cache.shape[2]:
+        query_cache[layer_idx][:, :q_len] = query_states
+
     if attention_mask is None:
         if bsz > 1:
-            attn_output = flash_attn_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, cache_seqlens=kv_buffer.seq_len, softmax_scale=1/torch.sqrt(torch.tensor(head_dim, dtype=torch.float16)), causal=True)
+            attn_output = attention_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, cache_seqlens=kv_buffer.seq_len, softmax_scale=1/torch.sqrt(torch.tensor(head_dim, dtype=torch.float16)), causal=True)
         else:
-            attn_output = flash_attn_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(head_dim, dtype=torch.float16)), causal=True)
+            attn_output = attention_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(head_dim, dtype=torch.float16)), causal=True)
     else:
         with torch.backends.cuda.sdp_kernel(enable_math=False):
-            attn_output = F.scaled_dot_product_attention(query_states.transpose(1, 2),key_states.transpose(1, 2),value_states.transpose(1, 2), attn_mask=attention_mask.half())
+            attn_output = F.scaled_dot_product_attention(query_states.transpose(1, 2),key_states.transpose(1, 2),value_states.transpose(1, 2), attn_mask=attention_mask.to(query_states.dtype))
         attn_output = attn_output.transpose(1, 2).contiguous()
 
     attn_output = attn_output.reshape(bsz, q_len, local_num_heads * head_dim)
-    #[bsz, q_len, h // tp]
-    hidden_states = F.linear(attn_output, wo)
-
-    #[bsz, q_len, h]
-    dist.all_reduce(hidden_states, dist.ReduceOp.SUM)
+    #[bsz, q_len, h // tp] --> [bsz, q_len, h], summed over ranks
+    hidden_states = linear_all_reduce(attn_output, wo)
     
     return hidden_states
 
@@ -184,9 +216,7 @@ def TP_Attention_ssl(
     hidden_states: torch.FloatTensor,
     position_ids: torch.LongTensor,
     layer_idx: int,
-    wq: torch.FloatTensor,
-    wk: torch.FloatTensor,
-    wv: torch.FloatTensor,
+    wqkv: torch.FloatTensor,
     wo: torch.FloatTensor,
     sin_cache: torch.FloatTensor,
     cos_cache: torch.FloatTensor,
@@ -200,9 +230,7 @@ def TP_Attention_ssl(
     flash_attn: bool=True,
 ):
     bsz, q_len, _ = hidden_states.size()
-    query_states = F.linear(hidden_states, wq) #[bsz, q_len, h // tp]
-    key_states = F.linear(hidden_states, wk) #[bsz, q_len, h // tp]
-    value_states = F.linear(hidden_states, wv) #[bsz, q_len, h // tp]
+    query_states, key_states, value_states = qkv_proj(hidden_states, wqkv, local_num_heads * head_dim, local_num_key_value_heads * head_dim)
     query_states = query_states.view(bsz, q_len, local_num_heads, head_dim).transpose(1, 2)
     #[bsz, local_num_heads, q_len, head_dim]
     key_states = key_states.view(bsz, q_len, local_num_key_value_heads, head_dim).transpose(1, 2)
@@ -214,15 +242,12 @@ def TP_Attention_ssl(
     key_states = key_states.transpose(1, 2)
     key_states, value_states = kv_buffer.ssl_update(key_states, value_states, layer_idx)
     with torch.backends.cuda.sdp_kernel(enable_math=False):
-        attn_output = F.scaled_dot_product_attention(query_states.transpose(1, 2),key_states.transpose(1, 2),value_states.transpose(1, 2), attn_mask=attention_mask.half())
+        attn_output = F.scaled_dot_product_attention(query_states.transpose(1, 2),key_states.transpose(1, 2),value_states.transpose(1, 2), attn_mask=attention_mask.to(query_states.dtype))
         attn_output = attn_output.transpose(1, 2).contiguous()
 
     attn_output = attn_output.reshape(bsz, q_len, local_num_heads * head_dim)
-    #[bsz, q_len, h // tp]
-    hidden_states = F.linear(attn_output, wo)
-
-    #[bsz, q_len, h]
-    dist.all_reduce(hidden_states, dist.ReduceOp.SUM)
+    #[bsz, q_len, h // tp] --> [bsz, q_len, h], summed over ranks
+    hidden_states = linear_all_reduce(attn_output, wo)
     
     return hidden_states
 
@@ -231,9 +256,7 @@ def TP_Attention_Tree_Retrieval(
     hidden_states: torch.FloatTensor,
     position_ids: torch.LongTensor,
     layer_idx: int,
-    wq: torch.FloatTensor,
-    wk: torch.FloatTensor,
-    wv: torch.FloatTensor,
+    wqkv: torch.FloatTensor,
     wo: torch.FloatTensor,
     sin_cache: torch.FloatTensor,
     cos_cache: torch.FloatTensor,
@@ -249,9 +272,7 @@ def TP_Attention_Tree_Retrieval(
 ):
     bsz, q_len, _ = hidden_states.size()
 
-    query_states = F.linear(hidden_states, wq) #[bsz, q_len, h // tp]
-    key_states = F.linear(hidden_states, wk) #[bsz, q_len, h // tp]
-    value_states = F.linear(hidden_states, wv) #[bsz, q_len, h // tp]
+    query_states, key_states, value_states = qkv_proj(hidden_states, wqkv, local_num_heads * head_dim, local_num_key_value_heads * head_dim)
 
     query_states = query_states.view(bsz, q_len, local_num_heads, head_dim).transpose(1, 2)
     key_states = key_states.view(bsz, q_len, local_num_key_value_heads, head_dim).transpose(1, 2)
@@ -262,13 +283,11 @@ def TP_Attention_Tree_Retrieval(
     key_states = key_states.transpose(1, 2)
     key_states, value_states = retrieval_cache.update(key_states=key_states, value_states=value_states, layer_idx=layer_idx, storage_ids=storage_ids)
     with torch.backends.cuda.sdp_kernel(enable_math=False):
-        attn_output = F.scaled_dot_product_attention(query_states.transpose(1, 2), key_states.transpose(1, 2), value_states.transpose(1, 2), attn_mask=attention_mask.half())
+        attn_output = F.scaled_dot_product_attention(query_states.transpose(1, 2), key_states.transpose(1, 2), value_states.transpose(1, 2), attn_mask=attention_mask.to(query_states.dtype))
     attn_output = attn_output.transpose(1, 2).contiguous()
     attn_output = attn_output.reshape(bsz, q_len, local_num_heads * head_dim)
-    #[bsz, q_len, h // tp]
-    hidden_states = F.linear(attn_output, wo)
-    #[bsz, q_len, h]
-    dist.all_reduce(hidden_states, dist.ReduceOp.SUM)
+    #[bsz, q_len, h // tp] --> [bsz, q_len, h], summed over ranks
+    hidden_states = linear_all_reduce(attn_output, wo)
     return hidden_states
 
 
@@ -277,9 +296,7 @@ def TP_Attention_Retrieval(
     hidden_states: torch.FloatTensor,
     position_ids: torch.LongTensor,
     layer_idx: int,
-    wq: torch.FloatTensor,
-    wk: torch.FloatTensor,
-    wv: torch.FloatTensor,
+    wqkv: torch.FloatTensor,
     wo: torch.FloatTensor,
     sin_cache: torch.FloatTensor,
     cos_cache: torch.FloatTensor,
@@ -294,9 +311,7 @@ def TP_Attention_Retrieval(
 ):
     bsz, q_len, _ = hidden_states.size()
 
-    query_states = F.linear(hidden_states, wq) #[bsz, q_len, h // tp]
-    key_states = F.linear(hidden_states, wk) #[bsz, q_len, h // tp]
-    value_states = F.linear(hidden_states, wv) #[bsz, q_len, h // tp]
+    query_states, key_states, value_states = qkv_proj(hidden_states, wqkv, local_num_heads * head_dim, local_num_key_value_heads * head_dim)
 
     query_states = query_states.view(bsz, q_len, local_num_heads, head_dim).transpose(1, 2)
     key_states = key_states.view(bsz, q_len, local_num_key_value_heads, head_dim).transpose(1, 2)
@@ -312,49 +327,43 @@ def TP_Attention_Retrieval(
 
     key_states, value_states = retrieval_cache.update(key_states=key_states, value_states=value_states, layer_idx=layer_idx)
 
-    if flash_attn:
-        attn_output = flash_attn_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(head_dim, dtype=torch.float16)), causal=True)
-    else:
-        raise ValueError("Non-Flash-Attn Retrieval TP-Attention is not implemented yet")
+    # flash_attn: True uses the runtime attention backend (models/attention.py), False the portable sdpa one, or a backend name
+    backend = None if flash_attn is True else 'sdpa' if flash_attn is False else flash_attn
+    attn_output = attention_with_kvcache(q=query_states, k_cache=key_states, v_cache=value_states, softmax_scale=1/torch.sqrt(torch.tensor(head_dim, dtype=torch.float16)), causal=True, backend=backend)
 
     attn_output = attn_output.reshape(bsz, q_len, local_num_heads * head_dim)
 
-    #[bsz, q_len, h // tp]
-    hidden_states = F.linear(attn_output, wo)
-
-    #[bsz, q_len, h]
-    dist.all_reduce(hidden_states, dist.ReduceOp.SUM)
+    #[bsz, q_len, h // tp] --> [bsz, q_len, h], summed over ranks
+    hidden_states = linear_all_reduce(attn_output, wo)
     
     return hidden_states
 
 
+# parallel layouts of a DistributedLlama forward:
+#   tp:      attention heads and MLP sharded, two all-reduces per layer (o_proj and down_proj)
+#   attn_tp: attention heads sharded, every rank runs the whole MLP on the reduced hidden states, one all-reduce per
+#            layer for world_size x the MLP weights (and MLP weight reads), worth it when collectives dominate, e.g.
+#            the few-token retrieval forwards of TriForce over gloo or across nodes
+LAYOUTS = ("tp", "attn_tp")
+
 def MLP(
     hidden_states: torch.FloatTensor,
-    up_proj: torch.FloatTensor,
+    w_gate_up: torch.FloatTensor,
     down_proj: torch.FloatTensor,
-    gate_proj: torch.FloatTensor,
     ):
 
-    up = F.linear(hidden_states, up_proj)
-    gate = F.linear(hidden_states, gate_proj)
-    gate = F.silu(gate)
-    hidden_states = gate * up
+    # one GEMM for gate and up, [bsz, q_len, 2 * intermediate // tp] split into views
+    gate, up = F.linear(hidden_states, w_gate_up).chunk(2, dim=-1)
+    hidden_states = F.silu(gate) * up
     hidden_states = F.linear(hidden_states, down_proj)
 
     return hidden_states
 
 def TP_MLP(
     hidden_states: torch.FloatTensor,
-    up_proj: torch.FloatTensor,
+    w_gate_up: torch.FloatTensor,
     down_proj: torch.FloatTensor,
-    gate_proj: torch.FloatTensor,
     ):
 
-    up = F.linear(hidden_states, up_proj)
-    gate = F.linear(hidden_states, gate_proj)
-    gate = F.silu(gate)
-    hidden_states = gate * up
-    hidden_states = F.linear(hidden_states, down_proj)
-    
-    dist.all_reduce(hidden_states, dist.ReduceOp.SUM)
-    return hidden_states
\ No newline at end of file
+    # the all-reduce of a chunk of tokens overlaps the MLP of the next one
+    return chunked_all_reduce(lambda x: MLP(x, w_gate_up=w_gate_up, down_proj=down_proj), hidden_states)
\ No newline at end of file
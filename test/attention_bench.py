@@ -0,0 +1,69 @@
+# python test/attention_bench.py --kv_len 32768 --q_len 1 7 256 --device cpu
+# compares the attention backends of models/attention.py (flash / sdpa / chunked) on one layer of llama-7B shapes
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import time
+import torch
+import argparse
+from termcolor import colored
+from models.attention import attention_with_kvcache, set_attention_backend, BACKENDS, _flash_attn_with_kvcache
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for attention_bench.py')
+    parser.add_argument('--kv_len', type=int, default=32768, help='kv length')
+    parser.add_argument('--q_len', type=int, nargs='+', default=[1, 7, 256], help='queries per call (1: decode, gamma+1: verify, prefill chunk)')
+    parser.add_argument('--heads', type=int, default=32, help='query heads')
+    parser.add_argument('--kv_heads', type=int, default=32, help='kv heads')
+    parser.add_argument('--head_dim', type=int, default=128, help='head dim')
+    parser.add_argument('--q_block', type=int, default=None, help='query block of the chunked backend')
+    parser.add_argument('--kv_block', type=int, default=None, help='kv block of the chunked backend')
+    parser.add_argument('--max_scores', type=int, default=None, help='attention scores per sdpa call')
+    parser.add_argument('--iters', type=int, default=5, help='timed calls')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    parser.add_argument('--dtype', type=str, default=None, help='float16 / bfloat16 / float32, default float16 on cuda and float32 on cpu')
+    parser.add_argument('--seed', type=int, default=0, help='seed')
+    return parser.parse_args()
+
+def timeit(fn, iters, device):
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    t1 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t1) / iters * 1000
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device).type
+    dtype = getattr(torch, args.dtype) if args.dtype is not None else torch.float16 if device == 'cuda' else torch.float32
+    set_attention_backend(q_block=args.q_block, kv_block=args.kv_block, max_scores=args.max_scores)
+    backends = [b for b in BACKENDS if b != 'flash' or (_flash_attn_with_kvcache is not None and device == 'cuda')]
+
+    k_cache = torch.randn(1, args.kv_len, args.kv_heads, args.head_dim, device=args.device, dtype=dtype)
+    v_cache = torch.randn(1, args.kv_len, args.kv_heads, args.head_dim, device=args.device, dtype=dtype)
+    full = args.heads * args.kv_len * 4 / 1024**2
+    print(colored(f"[kv {args.kv_len}] {args.heads} heads / {args.kv_heads} kv heads x {args.head_dim}, {dtype}, backends {backends}", "green"))
+
+    with torch.inference_mode():
+        for q_len in args.q_len:
+            q = torch.randn(1, q_len, args.heads, args.head_dim, device=args.device, dtype=dtype)
+            outputs = {}
+            for backend in backends:
+                run = lambda: attention_with_kvcache(q, k_cache, v_cache, softmax_scale=args.head_dim ** -0.5, causal=True, backend=backend)
+                outputs[backend] = run().float()
+                ms = timeit(run, args.iters, device)
+                print(f"[q {q_len}] {backend:8s} {ms:9.3f} ms")
+            ref = outputs[backends[0]]
+            for backend in backends[1:]:
+                err = (outputs[backend] - ref).abs().max().item()
+                status = colored('OK', 'green') if err < (1e-2 if dtype != torch.float32 else 1e-4) else colored('MISMATCH', 'red')
+                print(f"[q {q_len}] max |{backend} - {backends[0]}| {err:.2e} {status}")
+            print(f"[q {q_len}] a full fp32 attention matrix would take {full * q_len:.1f} MB")
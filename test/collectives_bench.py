@@ -0,0 +1,100 @@
+# CUDA_VISIBLE_DEVICES=0,1 torchrun --nproc_per_node=2 test/collectives_bench.py --target llama-7B-128K --prefill 32768 --on_chip 32
+# OMP_NUM_THREADS=32 torchrun --nproc_per_node=2 test/collectives_bench.py --cpu --target llama-7B-128K --prefill 4096   (gloo)
+# compares the parallel layouts of DistributedLlama (see LAYOUTS in models/tensor_op.py) on the few-token forwards of TriForce:
+# collectives per forward / per token, latency per forward, and the logits drift against the 'tp' layout
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import time
+import torch
+import argparse
+import torch.distributed as dist
+from termcolor import colored
+from models.TP_llama import distributed_init, DistributedLlama
+from models.tensor_op import LAYOUTS
+from models.modeling_llama import LlamaForCausalLM
+from utils.profiler import CollectiveCounter
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for collectives_bench.py')
+    parser.add_argument('--target', type=str, default='llama-7B-128K', help='target model')
+    parser.add_argument('--prefill', type=int, default=32768, help='prefill length')
+    parser.add_argument('--budget', type=int, default=4096, help='retrieval budget')
+    parser.add_argument('--gamma', type=int, default=6, help='tokens per forward - 1')
+    parser.add_argument('--on_chip', type=int, default=32, help='on chip layers')
+    parser.add_argument('--forwards', type=str, nargs='+', default=['retrieval', 'verify'], help='forward types to compare')
+    parser.add_argument('--iters', type=int, default=10, help='timed forwards per layout')
+    parser.add_argument('--cpu', action='store_true', help='tensor parallel over cpu processes (gloo, bf16)')
+    parser.add_argument('--seed', type=int, default=1, help='seed')
+    return parser.parse_args()
+
+def sync(llm):
+    if llm.device.type == 'cuda':
+        torch.cuda.synchronize(llm.device)
+    dist.barrier()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    local_rank, world_size = distributed_init("gloo" if args.cpu else "nccl")
+    device = torch.device("cpu") if args.cpu else torch.device("cuda", local_rank)
+    dtype = torch.bfloat16 if args.cpu else torch.float16
+    torch.manual_seed(args.seed)
+
+    if args.target == 'llama-13B-128K':
+        model_name_or_path = "NousResearch/Yarn-Llama-2-13b-128k"
+    elif args.target == 'llama-7B-128K':
+        model_name_or_path = "NousResearch/Yarn-Llama-2-7b-128k"
+    elif args.target == 'lwm-128K':
+        model_name_or_path = "LargeWorldModel/LWM-Text-Chat-128K"
+    else:
+        model_name_or_path = args.target
+
+    # replicate the MLP for the compared forwards, the layout is switched per run below
+    llm = DistributedLlama(model_name_or_path=model_name_or_path, local_rank=local_rank, world_size=world_size, prefill=args.prefill, gen_len=args.gamma + 64, retrieval_budget=args.budget, kv_offload=True, on_chip_layers=args.on_chip, gamma=args.gamma, dtype=dtype, device=device, layouts={forward: 'attn_tp' for forward in args.forwards})
+    for rank in range(world_size):
+        if local_rank == rank:
+            hf_model = LlamaForCausalLM.from_pretrained(model_name_or_path, torch_dtype=dtype, device_map='cpu')
+            llm.init_parameters(hf_model=hf_model)
+            del hf_model
+        dist.barrier()
+
+    # the same prompt on every rank
+    input_ids = torch.randint(0, llm.vocab_size, (1, args.prefill + 1), generator=torch.Generator().manual_seed(args.seed)).to(device)
+    llm.prefill(input_ids=input_ids[:, :-1])
+    llm.build_retrieval_cache(input_ids=input_ids[:, -1:])
+    seq_len = llm.kv_cache.seq_len
+    tokens = torch.randint(0, llm.vocab_size, (1, args.gamma + 1), generator=torch.Generator().manual_seed(args.seed + 1)).to(device)
+    position_ids = torch.arange(seq_len, seq_len + args.gamma + 1, device=device).unsqueeze(0)
+
+    def forward(kind):
+        if kind == 'retrieval':
+            return llm.retrieval_inference(tokens, position_ids)
+        logits = llm.inference(input_ids=tokens)
+        llm.kv_cache.seq_len = seq_len # verification is rolled back, every iteration writes the same slots
+        return logits
+
+    counter = CollectiveCounter()
+    if local_rank == 0:
+        print(colored(f"[{args.target}] world size {world_size}, {dtype}, {llm.num_layers} layers, {args.gamma + 1} tokens per forward, prefill {args.prefill}", "green"))
+    for kind in args.forwards:
+        reference = None
+        for layout in LAYOUTS:
+            llm.layouts[kind] = layout
+            logits = forward(kind) # warmup
+            sync(llm)
+            counter.reset()
+            t1 = time.perf_counter()
+            for _ in range(args.iters):
+                logits = forward(kind)
+            sync(llm)
+            ms = (time.perf_counter() - t1) / args.iters * 1000
+            calls = counter.total(names=('all_reduce', 'broadcast', 'all_gather', 'all_gather_into_tensor', 'reduce_scatter_tensor')) / args.iters
+            reference = logits if reference is None else reference
+            drift = (logits - reference).abs().max().item()
+            if local_rank == 0:
+                print(f"[{kind:9s}] {layout:8s} {calls:6.1f} collectives / forward {calls / (args.gamma + 1):6.2f} / token {counter.bytes / args.iters / 1024**2:8.3f} MB / forward {ms:9.3f} ms | max |logits - tp| {drift:.2e}")
+
+    dist.destroy_process_group()
@@ -0,0 +1,85 @@
+# python test/kv_quant.py --seq_len 8192 --heads 32 --head_dim 128
+# CPU check of the int8 / int4 offloaded kv (models/kv_quant.py) against the fp16 path: fails when the attention output
+# drifts from fp16 by more than --tol8 / --tol4 (relative), or when keys written a few tokens at a time (KeyTail)
+# differ from keys quantized at once
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import torch
+import argparse
+from termcolor import colored
+from models.kv_quant import KEY_GROUP, KeyTail, packed_dim, key_groups, quantize_kv, dequantize_kv, quantize_keys, dequantize_keys
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for kv_quant.py')
+    parser.add_argument('--seq_len', type=int, default=8192, help='cached tokens')
+    parser.add_argument('--heads', type=int, default=32, help='kv heads')
+    parser.add_argument('--head_dim', type=int, default=128, help='head dim')
+    parser.add_argument('--queries', type=int, default=8, help='query tokens')
+    parser.add_argument('--tol8', type=float, default=0.02, help='max relative attention output error of int8')
+    parser.add_argument('--tol4', type=float, default=0.2, help='max relative attention output error of int4')
+    parser.add_argument('--seed', type=int, default=0, help='seed')
+    return parser.parse_args()
+
+def attention(q, k, v):
+    # (1, n, heads, head_dim) in float32, queries attend to the whole cache
+    q, k, v = [x.float().transpose(1, 2) for x in (q, k, v)]
+    scores = q @ k.transpose(-1, -2) / q.shape[-1] ** 0.5
+    return (scores.softmax(dim=-1) @ v).transpose(1, 2)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    torch.manual_seed(args.seed)
+
+    shape = (1, args.seq_len, args.heads, args.head_dim)
+    # keys with a few outlier channels, as after rope in llama
+    key = torch.randn(shape) * (1 + 4 * (torch.rand(args.head_dim) < 0.05))
+    key = key.half()
+    value = torch.randn(shape).half()
+    query = torch.randn(1, args.queries, args.heads, args.head_dim).half()
+    reference = attention(query, key, value)
+
+    fp16_bytes = 2 * key.numel() * key.element_size()
+    failed = False
+    for bits, tol in ((8, args.tol8), (4, args.tol4)):
+        k_q, k_scale, k_zero = quantize_keys(key, bits)
+        v_q, v_scale, v_zero = quantize_kv(value, bits)
+        assert k_q.shape[-1] == packed_dim(args.head_dim, bits) and k_scale.shape[-3] == key_groups(args.seq_len)
+
+        # dequantize into a preallocated fp16 buffer, as DistributedKVCacheBuffer.copy_kv does
+        key_ = torch.empty_like(key)
+        value_ = torch.empty_like(value)
+        dequantize_keys(k_q, k_scale, k_zero, bits, out=key_)
+        dequantize_kv(v_q, v_scale, v_zero, bits, out=value_)
+
+        # rounding error is at most half a step of every group-channel / token-head
+        for x, x_, step in ((key, key_, k_scale.float().repeat_interleave(KEY_GROUP, dim=1)[:, :args.seq_len]), (value, value_, v_scale.float())):
+            assert ((x_.float() - x.float()).abs() <= 0.5 * step + 1e-2 * x.float().abs() + 1e-3).all(), bits
+
+        # decoding: a prefill then a few tokens per write, every write requantizes the group it continues
+        tail = KeyTail(1, args.heads, args.head_dim, key.dtype, key.device)
+        inc_q, inc_scale = torch.zeros_like(k_q), torch.zeros_like(k_scale)
+        start = args.seq_len - 3 * KEY_GROUP - 5
+        prev = 0
+        for end in [start] + list(range(start + 7, args.seq_len, 7)) + [args.seq_len]:
+            first, keys = tail.group_keys(0, key, prev, end)
+            q, scale, _ = quantize_keys(keys, bits)
+            inc_q[:, first:end] = q
+            inc_scale[:, first // KEY_GROUP:key_groups(end)] = scale
+            prev = end
+        incremental = torch.equal(inc_q, k_q) and torch.equal(inc_scale, k_scale)
+
+        output = attention(query, key_, value_)
+        err = ((output - reference).norm() / reference.norm()).item()
+        ok = err <= tol and incremental
+        failed |= not ok
+        q_bytes = k_q.numel() + v_q.numel() + (k_scale.numel() + k_zero.numel() + v_scale.numel() + v_zero.numel()) * k_scale.element_size()
+        print(colored(f"[int{bits}] bytes per layer: {q_bytes / fp16_bytes:.3f}x of fp16 ({fp16_bytes / q_bytes:.2f}x less pcie traffic)", "green"))
+        print(f"[int{bits}] key abs err: max {(key_.float() - key.float()).abs().max():.4f}, mean {(key_.float() - key.float()).abs().mean():.5f} | value abs err: max {(value_.float() - value.float()).abs().max():.4f}, mean {(value_.float() - value.float()).abs().mean():.5f}")
+        print(f"[int{bits}] attention output abs err: max {(output - reference).abs().max():.5f}, mean {(output - reference).abs().mean():.6f} (output mean abs {reference.abs().mean():.4f})")
+        print(colored(f"[int{bits}] attention output relative err {err:.4f} (tolerance {tol}), incremental key writes match: {incremental}", "green" if ok else "red"))
+
+    sys.exit(1 if failed else 0)
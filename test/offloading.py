@@ -17,6 +17,9 @@ from models.cache import OffloadingFlashSimpleCache, StreamingLLMEvictionCache,
 from utils.decoding import TriForce, Autoregressive
 from utils.misc import print_config
 from utils.graph_infer import GraphInferenceEngine
+from utils.retrieval_policy import RetrievalRefreshPolicy
+from utils.profiler import Profiler
+from utils.gamma_controller import GammaController
 
 import argparse
 def parse_arguments():
@@ -36,6 +39,12 @@ def parse_arguments():
     parser.add_argument('--budget', type=int, default=8192, help='budget')
     parser.add_argument('--draft_cache_budget', type=int, default=256, help='draft cache budget')
     parser.add_argument('--chunk_size', type=int, default=8, help='chunk size')
+    parser.add_argument('--kv_bits', type=int, default=None, choices=[4, 8], help='store the offloaded kv as int8 / int4 (int4 is experimental, see test/kv_quant.py)')
+    parser.add_argument('--refresh_every', type=int, default=None, help='re-select retrieval chunks every N tokens')
+    parser.add_argument('--refresh_acc', type=float, default=None, help='re-select retrieval chunks when middle acceptance falls below this')
+    parser.add_argument('--gammas', type=str, default=None, help='comma separated speculation lengths (<= gamma) chosen per round by the gamma controller')
+    parser.add_argument('--confidence', type=float, default=None, help='end a middle speculation chain early when the draft probability of its sample falls below this')
+    parser.add_argument('--profile', type=str, default=None, help='profile the decoding hot path, writes PATH.json and PATH.trace.json')
     args = parser.parse_args()
     
     return args
@@ -82,12 +91,16 @@ if __name__ == "__main__":
     draft_cache_budget = args.draft_cache_budget
     recent_size = draft_cache_budget - 16 - gamma
 
-    cache = OffloadingFlashSimpleCache(target, prefill+gen_len+32)
+    cache = OffloadingFlashSimpleCache(target, prefill+gen_len+32, chunk_size=chunk_size, kv_bits=args.kv_bits)
     graph_cache = RetrievalCache(target, max_budget=max_budget, prefill=prefill, gamma=gamma, chunk_size=chunk_size)
     draft_cache = StreamingLLMEvictionCache(draft, start_size=16, recent_size=recent_size, gamma=gamma)
 
     graph_engine = GraphInferenceEngine(target, cache, graph_cache, draft, draft_cache)
-    graph_engine.initialize_cuda_graph(gamma, probs=True, temperature=temperature, top_p=top_p)
+    gammas = [int(g) for g in args.gammas.split(',')] if args.gammas is not None else None
+    graph_engine.initialize_cuda_graph(gamma, probs=True, temperature=temperature, top_p=top_p, gammas=gammas)
+    gamma_controller = GammaController(gammas + [gamma], gamma=gamma, verbose=verbose) if gammas is not None else None
+    refresh_policy = RetrievalRefreshPolicy(every=args.refresh_every, acc_threshold=args.refresh_acc, verbose=verbose)
+    profiler = Profiler(device=target.device) if args.profile is not None else None
 
     cache.print_status()
     graph_cache.print_status()
@@ -120,11 +133,15 @@ if __name__ == "__main__":
     for input_ids in tqdm(tokenized_prompts, desc="TriForce Test"):
         input_ids = input_ids.to(target.device)[:,:prefill]
 
-        acceptance_rate, speed = TriForce(tokenizer, graph_engine, input_ids, gamma=gamma, max_len=gen_len, top_k=top_k, top_p=top_p, temperature=temperature, verbose=verbose, file_path=None, dataset=args.dataset, spec_args={'budget': args.budget, 'draft': args.draft, 'chunk_size': chunk_size, 'gamma': gamma, 'temperature': temperature, 'top_p': top_p})
+        acceptance_rate, speed = TriForce(tokenizer, graph_engine, input_ids, gamma=gamma, max_len=gen_len, top_k=top_k, top_p=top_p, temperature=temperature, verbose=verbose, file_path=None, dataset=args.dataset, spec_args={'budget': args.budget, 'draft': args.draft, 'chunk_size': chunk_size, 'gamma': gamma, 'temperature': temperature, 'top_p': top_p}, refresh_policy=refresh_policy, profiler=profiler, gamma_controller=gamma_controller, confidence=args.confidence)
         all_acceptance_rate.append(acceptance_rate)
         all_speed.append(speed)
 
     method_latency = 1000/(sum(all_speed) / len(all_speed))
     print(colored(f"average acceptance rate (NOT per token): {sum(all_acceptance_rate) / len(all_acceptance_rate)}", "red"))
     print(colored(f"[TriForce] average latency: {method_latency} ms", "red"))
+    if profiler is not None:
+        profiler.print_summary()
+        profiler.to_json(f"{args.profile}.json")
+        profiler.to_chrome_trace(f"{args.profile}.trace.json")
     # print(colored(f"[E2E Speedup]: {baseline_latency / method_latency}", "red"))
\ No newline at end of file
@@ -1,4 +1,5 @@
 # CUDA_VISIBLE_DEVICES=8,9 OMP_NUM_THREADS=48 torchrun --nproc_per_node=2 test/offloading_TP.py --budget 12288 --prefill 130048 --dataset demo --llama-7B-128K --on_chip 9 --seed 1 2>/dev/null
+# OMP_NUM_THREADS=32 torchrun --nproc_per_node=2 test/offloading_TP.py --cpu --budget 4096 --prefill 32768 --target llama-7B-128K   (gloo, e.g. one process per socket)
 
 import os
 import sys
@@ -15,14 +16,14 @@ from models.TP_llama import distributed_init, DistributedLlama
 from models.modeling_llama import LlamaForCausalLM
 from models.modeling_llama_68m import LlamaForCausalLM as LlamaForCausalLM_68M
 from models.cache import StreamingLLMEvictionCache
+from utils.prefix_store import PrefixKVStore
+from utils.retrieval_policy import RetrievalRefreshPolicy
+from utils.profiler import Profiler
 from transformers import AutoTokenizer
 import numpy as np
 import time
 from tqdm import tqdm
 
-local_rank, world_size = distributed_init()
-device = torch.device("cuda", local_rank)
-
 def parse_arguments():
     parser = argparse.ArgumentParser(description='args for main.py')
 
@@ -38,12 +39,29 @@ def parse_arguments():
     parser.add_argument('--baseline', action='store_true', help='baseline')
     parser.add_argument('--file', type=str, default='')
     parser.add_argument('--seed', type=int, default=1, help='seed')
+    parser.add_argument('--sync_free', action='store_true', help='all ranks sample from a generator seeded with --seed, one broadcast per round')
     parser.add_argument('--gamma', type=str, default=6)
+    parser.add_argument('--refresh_every', type=int, default=None, help='re-select retrieval chunks every N tokens')
+    parser.add_argument('--refresh_acc', type=float, default=None, help='re-select retrieval chunks when middle acceptance falls below this')
+    parser.add_argument('--kv_bits', type=int, default=None, choices=[4, 8], help='store the offloaded kv as int8 / int4 (int4 is experimental, see test/kv_quant.py)')
+    parser.add_argument('--prefix_store', type=str, default=None, help='directory of the prefix kv store, reuses the kv of repeated prompt prefixes')
+    parser.add_argument('--prefix_store_gb', type=float, default=64, help='disk budget of the prefix kv store per rank (GB)')
+    parser.add_argument('--prefetch_depth', type=int, default=2, help='on-chip buffers of the offloaded kv pipeline')
+    parser.add_argument('--gpu_budget', type=float, default=None, help='device memory per rank (GB), layer weights beyond it are streamed from the host')
+    parser.add_argument('--weight_buffers', type=int, default=2, help='rotating device buffers of the streamed layer weights')
+    parser.add_argument('--pipeline_stats', action='store_true', help='report per layer copy / compute overlap of the offloaded kv')
+    parser.add_argument('--profile', type=str, default=None, help='profile the decoding hot path of rank 0, writes PATH.json and PATH.trace.json')
+    parser.add_argument('--cpu', action='store_true', help='tensor parallel over cpu processes (gloo, bf16), all kv in host memory')
+    parser.add_argument('--retrieval_layout', type=str, default='tp', choices=['tp', 'attn_tp'], help='parallel layout of the retrieval forwards, attn_tp: one all-reduce per layer, replicated MLP')
+    parser.add_argument('--verify_layout', type=str, default='tp', choices=['tp', 'attn_tp'], help='parallel layout of the target verification forwards')
     args = parser.parse_args()
     
     return args
 
 args = parse_arguments()
+local_rank, world_size = distributed_init("gloo" if args.cpu else "nccl")
+device = torch.device("cpu") if args.cpu else torch.device("cuda", local_rank)
+dtype = torch.bfloat16 if args.cpu else torch.float16
 torch.manual_seed(args.seed)
 prefill = args.prefill
 gen_len = args.gen_len
@@ -72,35 +90,49 @@ input_ids = tokenized_prompts[0][:,:prefill].to(device)
 
 
 if args.baseline:
-    llm = DistributedLlama(model_name_or_path=model_name_or_path, local_rank=local_rank, world_size=world_size, prefill=prefill, gen_len=gen_len, temperature=temperature, top_p=top_p, flash_attn=True, retrieval_budget=0, kv_offload=True, on_chip_layers=args.on_chip)
+    llm = DistributedLlama(model_name_or_path=model_name_or_path, local_rank=local_rank, world_size=world_size, prefill=prefill, gen_len=gen_len, temperature=temperature, top_p=top_p, flash_attn=True, retrieval_budget=0, kv_offload=True, on_chip_layers=args.on_chip, kv_bits=args.kv_bits, prefetch_depth=args.prefetch_depth, gpu_budget=args.gpu_budget, weight_buffers=args.weight_buffers, dtype=dtype, device=device)
     for rank in range(world_size):
         if local_rank == rank:
-            hf_model = LlamaForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float16, device_map='cpu')
+            hf_model = LlamaForCausalLM.from_pretrained(model_name_or_path, torch_dtype=dtype, device_map='cpu')
             llm.init_parameters(hf_model=hf_model)
             del hf_model
         dist.barrier()
-    baseline_latency, gen_tokens = Baseline_Dist(tokenizer, llm, input_ids, max_len=gen_len, temperature=temperature, top_p=top_p, local_rank=local_rank)
+    if llm.prefetcher is not None:
+        llm.prefetcher.record_stats = args.pipeline_stats
+    baseline_latency, gen_tokens = Baseline_Dist(tokenizer, llm, input_ids, max_len=gen_len, temperature=temperature, top_p=top_p, local_rank=local_rank, seed=args.seed if args.sync_free else None)
     baseline_latency = baseline_latency/1000
     if local_rank == 0:
         print(colored(f"\n[Autoregressive] average latency: {baseline_latency} s", "red"))
+        if args.pipeline_stats and llm.prefetcher is not None:
+            llm.prefetcher.print_report()
     dist.barrier()
 
 else:
     gamma = int(args.gamma)
-    draft = LlamaForCausalLM_68M.from_pretrained("JackFram/llama-68m", torch_dtype=torch.float16, device_map=device)
+    draft = LlamaForCausalLM_68M.from_pretrained("JackFram/llama-68m", torch_dtype=dtype, device_map=device)
     draft = draft.eval()
     draft_cache_budget = 256
     recent_size = draft_cache_budget - 16 - gamma
     draft_cache = StreamingLLMEvictionCache(draft, start_size=16, recent_size=recent_size, gamma=gamma)
 
-    llm = DistributedLlama(model_name_or_path=model_name_or_path, local_rank=local_rank, world_size=world_size, prefill=prefill, gen_len=gen_len, temperature=temperature, top_p=top_p, flash_attn=True, retrieval_budget=retrieval_budget, kv_offload=True, on_chip_layers=args.on_chip, draft=draft, draft_cache=draft_cache, gamma=gamma)
+    # refreshing keeps chunk summaries of all layers on chip
+    refresh = args.refresh_every is not None or args.refresh_acc is not None
+    refresh_policy = RetrievalRefreshPolicy(every=args.refresh_every, acc_threshold=args.refresh_acc, verbose=args.verbose and local_rank == 0) if refresh else None
+
+    llm = DistributedLlama(model_name_or_path=model_name_or_path, local_rank=local_rank, world_size=world_size, prefill=prefill, gen_len=gen_len, temperature=temperature, top_p=top_p, flash_attn=True, retrieval_budget=retrieval_budget, kv_offload=True, on_chip_layers=args.on_chip, kv_bits=args.kv_bits, prefetch_depth=args.prefetch_depth, gpu_budget=args.gpu_budget, weight_buffers=args.weight_buffers, retrieval_refresh=refresh, draft=draft, draft_cache=draft_cache, gamma=gamma, dtype=dtype, device=device, layouts={'retrieval': args.retrieval_layout, 'verify': args.verify_layout})
     for rank in range(world_size):
         if local_rank == rank:
-            hf_model = LlamaForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float16, device_map='cpu')
+            hf_model = LlamaForCausalLM.from_pretrained(model_name_or_path, torch_dtype=dtype, device_map='cpu')
             llm.init_parameters(hf_model=hf_model)
             del hf_model
         dist.barrier()
 
+    # every rank keeps its own shard of heads
+    prefix_store = PrefixKVStore(args.prefix_store, max_bytes=int(args.prefix_store_gb * 1024**3), namespace=f"{args.target}-on_chip{args.on_chip}-rank{local_rank}of{world_size}") if args.prefix_store is not None else None
+    if llm.prefetcher is not None:
+        llm.prefetcher.record_stats = args.pipeline_stats
+    profiler = Profiler(device=llm.device) if args.profile is not None and local_rank == 0 else None
+
     ######## TriForce ########
     all_avg_tokens = []
     all_latency = []
@@ -108,7 +140,7 @@ else:
     for input_ids in tqdm(tokenized_prompts, desc="TriForce Test"):
         input_ids = input_ids[:,:args.prefill].to(llm.device)
 
-        avg_tokens, latency = TriForce_Dist(tokenizer, llm, input_ids, gamma=gamma, max_len=gen_len, top_k=-1, top_p=top_p, temperature=temperature, verbose=False, file_path=None, dataset=args.dataset)
+        avg_tokens, latency = TriForce_Dist(tokenizer, llm, input_ids, gamma=gamma, max_len=gen_len, top_k=-1, top_p=top_p, temperature=temperature, verbose=False, file_path=None, dataset=args.dataset, prefix_store=prefix_store, refresh_policy=refresh_policy, profiler=profiler, seed=args.seed if args.sync_free else None)
         all_avg_tokens.append(avg_tokens)
         all_latency.append(latency)
         if local_rank == 0:
@@ -117,6 +149,12 @@ else:
     if local_rank == 0:
         print(f"[Overall Latency]: {np.array(all_latency).mean()}")
         print(f"[Overall Avg Accepted Tokens]: {np.array(all_avg_tokens).mean()}")
+        if args.pipeline_stats and llm.prefetcher is not None:
+            llm.prefetcher.print_report()
+        if profiler is not None:
+            profiler.print_summary()
+            profiler.to_json(f"{args.profile}.json")
+            profiler.to_chrome_trace(f"{args.profile}.trace.json")
 
     # destory the distributed process
     dist.destroy_process_group()
\ No newline at end of file
@@ -17,6 +17,7 @@ import numpy as np
 import time
 from torch.nn.functional import softmax
 from utils.SpecTree_TP import SpecTree
+from utils.misc import IncrementalDetokenizer
 
 local_rank, world_size = distributed_init()
 device = torch.device("cuda", local_rank)
@@ -53,6 +54,7 @@ def parse_arguments():
     parser.add_argument('--baseline', action='store_true', help='baseline')
     parser.add_argument('--file', type=str, default='')
     parser.add_argument('--seed', type=int, default=1, help='seed')
+    parser.add_argument('--sync_free', action='store_true', help='all ranks sample from a generator seeded with --seed, one broadcast per round')
     parser.add_argument('--tree_size', type=str, default='512')
     args = parser.parse_args()
     
@@ -101,7 +103,7 @@ if args.baseline:
             llm.init_parameters(hf_model=hf_model)
             del hf_model
         dist.barrier()
-    baseline_latency, gen_tokens = Baseline_Dist(tokenizer, llm, input_ids, max_len=gen_len, temperature=temperature, top_p=top_p, local_rank=local_rank)
+    baseline_latency, gen_tokens = Baseline_Dist(tokenizer, llm, input_ids, max_len=gen_len, temperature=temperature, top_p=top_p, local_rank=local_rank, seed=args.seed if args.sync_free else None)
     baseline_latency = baseline_latency/1000
     if local_rank == 0:
         print(colored(f"\n[Autoregressive] average latency: {baseline_latency} s", "red"))
@@ -143,19 +145,19 @@ else:
                         residual_graph=residual_graph,
                         sampling_callables=sampling_callables,
                         sample_gather_indices=sample_gather_indices,
-                        tokenizer=tokenizer, vocab_size=llm.config.vocab_size)
+                        tokenizer=tokenizer, vocab_size=llm.config.vocab_size, seed=args.seed if args.sync_free else None)
 
     for input_ids in tokenized_prompts:
         input_ids = input_ids[0,:args.prefill].to(llm.device)
 
         with torch.inference_mode():
             n=0
-            pos = 0
-            generated_ids = []
+            detokenizer = IncrementalDetokenizer(tokenizer) if local_rank == 0 else None
             
             next_token = spectree.prefill(prefix=input_ids)
             acc_count_list = []
-            generated_ids.extend(next_token[0].tolist())
+            if detokenizer is not None:
+                print(detokenizer.push(next_token[0].tolist()), end="", flush=True)
 
             time1 = time.time()
             while n < gen_len:
@@ -165,32 +167,16 @@ else:
                 if next_token is None:
                     break
                 
-                generated_ids.extend(print_tokens[1:].tolist())
-                
-                generated_text = (
-                    tokenizer.decode(
-                    generated_ids,
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=True,
-                    spaces_between_special_tokens=False,
-                )
-                .strip()
-                .split(" ")
-                )
-
-                if local_rank == 0:
-                    now = len(generated_text) - 1
-                    if now > pos:
-                        print(" ".join(generated_text[pos:now]), end=" ", flush=True)
-                        pos = now
+                if detokenizer is not None:
+                    print(detokenizer.push(print_tokens[1:].tolist()), end="", flush=True)
 
                 if next_token is None:
                     break
                 next_token = next_token.unsqueeze(0)
                 n += acc_count
                 acc_count_list.append(acc_count)
-            if local_rank == 0:
-                print(" ".join(generated_text[pos:]), flush=True)
+            if detokenizer is not None:
+                print(detokenizer.flush(), flush=True)
             if n < 64:
                 continue
             torch.cuda.synchronize()
@@ -12,10 +12,17 @@ from tqdm import tqdm
 from data.dataset import get_dataset
 from models.modeling_llama import LlamaForCausalLM
 from models.modeling_llama_68m import LlamaForCausalLM as LlamaForCausalLM_68M
-from models.cache import FlashSimpleCache, StreamingLLMEvictionCache, RetrievalCache
+from models.cache import FlashSimpleCache, StreamingLLMEvictionCache, RetrievalCache, KVBlockPool, PagedFlashSimpleCache
 from utils.decoding import Autoregressive, TriForce
 from utils.misc import print_config
 from utils.graph_infer import GraphInferenceEngine
+from utils.retrieval_policy import RetrievalRefreshPolicy
+from utils.prefix_store import PrefixKVStore
+from utils.profiler import Profiler
+from utils.gamma_controller import GammaController
+from utils.streaming import triforce_stream
+from models.attention import set_attention_backend, get_attention_backend
+import asyncio
 
 import argparse
 def parse_arguments():
@@ -35,6 +42,18 @@ def parse_arguments():
     parser.add_argument('--budget', type=int, default=4096)
     parser.add_argument('--draft_cache_budget', type=int, default=256, help='draft cache budget')
     parser.add_argument('--chunk_size', type=int, default=8, help='chunk size')
+    parser.add_argument('--paged', action='store_true', help='store the target cache in a paged block pool')
+    parser.add_argument('--block_size', type=int, default=256, help='tokens per kv block of the paged cache')
+    parser.add_argument('--refresh_every', type=int, default=None, help='re-select retrieval chunks every N tokens')
+    parser.add_argument('--refresh_acc', type=float, default=None, help='re-select retrieval chunks when middle acceptance falls below this')
+    parser.add_argument('--prefix_store', type=str, default=None, help='directory of the prefix kv store, reuses the kv of repeated prompt prefixes')
+    parser.add_argument('--prefix_store_gb', type=float, default=64, help='disk budget of the prefix kv store (GB)')
+    parser.add_argument('--gammas', type=str, default=None, help='comma separated speculation lengths (<= gamma) chosen per round by the gamma controller')
+    parser.add_argument('--confidence', type=float, default=None, help='end a middle speculation chain early when the draft probability of its sample falls below this')
+    parser.add_argument('--profile', type=str, default=None, help='profile the decoding hot path, writes PATH.json and PATH.trace.json')
+    parser.add_argument('--stream', action='store_true', help='stream one generation through triforce_stream and report ttft / inter-token latency')
+    parser.add_argument('--device', type=str, default='cuda:0', help='device, cpu runs eagerly in bfloat16')
+    parser.add_argument('--attn', type=str, default=None, choices=['auto', 'flash', 'sdpa', 'chunked'], help='attention backend (models/attention.py), default TRIFORCE_ATTN or auto')
     args = parser.parse_args()
     
     return args
@@ -42,15 +61,20 @@ def parse_arguments():
 if __name__ == "__main__":
 
     args = parse_arguments()
+    if args.attn is not None:
+        set_attention_backend(args.attn)
+    on_cpu = torch.device(args.device).type == 'cpu'
+    dtype = torch.bfloat16 if on_cpu else torch.float16
+    print(colored(f"attention backend: {get_attention_backend(args.device)}", "green"))
 
     ######## model initialization ########
     if args.target == 'llama-7B-128K':
-        target = LlamaForCausalLM.from_pretrained("NousResearch/Yarn-Llama-2-7b-128k", torch_dtype=torch.float16, device_map="cuda:0")
+        target = LlamaForCausalLM.from_pretrained("NousResearch/Yarn-Llama-2-7b-128k", torch_dtype=dtype, device_map=args.device)
     else:
         raise NotImplementedError
     target = target.eval()
 
-    draft = LlamaForCausalLM_68M.from_pretrained("JackFram/llama-68m", torch_dtype=torch.float16, device_map="cuda:0")
+    draft = LlamaForCausalLM_68M.from_pretrained("JackFram/llama-68m", torch_dtype=dtype, device_map=args.device)
     draft = draft.eval()
 
     tokenizer = AutoTokenizer.from_pretrained("NousResearch/Yarn-Llama-2-7b-128k", use_fast=True, legacy=False)
@@ -75,12 +99,24 @@ if __name__ == "__main__":
 
     draft_cache_budget = args.draft_cache_budget
     recent_size = draft_cache_budget - 16 - gamma
-    cache = FlashSimpleCache(target, prefill+gen_len+16)
+    if args.paged:
+        pool = KVBlockPool.from_budget(target, prefill+gen_len+16, block_size=args.block_size, chunk_size=chunk_size)
+        cache = PagedFlashSimpleCache(target, pool, max_budget=prefill+gen_len+16)
+    else:
+        cache = FlashSimpleCache(target, prefill+gen_len+16, chunk_size=chunk_size)
     graph_cache = RetrievalCache(target, max_budget=max_budget, prefill=prefill, gamma=gamma, chunk_size=chunk_size)
     draft_cache = StreamingLLMEvictionCache(draft, start_size=16, recent_size=recent_size, gamma=gamma)
 
     graph_engine = GraphInferenceEngine(target, cache, graph_cache, draft, draft_cache)
-    graph_engine.initialize_cuda_graph(gamma, probs=True, temperature=temperature, top_p=top_p)
+    gammas = [int(g) for g in args.gammas.split(',')] if args.gammas is not None else None
+    if on_cpu:
+        graph_engine.initialize_eager(gamma, probs=True, temperature=temperature, top_p=top_p, gammas=gammas)
+    else:
+        graph_engine.initialize_cuda_graph(gamma, probs=True, temperature=temperature, top_p=top_p, gammas=gammas)
+    gamma_controller = GammaController(gammas + [gamma], gamma=gamma, verbose=verbose) if gammas is not None else None
+    prefix_store = PrefixKVStore(args.prefix_store, max_bytes=int(args.prefix_store_gb * 1024**3), namespace=args.target) if args.prefix_store is not None else None
+    refresh_policy = RetrievalRefreshPolicy(every=args.refresh_every, acc_threshold=args.refresh_acc, verbose=verbose)
+    profiler = Profiler(device=target.device) if args.profile is not None else None
 
     cache.print_status()
     graph_cache.print_status()
@@ -114,11 +150,24 @@ if __name__ == "__main__":
     for input_ids in tqdm(tokenized_prompts, desc="TriForce Test"):
         input_ids = input_ids.to(target.device)[:,:prefill]
 
-        acceptance_rate, speed = TriForce(tokenizer, graph_engine, input_ids, gamma=gamma, max_len=gen_len, top_k=top_k, top_p=top_p, temperature=temperature, verbose=verbose, file_path=None, dataset=args.dataset, spec_args={'budget': args.budget, 'draft': args.draft, 'chunk_size': chunk_size, 'gamma': gamma, 'temperature': temperature, 'top_p': top_p, 'baseline': baseline_latency/1000})
+        acceptance_rate, speed = TriForce(tokenizer, graph_engine, input_ids, gamma=gamma, max_len=gen_len, top_k=top_k, top_p=top_p, temperature=temperature, verbose=verbose, file_path=None, dataset=args.dataset, spec_args={'budget': args.budget, 'draft': args.draft, 'chunk_size': chunk_size, 'gamma': gamma, 'temperature': temperature, 'top_p': top_p, 'baseline': baseline_latency/1000}, refresh_policy=refresh_policy, prefix_store=prefix_store, profiler=profiler, gamma_controller=gamma_controller, confidence=args.confidence)
         all_acceptance_rate.append(acceptance_rate)
         all_speed.append(speed)
 
     method_latency = 1000/(sum(all_speed) / len(all_speed))
     print(colored(f"average acceptance rate (NOT per token): {sum(all_acceptance_rate) / len(all_acceptance_rate)}", "red"))
     print(colored(f"[TriForce] average latency: {method_latency} ms", "red"))
-    print(colored(f"[E2E Speedup]: {baseline_latency / method_latency}", "red"))
\ No newline at end of file
+    print(colored(f"[E2E Speedup]: {baseline_latency / method_latency}", "red"))
+    if profiler is not None:
+        profiler.print_summary()
+        profiler.to_json(f"{args.profile}.json")
+        profiler.to_chrome_trace(f"{args.profile}.trace.json")
+
+    if args.stream:
+        async def stream_one(input_ids):
+            async for chunk in triforce_stream(tokenizer, graph_engine, input_ids, gamma=gamma, max_len=gen_len, top_k=top_k, top_p=top_p, temperature=temperature, gamma_controller=gamma_controller, confidence=args.confidence):
+                print(chunk["text"], end="", flush=True)
+            return chunk["metrics"]
+
+        metrics = asyncio.run(stream_one(tokenized_prompts[0].to(target.device)[:,:prefill]))
+        print(colored(f"\n[Stream] ttft {1000 * metrics['ttft']:.1f} ms, inter-token latency mean {1000 * metrics['itl_mean']:.2f} ms, p50 {1000 * metrics['itl_p50']:.2f} ms, p99 {1000 * metrics['itl_p99']:.2f} ms, {metrics['tokens']} tokens", "red"))
@@ -0,0 +1,86 @@
+# python test/paged_cache.py
+# CPU check of the paged target cache (PagedFlashSimpleCache): tiny random models, several generations in a row on
+# one engine (the retrieval cache is only reset, not rebuilt, between them) must match the flat cache token for token,
+# and empty logical ranges read as empty, like slicing
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import types
+import torch
+import argparse
+from termcolor import colored
+from models.config_yarn import LlamaConfig
+from models.modeling_llama import LlamaForCausalLM
+from models.modeling_llama_68m import LlamaForCausalLM as LlamaForCausalLM_68M
+from models.cache import FlashSimpleCache, PagedFlashSimpleCache, KVBlockPool, RetrievalCache, StreamingLLMEvictionCache
+from utils.graph_infer import GraphInferenceEngine
+from utils.decoding import TriForce
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for paged_cache.py')
+    parser.add_argument('--prefill', type=int, default=296, help='prefill length')
+    parser.add_argument('--gen_len', type=int, default=32, help='generation length')
+    parser.add_argument('--gamma', type=int, default=3, help='gamma')
+    parser.add_argument('--budget', type=int, default=64, help='retrieval budget')
+    parser.add_argument('--chunk_size', type=int, default=8, help='chunk size')
+    parser.add_argument('--block_size', type=int, default=64, help='kv block size')
+    parser.add_argument('--runs', type=int, default=3, help='generations per engine')
+    return parser.parse_args()
+
+def engine(target, draft, args, paged):
+    max_budget = args.prefill + args.gen_len + 32
+    if paged:
+        pool = KVBlockPool.from_budget(target, max_budget, block_size=args.block_size, chunk_size=args.chunk_size)
+        cache = PagedFlashSimpleCache(target, pool, max_budget)
+    else:
+        cache = FlashSimpleCache(target, max_budget, chunk_size=args.chunk_size)
+    graph_cache = RetrievalCache(target, max_budget=args.budget, prefill=args.prefill, chunk_size=args.chunk_size, gamma=args.gamma)
+    draft_cache = StreamingLLMEvictionCache(draft, start_size=4, recent_size=100, gamma=args.gamma)
+    graph_engine = GraphInferenceEngine(target, cache, graph_cache, draft, draft_cache)
+    graph_engine.initialize_eager(args.gamma, probs=True, temperature=1.0, top_p=1.0)
+    return graph_engine
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    failed = False
+
+    def check(name, ok):
+        global failed
+        failed |= not ok
+        print(f"[{name}] {colored('OK', 'green') if ok else colored('FAIL', 'red')}")
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=4096)
+    target = LlamaForCausalLM(config).eval()
+    draft = LlamaForCausalLM_68M(config).eval()
+    for model in (target, draft):
+        for p in model.parameters():
+            p.data.normal_(0, 0.3)
+    # no eos in the random vocab, every run generates gen_len tokens
+    tokenizer = types.SimpleNamespace(eos_token_id=config.vocab_size, decode=lambda ids, **kwargs: str(ids))
+
+    flat = engine(target, draft, args, paged=False)
+    paged = engine(target, draft, args, paged=True)
+
+    # the retrieval tail after a prefill of prefill - 1 tokens starts past the end of the cache
+    paged.prefill(torch.randint(0, 120, (1, args.prefill - 1)))
+    key, value = paged.engine.kv_cache.read_range(args.prefill, args.prefill - 1, 0)
+    check("empty range", key.shape[1] == 0 and value.shape[1] == 0)
+
+    for run in range(args.runs):
+        input_ids = torch.randint(0, 120, (1, args.prefill))
+        outputs = []
+        for graph_engine in (flat, paged):
+            ids = []
+            torch.manual_seed(run)
+            try:
+                TriForce(tokenizer, graph_engine, input_ids, gamma=args.gamma, max_len=args.gen_len, top_p=1.0, temperature=1.0, on_tokens=lambda committed, eos: ids.extend(committed))
+            except RuntimeError as e:
+                print(colored(f"run {run}: {e}", "red"))
+            outputs.append(ids)
+        check(f"run {run} matches the flat cache", len(outputs[0]) > 0 and outputs[0] == outputs[1])
+
+    sys.exit(1 if failed else 0)
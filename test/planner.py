@@ -0,0 +1,95 @@
+# python test/planner.py
+# CPU check of the cost model and the grid search of utils/planner.py on a synthetic 7B-like target with synthetic
+# Timings and acceptance tables: memory limits, the direction latency moves with on_chip / budget / PCIe bandwidth,
+# the costs of small chunks and the draft kv, and the optimum of a small grid
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import types
+import argparse
+import itertools
+from termcolor import colored
+from utils.planner import GB, HardwareSpec, Timings, AcceptanceModel, CostModel, search, grid_edges
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for planner.py')
+    parser.add_argument('--prefill', type=int, default=32768, help='prefill length')
+    parser.add_argument('--world_size', type=int, default=2, help='tensor parallel ranks')
+    parser.add_argument('--device_gb', type=float, default=16, help='device memory per rank (GB)')
+    return parser.parse_args()
+
+def target_config(world_size):
+    return types.SimpleNamespace(world_size=world_size, hidden_size=4096, intermediate_size=11008, num_attention_heads=32,
+        num_key_value_heads=32, num_hidden_layers=32, vocab_size=32000)
+
+# 1 ms draft steps, retrieval verifies of 10 / 11 ms, 3 ms of compute per target layer
+TIMINGS = {"draft_step": 1e-3, "retrieval_step": {1024: 10e-3, 2048: 11e-3}, "target_layer": 3e-3}
+# only chunk 8 gains from the larger budget (chunk 4 reads the chunk 8 row, the nearest one)
+ACCEPTANCE = {8: {1024: 0.5, 2048: 0.9}, 16: {1024: 0.5, 2048: 0.5}}
+
+def cost_model(args, device_gb=None, pcie_gbps=20, acceptance=ACCEPTANCE, draft_table=None, world_size=None, **kwargs):
+    hardware = HardwareSpec(device_memory=(device_gb or args.device_gb) * GB, pcie_bandwidth=pcie_gbps * 1e9)
+    return CostModel(target_config(world_size or args.world_size), args.prefill, hardware=hardware, timings=Timings(**TIMINGS),
+        acceptance=AcceptanceModel(retrieval_table=acceptance, draft_table=draft_table), **kwargs)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    failed = False
+
+    def check(name, ok):
+        global failed
+        failed |= not ok
+        print(f"[{name}] {colored('OK', 'green') if ok else colored('FAIL', 'red')}")
+
+    model = cost_model(args)
+
+    # fits() is exactly the device / host limit of memory()
+    device, host = model.memory(8, 2048, 6, 256, 8)
+    cap = device / (1 - model.hw.reserve) / GB
+    check("fits at the device limit", cost_model(args, device_gb=cap).fits(8, 2048, 6, 256, 8))
+    check("fits over the device limit", not cost_model(args, device_gb=cap * 0.999).fits(8, 2048, 6, 256, 8))
+    small_host = cost_model(args)
+    small_host.hw.host_memory = host * 0.999
+    check("fits over the host limit", not small_host.fits(8, 2048, 6, 256, 8) and model.fits(8, 2048, 6, 256, 8))
+    check("fits agrees with memory", all(model.fits(n, 2048, 6, 256, 8) == (model.memory(n, 2048, 6, 256, 8)[0] <= (1 - model.hw.reserve) * model.hw.device_memory) for n in range(33)))
+
+    # latency: every layer on chip saves its PCIe copy, a larger budget costs retrieval time at the same acceptance,
+    # a faster PCIe link shortens the offloaded layers
+    latency = [model.evaluate(n, 2048, 6, 8, 256)["latency"] for n in range(33)]
+    check("latency falls with on_chip", all(a > b for a, b in zip(latency, latency[1:])))
+    flat = cost_model(args, acceptance={8: {1024: 0.8, 2048: 0.8}})
+    check("latency rises with budget at equal acceptance", flat.evaluate(16, 1024, 6, 8, 256)["latency"] < flat.evaluate(16, 2048, 6, 8, 256)["latency"])
+    check("latency falls with acceptance of the budget", model.evaluate(16, 1024, 6, 8, 256)["latency"] > model.evaluate(16, 2048, 6, 8, 256)["latency"])
+    pcie = [cost_model(args, pcie_gbps=g).evaluate(16, 2048, 6, 8, 256)["latency"] for g in (10, 20, 40)]
+    check("latency falls with PCIe bandwidth", pcie[0] > pcie[1] > pcie[2])
+    check("no PCIe cost all on chip", cost_model(args, pcie_gbps=10).evaluate(32, 2048, 6, 8, 256)["latency"] == cost_model(args, pcie_gbps=40).evaluate(32, 2048, 6, 8, 256)["latency"])
+
+    # small chunks cost summaries and top-k time, more so with refresh
+    refresh = cost_model(args, refresh_every=1)
+    check("small chunks cost selection time", model.selection_time(4) > model.selection_time(8) > model.selection_time(16))
+    check("small chunks cost summary memory", refresh.memory(16, 2048, 6, 256, 4)[0] > refresh.memory(16, 2048, 6, 256, 8)[0] > model.memory(16, 2048, 6, 256, 8)[0])
+    check("refresh costs latency", refresh.evaluate(16, 2048, 6, 8, 256)["latency"] > model.evaluate(16, 2048, 6, 8, 256)["latency"])
+
+    # the draft kv is sized from the draft and replicated, the same on every rank whatever the world size
+    for ws in (1, 2, 4):
+        m = cost_model(args, world_size=ws, draft_hidden=768, draft_layers=2)
+        grow = m.memory(16, 2048, 6, 512, 8)[0] - m.memory(16, 2048, 6, 256, 8)[0]
+        check(f"draft kv bytes, world size {ws}", grow == 2 * 256 * 2 * 768 * 2)
+
+    # search: the optimum of a small grid, against every on_chip of every configuration
+    grid = {"budgets": (1024, 2048), "gammas": (2, 3, 4), "chunk_sizes": (4, 8, 16)}
+    results = search(model, top=200, **grid)
+    best = results[0]
+    brute = min((model.evaluate(n, b, g, c, 256) for b, g, c, n in itertools.product(grid["budgets"], grid["gammas"], grid["chunk_sizes"], range(33)) if model.fits(n, b, g, 256, c)), key=lambda r: r["latency"])
+    print(f"[search] best --on_chip {best['on_chip']} --budget {best['budget']} --gamma {best['gamma']} --chunk_size {best['chunk_size']} {1000 * best['latency']:.2f} ms/token")
+    check("search finds the optimum", best == brute)
+    check("search finds the known optimum", (best["budget"], best["gamma"], best["chunk_size"]) == (2048, 4, 8) and best["on_chip"] == max(n for n in range(33) if model.fits(n, 2048, 4, 256, 8)))
+    check("grid edges", grid_edges(best, budget=grid["budgets"], gamma=grid["gammas"], chunk_size=grid["chunk_sizes"]) == ["budget", "gamma"])
+    check("draft budget fixed without a draft table", {r["draft_cache_budget"] for r in results} == {256})
+    drafted = cost_model(args, draft_table={128: 0.6, 512: 0.8})
+    check("draft budget searched with a draft table", {r["draft_cache_budget"] for r in search(drafted, top=200, **grid)} == {128, 512})
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,107 @@
+# python test/sampling_bench.py --rows 1 17 128 --vocab 32000 --device cuda
+# micro-benchmark of the sort-free top-p (utils/sampling.py: norm_logits, norm_sample) against the sort-based top_k_top_p_filter;
+# the kept sets must match a float64 sort of the same probabilities, for flat (scale 1) and peaked logits, or the script fails
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import time
+import torch
+import itertools
+import argparse
+from torch.nn import functional as F
+from termcolor import colored
+from utils.sampling import top_k_top_p_filter, norm_logits, norm_sample, sample
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for sampling_bench.py')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1, 17, 128], help='rows per call (1: draft step, gamma+1: verify, tree size)')
+    parser.add_argument('--vocab', type=int, default=32000, help='vocab size')
+    parser.add_argument('--temp', type=float, default=0.6, help='temperature')
+    parser.add_argument('--top_p', type=float, default=0.9, help='top_p')
+    parser.add_argument('--scale', type=float, nargs='+', default=[1.0, 4.0], help='std of the random logits (1: flat, nucleus of ~1/3 of the vocab)')
+    parser.add_argument('--iters', type=int, default=100, help='timed calls')
+    parser.add_argument('--samples', type=int, default=20000, help='draws for the sampling check')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    parser.add_argument('--graph', action='store_true', help='also time both paths captured in a CUDA graph')
+    parser.add_argument('--seed', type=int, default=0, help='seed')
+    return parser.parse_args()
+
+def reference(logits, temperature, top_p):
+    return F.softmax(top_k_top_p_filter(logits / temperature, top_k=-1, top_p=top_p), dim=-1)
+
+def exact_reference(logits, temperature, top_p):
+    # the same float32 probabilities as norm_logits, the nucleus cut on a float64 cumulative sum; tokens tied with
+    # the last one kept are kept as well ({probs >= t}, see top_p_threshold)
+    probs = F.softmax(logits.float() / temperature, dim=-1)
+    sorted_probs, sorted_indices = probs.double().sort(dim=-1, descending=True)
+    kept = (sorted_probs.cumsum(-1) - sorted_probs < top_p).sum(-1, keepdim=True)
+    probs = probs * (probs >= sorted_probs.gather(-1, kept - 1).float())
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+def timeit(fn, iters, device):
+    for _ in range(3):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    t1 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t1) / iters * 1000
+
+def graphed(fn):
+    # capture fn once, replays reuse the static input / output
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(3):
+            fn()
+    torch.cuda.current_stream().wait_stream(stream)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        fn()
+    return graph.replay
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    torch.manual_seed(args.seed)
+    device = args.device
+
+    failed = False
+    for scale, rows in itertools.product(args.scale, args.rows):
+        logits = torch.randn(rows, args.vocab, device=device) * scale
+        name = f"scale {scale:g}, rows {rows}"
+
+        # the float32 sort differs by a few tokens on flat rows (rounding of its cumulative sum, ties at the cut), it is only reported
+        ref = exact_reference(logits, args.temp, args.top_p)
+        new = norm_logits(logits, temperature=args.temp, top_k=-1, top_p=args.top_p)
+        kept_diff = ((ref > 0) != (new > 0)).sum().item()
+        sort_diff = ((reference(logits, args.temp, args.top_p) > 0) != (new > 0)).sum().item()
+        max_err = (ref - new).abs().max().item()
+        ok = kept_diff == 0 and max_err < 1e-5
+        failed |= not ok
+        status = colored('OK', 'green') if ok else colored('MISMATCH', 'red')
+        print(f"[{name}] nucleus size {(ref > 0).sum(-1).float().mean().item():.0f}, kept set diff {kept_diff} (float32 sort: {sort_diff}), max |p - p_ref| {max_err:.2e} {status}")
+
+        t_ref = timeit(lambda: sample(reference(logits, args.temp, args.top_p)), args.iters, device)
+        t_new = timeit(lambda: norm_sample(logits, temperature=args.temp, top_k=-1, top_p=args.top_p), args.iters, device)
+        print(f"[{name}] sort + multinomial {t_ref:.3f} ms, sort-free + race {t_new:.3f} ms, speedup {t_ref / t_new:.2f}x")
+
+        if args.graph and device == 'cuda':
+            t_ref = timeit(graphed(lambda: reference(logits, args.temp, args.top_p)), args.iters, device)
+            t_new = timeit(graphed(lambda: norm_sample(logits, temperature=args.temp, top_k=-1, top_p=args.top_p)), args.iters, device)
+            print(f"[{name}] CUDA graph: sort {t_ref:.3f} ms, sort-free + race {t_new:.3f} ms, speedup {t_ref / t_new:.2f}x")
+
+    # the race sampler draws from the filtered distribution
+    logits = torch.randn(1, 64, device=device) * 2
+    probs = norm_logits(logits, temperature=args.temp, top_k=-1, top_p=args.top_p)
+    draws = norm_sample(logits.expand(args.samples, -1), temperature=args.temp, top_k=-1, top_p=args.top_p)[1]
+    freq = torch.bincount(draws.flatten(), minlength=64).float() / args.samples
+    tv = 0.5 * (freq - probs[0].float()).abs().sum().item()
+    print(f"[sampling] total variation of {args.samples} draws vs probs {tv:.4f}, outside the nucleus {(freq[probs[0] == 0]).sum().item():.4f}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,104 @@
+# CUDA_VISIBLE_DEVICES=0 python test/serve.py --max_context 131072 --budget 4096 --gamma 6 --port 8000
+# python test/serve.py --tiny --unix /tmp/triforce.sock   (random tiny models on CPU, try it with test/serve_client.py,
+# whose default 200 character prompt / max_len 64 fit the tiny defaults --max_context 1024 --budget 128)
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import torch
+import argparse
+from termcolor import colored
+from models.modeling_llama import LlamaForCausalLM
+from models.modeling_llama_68m import LlamaForCausalLM as LlamaForCausalLM_68M
+from models.config_yarn import LlamaConfig
+from models.cache import FlashSimpleCache, StreamingLLMEvictionCache, RetrievalCache
+from utils.graph_infer import GraphInferenceEngine
+from utils.server import TriForceServer, KVAdmission
+from models.attention import set_attention_backend, get_attention_backend
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for serve.py')
+    parser.add_argument('--target', type=str, default='llama-7B-128K', help='target model')
+    parser.add_argument('--tiny', action='store_true', help='random-weight tiny target / draft and a byte tokenizer, runs on CPU')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='http host')
+    parser.add_argument('--port', type=int, default=8000, help='http port')
+    parser.add_argument('--unix', type=str, default=None, help='serve on this unix socket instead of http')
+    parser.add_argument('--max_context', type=int, default=None, help='target kv cache size, prompt + max_len + gamma + 2 must fit (default 32768, 1024 with --tiny)')
+    parser.add_argument('--gen_len', type=int, default=256, help='default max_len of a request')
+    parser.add_argument('--gamma', type=int, default=6, help='gamma')
+    parser.add_argument('--temp', type=float, default=0.6, help='temperature')
+    parser.add_argument('--top_p', type=float, default=0.9, help='top p')
+    parser.add_argument('--budget', type=int, default=None, help='retrieval budget, below the prompt and above its tail + max_len + gamma + 2 (default 4096, 128 with --tiny)')
+    parser.add_argument('--draft_cache_budget', type=int, default=256, help='draft cache budget')
+    parser.add_argument('--chunk_size', type=int, default=8, help='chunk size')
+    parser.add_argument('--max_queue', type=int, default=16, help='requests waiting for the engine')
+    parser.add_argument('--max_queued_tokens', type=int, default=None, help='kv tokens of the waiting requests')
+    parser.add_argument('--eager', action='store_true', help='no cuda graphs (always on CPU)')
+    parser.add_argument('--attn', type=str, default=None, choices=['auto', 'flash', 'sdpa', 'chunked'], help='attention backend (models/attention.py), default TRIFORCE_ATTN or auto')
+    parser.add_argument('--verbose', action='store_true', help='verbose')
+    args = parser.parse_args()
+    if args.max_context is None:
+        args.max_context = 1024 if args.tiny else 32768
+    if args.budget is None:
+        args.budget = 128 if args.tiny else 4096
+    return args
+
+class ByteTokenizer:
+    # utf-8 bytes shifted by 3 (0 pad, 1 bos, 2 eos), for the tiny models
+    eos_token_id = 2
+    vocab_size = 259
+
+    def encode(self, text):
+        return [1] + [b + 3 for b in text.encode("utf-8")]
+
+    def decode(self, ids, skip_special_tokens=True, **kwargs):
+        return bytes(i - 3 for i in ids if i >= 3).decode("utf-8", errors="replace")
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.attn is not None:
+        set_attention_backend(args.attn)
+
+    if args.tiny:
+        device = "cuda:0" if torch.cuda.is_available() and not args.eager else "cpu"
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=ByteTokenizer.vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=args.max_context)
+        target = LlamaForCausalLM(config).to(device)
+        draft = LlamaForCausalLM_68M(config).to(device)
+        tokenizer = ByteTokenizer()
+    else:
+        from transformers import AutoTokenizer
+        device = "cuda:0"
+        if args.target == 'llama-7B-128K':
+            target = LlamaForCausalLM.from_pretrained("NousResearch/Yarn-Llama-2-7b-128k", torch_dtype=torch.float16, device_map=device)
+        else:
+            raise NotImplementedError
+        draft = LlamaForCausalLM_68M.from_pretrained("JackFram/llama-68m", torch_dtype=torch.float16, device_map=device)
+        tokenizer = AutoTokenizer.from_pretrained("NousResearch/Yarn-Llama-2-7b-128k", use_fast=True, legacy=False)
+    target = target.eval()
+    draft = draft.eval()
+
+    ####### cache init #######
+    gamma = args.gamma
+    recent_size = args.draft_cache_budget - 16 - gamma
+    cache = FlashSimpleCache(target, args.max_context, chunk_size=args.chunk_size)
+    # prefill is set per request (prompt rounded down to chunk_size)
+    graph_cache = RetrievalCache(target, max_budget=args.budget, prefill=args.max_context // args.chunk_size * args.chunk_size, gamma=gamma, chunk_size=args.chunk_size)
+    draft_cache = StreamingLLMEvictionCache(draft, start_size=16, recent_size=recent_size, gamma=gamma)
+
+    graph_engine = GraphInferenceEngine(target, cache, graph_cache, draft, draft_cache)
+    if device == "cpu" or args.eager:
+        graph_engine.initialize_eager(gamma, probs=True, temperature=args.temp, top_p=args.top_p)
+    else:
+        graph_engine.initialize_cuda_graph(gamma, probs=True, temperature=args.temp, top_p=args.top_p)
+
+    cache.print_status()
+    graph_cache.print_status()
+    draft_cache.print_status()
+
+    admission = KVAdmission.from_cache(cache, gamma, max_queue=args.max_queue, max_queued_tokens=args.max_queued_tokens)
+    server = TriForceServer(tokenizer, graph_engine, gamma=gamma, temperature=args.temp, top_p=args.top_p, max_len=args.gen_len, admission=admission, verbose=args.verbose)
+    print(colored(f"[TriForce Server] target {args.target if not args.tiny else 'tiny'} on {device}, {get_attention_backend(device)} attention, kv {admission.status()['kv_gb']:.2f} GB ({admission.capacity_tokens} tokens)", "green"), flush=True)
+    server.run(host=args.host, port=args.port, unix_path=args.unix)
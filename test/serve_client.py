@@ -0,0 +1,59 @@
+# python test/serve_client.py --address unix:/tmp/triforce.sock --requests 4
+# python test/serve_client.py --address http://127.0.0.1:8000 --prompt "..." --max_len 256
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import argparse
+import random
+import threading
+from termcolor import colored
+from utils.server import generate, health
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for serve_client.py')
+    parser.add_argument('--address', type=str, default='http://127.0.0.1:8000', help='http://host:port or unix:/path')
+    parser.add_argument('--prompt', type=str, default=None, help='prompt, random text of --prompt_len characters by default')
+    parser.add_argument('--prompt_len', type=int, default=200, help='length of the random prompt')
+    parser.add_argument('--max_len', type=int, default=64, help='tokens to generate')
+    parser.add_argument('--requests', type=int, default=1, help='concurrent requests, queued by the server')
+    parser.add_argument('--no_stream', action='store_true', help='one response per request instead of ndjson chunks')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random prompts')
+    return parser.parse_args()
+
+def run(idx, prompt, args, results):
+    text = ""
+    try:
+        for chunk in generate(args.address, prompt=prompt, max_len=args.max_len, stream=not args.no_stream):
+            text += chunk["text"]
+            if args.requests == 1 and not args.no_stream:
+                print(chunk["text"], end="", flush=True)
+        results[idx] = (text, chunk["metrics"])
+    except RuntimeError as e:
+        results[idx] = (None, str(e))
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    random.seed(args.seed)
+    print(colored(f"[Client] {args.address} {health(args.address)}", "green"))
+
+    prompts = [args.prompt or "".join(random.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(args.prompt_len)) for _ in range(args.requests)]
+    results = [None] * args.requests
+    threads = [threading.Thread(target=run, args=(i, prompts[i], args, results)) for i in range(args.requests)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print()
+    for i, (text, metrics) in enumerate(results):
+        if text is None:
+            print(colored(f"[{i}] refused: {metrics}", "red"))
+            continue
+        if args.requests > 1 or args.no_stream:
+            print(f"[{i}] {text!r}")
+        itl = f"{1000 * metrics['itl_mean']:.2f} ms" if metrics['itl_mean'] is not None else "-"
+        print(colored(f"[{i}] {metrics['tokens']} tokens, ttft {1000 * metrics['ttft']:.1f} ms, inter-token latency {itl}, {metrics['tokens_per_sec']:.1f} tokens/s", "red"))
+    print(colored(f"[Client] {health(args.address)}", "green"))
@@ -0,0 +1,89 @@
+# torchrun --nproc_per_node=2 test/sync_free_dist.py --model_dir /tmp/triforce_tiny
+# gloo / cpu check of the sync-free distributed decoding (seed=... of Baseline_Dist / TriForce_Dist): a tiny random
+# target and draft, every rank records its token stream, the streams must be identical across ranks. Also reports the
+# broadcasts and barriers per round against the default mode where rank 0 draws and broadcasts every sample.
+
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+import types
+import torch
+import argparse
+import torch.distributed as dist
+from termcolor import colored
+from models.TP_llama import distributed_init, DistributedLlama
+from models.modeling_llama import LlamaForCausalLM
+from models.modeling_llama_68m import LlamaForCausalLM as LlamaForCausalLM_68M
+from models.config_yarn import LlamaConfig
+from models.cache import StreamingLLMEvictionCache
+from utils.decoding import Baseline_Dist, TriForce_Dist
+from utils.profiler import Profiler, CollectiveCounter
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for sync_free_dist.py')
+    parser.add_argument('--model_dir', type=str, default='/tmp/triforce_tiny', help='where the tiny random target is saved')
+    parser.add_argument('--prefill', type=int, default=256, help='prefill length')
+    parser.add_argument('--gen_len', type=int, default=48, help='generation length')
+    parser.add_argument('--gamma', type=int, default=3, help='draft tokens per round')
+    parser.add_argument('--budget', type=int, default=64, help='retrieval budget')
+    parser.add_argument('--temp', type=float, default=1.0, help='temperature')
+    parser.add_argument('--top_p', type=float, default=1.0, help='top p')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the shared generator')
+    return parser.parse_args()
+
+def tiny_config():
+    return LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=4096)
+
+def random_init(model, seed):
+    torch.manual_seed(seed)
+    for p in model.parameters():
+        p.data.normal_(0, 0.3)
+    return model.eval()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    local_rank, world_size = distributed_init("gloo")
+    config = tiny_config()
+    if local_rank == 0 and not os.path.exists(os.path.join(args.model_dir, 'config.json')):
+        random_init(LlamaForCausalLM(config), 0).save_pretrained(args.model_dir)
+    dist.barrier()
+
+    draft = random_init(LlamaForCausalLM_68M(config), 1)
+    draft_cache = StreamingLLMEvictionCache(draft, start_size=4, recent_size=100, gamma=args.gamma)
+    llm = DistributedLlama(args.model_dir, dtype=torch.float32, kv_offload=True, local_rank=local_rank, world_size=world_size, prefill=args.prefill, gen_len=args.gen_len + args.gamma + 4, retrieval_budget=args.budget, gamma=args.gamma, temperature=args.temp, top_p=args.top_p, draft=draft, draft_cache=draft_cache, device='cpu')
+    llm.init_parameters(LlamaForCausalLM.from_pretrained(args.model_dir, torch_dtype=torch.float32).eval())
+
+    tokenizer = types.SimpleNamespace(eos_token_id=config.vocab_size - 1, decode=lambda ids, **kwargs: "")
+    input_ids = torch.randint(0, config.vocab_size - 1, (1, args.prefill + 1), generator=torch.Generator().manual_seed(args.seed))
+    counter = CollectiveCounter()
+    failed = False
+
+    for mode, seed in (("broadcast", None), ("sync-free", args.seed)):
+        # TriForce, rounds counted by the profiler
+        stream, profiler = [], Profiler()
+        torch.manual_seed(local_rank) # ranks disagree on everything but the shared stream
+        counter.reset()
+        TriForce_Dist(tokenizer, llm, input_ids, gamma=args.gamma, max_len=args.gen_len, top_p=args.top_p, temperature=args.temp, profiler=profiler, on_tokens=lambda ids, eos: stream.extend(ids), seed=seed)
+        rounds = profiler.counters.get("rounds", 1)
+        syncs = {name: counter.calls.get(name, 0) for name in ("broadcast", "barrier")}
+
+        # autoregressive
+        torch.manual_seed(local_rank)
+        counter.reset()
+        _, gen_tokens = Baseline_Dist(tokenizer, llm, input_ids[:, :-1], max_len=args.gamma + 1, temperature=args.temp, top_p=args.top_p, local_rank=-1, seed=seed)
+        baseline_syncs = counter.calls.get("broadcast", 0) + counter.calls.get("barrier", 0)
+
+        streams = [None] * world_size
+        dist.all_gather_object(streams, (stream, gen_tokens[0].tolist()))
+        same = all(s == streams[0] for s in streams)
+        failed |= not same
+        if local_rank == 0:
+            print(colored(f"[{mode}] TriForce {len(stream)} tokens in {rounds} rounds, {syncs['broadcast'] / rounds:.2f} broadcasts and {syncs['barrier'] / rounds:.2f} barriers per round | autoregressive {baseline_syncs / (args.gamma + 2):.2f} per token", "green"))
+            print(f"[{mode}] stream {stream[:24]}")
+            print(colored(f"[{mode}] identical token streams on {world_size} ranks: {same}", "green" if same else "red"))
+
+    counter.restore()
+    dist.destroy_process_group()
+    sys.exit(1 if failed else 0)
@@ -5,21 +5,10 @@ import time
 from utils.misc import print_config, spec_stream
 from utils.sampling import sample, norm_logits, max_fn
 
-def get_sampling_logits(logits :torch.Tensor, top_p:float, T: float, replicate = False):
-    if replicate:
-        logits = logits.clone()
-    if top_p < 1.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(
-        torch.nn.functional.softmax(sorted_logits / T, dim=-1), dim=-1)
-        filter = cumulative_probs > top_p
-        filter[..., 1:] = filter[..., :-1].clone()
-        filter[..., 0] = 0
-        indices_to_remove = filter.scatter(-1, sorted_indices, filter)
-        logits[indices_to_remove] = float('-inf')
-    return logits
-
-def sample_dist(probs):
+def sample_dist(probs, generator=None):
+    # with a generator shared by all ranks every rank draws the same token, no communication
+    if generator is not None:
+        return sample(probs, generator=generator)
     if torch.distributed.get_rank() == 0:
         next_token = sample(probs)
     else:
@@ -39,7 +28,8 @@ class SpecTree:
                  residual_graph = None,
                  sampling_callables = None,
                  sample_gather_indices = None,
-                 tokenizer=None) -> None:
+                 tokenizer=None,
+                 seed=None) -> None:
 
         self.graph_engine = engine
         self.temperature = temperature
@@ -48,6 +38,8 @@ class SpecTree:
         self.tokenizer = tokenizer
         self.device = engine.device
         self.dtype = torch.float16
+        # seed: sync-free mode, all ranks draw the tree, acceptance tests and samples from the same seeded stream
+        self.generator = torch.Generator(device=self.device).manual_seed(seed) if seed is not None else None
 
         # get world size
         self.world_size = torch.distributed.get_world_size()
@@ -91,12 +83,12 @@ class SpecTree:
     def prefill(self, prefix :torch.LongTensor):
         self.draft_logits.zero_()
         self.verify_tokens.zero_()
-        self.rand.uniform_()
+        self.rand.uniform_(generator=self.generator)
         ##### PREFILL #####
         self.graph_engine.reset()
         self.graph_engine.prefill(input_ids=prefix.unsqueeze(0)[:,:-1])
         logits = self.graph_engine.build_retrieval_cache(input_ids=prefix.unsqueeze(0)[:,-1:])
-        next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=self.temperature ,top_k=-1, top_p=self.top_p))
+        next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=self.temperature ,top_k=-1, top_p=self.top_p), self.generator)
         return next_token
 
     @torch.inference_mode()
@@ -155,7 +147,7 @@ class SpecTree:
         for pos in children:
             token = self.verify_tokens[pos]
             q = softmax(draft_logits / self.temperature, dim=-1)
-            r = torch.rand(1, device=self.graph_engine.device)
+            r = torch.rand(1, device=self.graph_engine.device, generator=self.generator)
             
             if p[token] > r * q[token]:
                 return (torch.tensor(pos, device=self.graph_engine.device), torch.empty((self.vocab_size), dtype=torch.float32, device=self.device))
@@ -171,8 +163,7 @@ class SpecTree:
 
         offset = self.graph_engine.kv_cache.seq_len
         self.target_logits = self.graph_engine.inference(input_ids = self.verify_tokens.unsqueeze(0), position_ids=position_ids, attention_mask=attn_mask)[0]
-        self.target_logits = get_sampling_logits(logits=self.target_logits, top_p=self.top_p, T=self.temperature, replicate=False)
-        self.target_logits = softmax(self.target_logits / self.temperature, dim=-1)
+        self.target_logits = norm_logits(self.target_logits, temperature=self.temperature, top_k=-1, top_p=self.top_p)
         
         acc_count = 0
         accept_list = []
@@ -199,29 +190,23 @@ class SpecTree:
             if torch.isnan(residual).any():
                 terminal = True
             else:
-                next_token = residual.multinomial(num_samples=1, replacement=True)
+                next_token = residual.multinomial(num_samples=1, replacement=True, generator=self.generator)
                 acc_count += 1
 
-        torch.distributed.barrier()
-        torch.distributed.broadcast(next_token, src=0)
-        torch.distributed.broadcast(self.verify_tokens, src=0)
-        torch.distributed.barrier()
-
-        acc_count = torch.tensor(acc_count, device=self.device)
-        torch.distributed.broadcast(acc_count, src=0)
-        torch.distributed.barrier()
-        acc_count = acc_count.cpu().item()
-
-        fake_ac_list = torch.full((24,), -1, dtype=torch.long, device=self.device)
-        fake_ac_list[:len(accept_list)] = torch.tensor(accept_list, device=self.device, dtype=torch.long)
-        torch.distributed.broadcast(fake_ac_list, src=0)
-        torch.distributed.barrier()
-        accept_list = fake_ac_list.cpu().numpy().tolist()[:acc_count]
-
-        terminal = torch.tensor(terminal, device=self.device)
-        torch.distributed.broadcast(terminal, src=0)
-        torch.distributed.barrier()
-        terminal = terminal.cpu().item()
+        # rank 0's round in one broadcast: (acc_count, terminal, next_token, accept_list padded to tree_size, verify_tokens)
+        packed = torch.full((3 + 2 * self.tree_size,), -1, dtype=torch.long, device=self.device)
+        packed[0] = acc_count
+        packed[1] = int(terminal)
+        packed[2] = next_token.view(-1)[0]
+        packed[3:3 + len(accept_list)] = torch.tensor(accept_list, device=self.device, dtype=torch.long)
+        packed[3 + self.tree_size:] = self.verify_tokens
+        torch.distributed.broadcast(packed, src=0)
+
+        next_token = packed[2:3].clone()
+        self.verify_tokens.copy_(packed[3 + self.tree_size:])
+        header = packed[:3 + self.tree_size].tolist()
+        acc_count, terminal = header[0], bool(header[1])
+        accept_list = header[3:3 + acc_count]
         
         if terminal:
             print(f"Terminal: {terminal}, Accept list: {accept_list}, Accept count: {acc_count}")
@@ -7,8 +7,9 @@ import sys
 root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(root_dir)
 
-from utils.misc import spec_stream, log_csv
-from utils.sampling import sample, norm_logits, max_fn
+from utils.misc import spec_stream, log_csv, IncrementalDetokenizer
+from utils.sampling import sample, norm_logits, norm_sample, max_fn, speculative_accept
+from utils.profiler import NULL_PROFILER
 
 @torch.inference_mode()
 def Autoregressive(tokenizer, graph_engine, input_ids, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False):
@@ -20,7 +21,7 @@ def Autoregressive(tokenizer, graph_engine, input_ids, max_len=256, top_k=-1, to
     if verbose:
         graph_engine.engine.kv_cache.print_status()
 
-    next_token = sample(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p))
+    next_token = norm_sample(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p)[1]
     
     if verbose:
         spec_stream(next_token[0], tokenizer, 'cyan')
@@ -29,7 +30,7 @@ def Autoregressive(tokenizer, graph_engine, input_ids, max_len=256, top_k=-1, to
     time1 = time.time()
     while n < max_len:
         logits = graph_engine.engine.model(input_ids=next_token, kv_cache=graph_engine.engine.kv_cache, graph_cache=None).logits
-        next_token = sample(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p))
+        next_token = norm_sample(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p)[1]
         n += 1
         if verbose:
             spec_stream(next_token[0], tokenizer, 'cyan')
@@ -38,18 +39,40 @@ def Autoregressive(tokenizer, graph_engine, input_ids, max_len=256, top_k=-1, to
 
 
 @torch.inference_mode()
-def TriForce(tokenizer, graph_engine, input_ids, gamma=4, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False, file_path=None, dataset=None, spec_args=None):
+def TriForce(tokenizer, graph_engine, input_ids, gamma=4, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False, file_path=None, dataset=None, spec_args=None, refresh_policy=None, prefix_store=None, profiler=None, gamma_controller=None, confidence=None, on_tokens=None):
+    """
+    on_tokens: called as on_tokens(ids, eos) with the ids committed by the first sample and by every round (utils/streaming.py).
+        A truthy return stops generation after that round.
+    """
+
+    # opt-in hot path profiling (utils/profiler.py), shared with the engine
+    profiler = graph_engine.profiler = profiler if profiler is not None else NULL_PROFILER
 
     # reset all cache
     graph_engine.engine.kv_cache.reset()
     graph_engine.engine.graph_cache.reset()
     graph_engine.engine.draft_cache.reset()
-
-    logits = graph_engine.inference(input_ids=input_ids[:,:-1])
-    logits = graph_engine.inference(input_ids=input_ids[:,-1:])
-    _ = graph_engine.graph_draft_prefill(input_ids=input_ids)
+    if refresh_policy is not None:
+        refresh_policy.reset()
+    if gamma_controller is not None:
+        gamma_controller.reset()
+
+    with profiler.phase("prefill"):
+        if prefix_store is not None:
+            # restore the longest stored prefix, prefill only the rest and store the result
+            restored = prefix_store.restore(graph_engine.engine.kv_cache, input_ids[:,:-1])
+            if restored < input_ids.shape[1] - 1:
+                graph_engine.prefill(input_ids=input_ids[:,restored:-1])
+            prefix_store.save(graph_engine.engine.kv_cache, input_ids[:,:-1])
+            if verbose:
+                prefix_store.print_status()
+        else:
+            logits = graph_engine.inference(input_ids=input_ids[:,:-1])
+        logits = graph_engine.inference(input_ids=input_ids[:,-1:])
+        _ = graph_engine.graph_draft_prefill(input_ids=input_ids)
 
     if verbose:
+        graph_engine.engine.prefill_planner.print_plan()
         graph_engine.engine.kv_cache.print_status()
         graph_engine.engine.graph_cache.print_status()
         graph_engine.engine.draft_cache.print_status()
@@ -59,21 +82,36 @@ def TriForce(tokenizer, graph_engine, input_ids, gamma=4, max_len=256, top_k=-1,
     target_sample_count = 0
     draft_count = 0
 
-    next_token = sample(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p))
+    next_token = norm_sample(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p)[1]
     
     if verbose:
         spec_stream(next_token[0], tokenizer, 'cyan')
+    stop = False
+    if on_tokens is not None:
+        first = next_token[0].tolist()
+        stop = on_tokens(first, first[-1] == tokenizer.eos_token_id)
 
     acc_rate_middle_list = []
+    gamma_list = []
+    # retrieval verifications of rejected drafts / target verifications of rejected middle tokens
+    middle_stats = {}
+    target_verified = 0
     n = 0
     time1 = time.time()
-    while n < max_len:
+    while n < max_len and not stop:
         if next_token.shape == torch.Size([1]):
             next_token = next_token.unsqueeze(0)
         
+        # speculation length of this round, among the captured verify graphs
+        round_gamma = gamma_controller.choose() if gamma_controller is not None else gamma
+        gamma_list.append(round_gamma)
+
         # speculative decoding for draft (68m) and retrieval 7b model
         pred_token_idx = next_token
-        verify_tokens, speculation_probs, acc_rate_middle = Middle_Spec(pred_token_idx, graph_engine, gamma, False, tokenizer)
+        t_middle = time.perf_counter()
+        with profiler.phase("middle_spec"):
+            verify_tokens, speculation_probs, acc_rate_middle = Middle_Spec(pred_token_idx, graph_engine, round_gamma, False, tokenizer, confidence=confidence, stats=middle_stats)
+        t_target = time.perf_counter()
         acc_rate_middle_list.append(acc_rate_middle)
         generated_ids = verify_tokens[1:]
         draft_count += len(speculation_probs)
@@ -81,71 +119,92 @@ def TriForce(tokenizer, graph_engine, input_ids, gamma=4, max_len=256, top_k=-1,
         gamma2 = len(generated_ids)
         
         # speculative decoding retrieval 7b model and target model
-        verify_tokens = torch.cat([next_token, torch.LongTensor([generated_ids]).to(graph_engine.engine.model.device)], dim=1)
-        logits = graph_engine.inference(input_ids=verify_tokens)
-
-        count = 0
-        verify_probs = []
-    
-        probs = norm_logits(logits[0], temperature=temperature ,top_k=top_k, top_p=top_p)
-        for i in range(gamma2 + 1):
-            verify_probs.append(probs[i])
+        with profiler.phase("target_verify"):
+            verify_tokens = torch.cat([next_token, torch.LongTensor([generated_ids]).to(graph_engine.engine.model.device)], dim=1)
+            logits = graph_engine.inference(input_ids=verify_tokens)
+
+            verify_probs = norm_logits(logits[0], temperature=temperature ,top_k=top_k, top_p=top_p)
+
+            # all acceptance tests, the residual / bonus sample and eos in one pass, single readback
+            accept, pred_token_idx, eos = speculative_accept(verify_tokens[:, 1:], torch.stack(speculation_probs).unsqueeze(0), verify_probs.unsqueeze(0), eos_token_id=tokenizer.eos_token_id)
+            with profiler.phase("host_sync"):
+                count, token, eos = torch.stack([accept, pred_token_idx, eos.long()], dim=1)[0].tolist()
+        if gamma_controller is not None:
+            # both spans end in a host readback, so wall time covers the device work
+            gamma_controller.step(round_gamma, gamma2, count, acc_rate_middle, t_target - t_middle, time.perf_counter() - t_target)
+        target_verified += gamma2
+        profiler.count("rounds")
+        profiler.count("middle_proposed", gamma2)
+        profiler.count("target_accepted", count)
+        if on_tokens is not None:
+            committed = generated_ids[:count] if eos else generated_ids[:count] + [token]
+            if on_tokens(committed, bool(eos) or token == tokenizer.eos_token_id):
+                n += len(committed)
+                break
 
         pass_tokens = torch.full((1, gamma2 + 2), 100, device=graph_engine.engine.model.device)
-        pass_tokens[:, 0] = next_token
-        
-        for i, speculation_prob, verify_prob in zip(generated_ids, speculation_probs, verify_probs):
-            r = torch.rand(1, device = graph_engine.engine.model.device)
-            if r < torch.min(torch.tensor([1], device=r.device), (verify_prob[i] / speculation_prob[i])):
-                count += 1
-                accepted_count += 1
-                n += 1
-                pred_token_idx = torch.tensor([[i]]).to(graph_engine.engine.model.device)
-                pass_tokens[:, count] = pred_token_idx
-                if verbose:
-                    spec_stream(i, tokenizer, 'green')
-                # if eos
-                if tokenizer.eos_token_id == i:
-                    draft_count -= gamma2 - count
-                    break
-            else:
+        pass_tokens[:, :count+1] = verify_tokens[:, :count+1]
+
+        accepted_count += count
+        n += count
+        if verbose:
+            for i in generated_ids[:count]:
+                spec_stream(i, tokenizer, 'green')
+
+        if eos:
+            draft_count -= gamma2 - count
+            pred_token_idx = pass_tokens[:, count:count+1]
+        else:
+            n += 1
+            pred_token_idx = pred_token_idx.view(1, 1)
+            pass_tokens[:, count+1] = pred_token_idx
+            if count < gamma2:
                 resample_count += 1
-                n += 1
-                pred_token_idx = sample(max_fn(verify_prob-speculation_prob))
-                pass_tokens[:, count+1] = pred_token_idx
                 if verbose:
-                    spec_stream(pred_token_idx, tokenizer, 'red')
-                break
-
-            if tokenizer.eos_token_id == pred_token_idx:
-                break
+                    spec_stream(token, tokenizer, 'red')
 
         # update 7b cache
         graph_engine.engine.kv_cache.seq_len -= (len(generated_ids) - count)
         graph_engine.update_graph_cache()
+
+        # re-select retrieval chunks with the query of the last committed token
+        if refresh_policy is not None:
+            with profiler.phase("refresh"):
+                refresh_policy.step(graph_engine.engine.graph_cache, graph_engine.engine.kv_cache, accepted=count + 1, acc_rate_middle=acc_rate_middle, position=count)
         
-        if count == len(generated_ids):
+        if count == len(generated_ids) and not eos:
             target_sample_count += 1
-            n += 1
-            pred_token_idx = sample(verify_probs[-1])
-            pass_tokens[:, count+1] = pred_token_idx
             if verbose:
-                spec_stream(pred_token_idx, tokenizer, 'blue')
+                spec_stream(token, tokenizer, 'blue')
             count += 1
 
         # update cache for 68m
-        graph_engine.graph_draft_inference(input_ids=pass_tokens, gamma_offset = gamma2 + 1)
-        current_seq_len = graph_engine.engine.draft_cache.start_size + graph_engine.engine.draft_cache.recent_size + count
-        graph_engine.engine.draft_cache.evict_for_spec(current_seq_len)
+        with profiler.phase("draft_update"):
+            graph_engine.graph_draft_inference(input_ids=pass_tokens, gamma_offset = gamma2 + 1)
+        with profiler.phase("evict_for_spec"):
+            current_seq_len = graph_engine.engine.draft_cache.start_size + graph_engine.engine.draft_cache.recent_size + count
+            graph_engine.engine.draft_cache.evict_for_spec(current_seq_len)
 
         next_token = pred_token_idx
 
     time2 = time.time()
-    acceptance_rate = accepted_count / draft_count
-    avg_tokens = accepted_count / draft_count * gamma
+    profiler.count("generated", n)
+    acceptance_rate = accepted_count / max(draft_count, 1)
+    avg_tokens = acceptance_rate * (np.mean(gamma_list) if gamma_list else gamma)
     if verbose:
         print(f"Use {time2 - time1} sec to generate {n} tokens (now {graph_engine.engine.kv_cache.seq_len} tokens), Tokens/s: {n / (time2 - time1)}", flush=True)
         print(f"accepted rate {acceptance_rate}, avg generated tokens {avg_tokens}")
+        print(f"wasted verification: retrieval {middle_stats.get('rejected', 0) / max(middle_stats.get('verified', 0), 1):.3f} of {middle_stats.get('verified', 0)} drafts, target {(target_verified - accepted_count) / max(target_verified, 1):.3f} of {target_verified} middle tokens, early exits {middle_stats.get('early_exits', 0)}")
+        if gamma_controller is not None:
+            gamma_summary = gamma_controller.summary()
+            print(f"gamma changes {gamma_summary['changes']}, mean gamma {gamma_summary['mean_gamma']:.2f}, rounds per gamma {gamma_summary['gamma_rounds']}")
+        if refresh_policy is not None:
+            refresh_summary = refresh_policy.summary()
+            print(f"retrieval refreshes {refresh_summary['refreshes']}, total refresh cost {refresh_summary['total_cost']} sec")
+            for event in refresh_summary['events']:
+                print(f"  round {event['round']} ({event['reason']}): acc_rate_middle {event['acc_before']} -> {event['acc_after']}, cost {event['cost']} sec")
+        if profiler.enabled:
+            profiler.print_summary()
 
     if file_path is not None:
         header = "target,acceptance_rate,token/s,avg_tokens,prefill,gen_len,dataset,acc_rate_middle,latency\n"
@@ -160,8 +219,14 @@ def TriForce(tokenizer, graph_engine, input_ids, gamma=4, max_len=256, top_k=-1,
     return acceptance_rate, n / (time2 - time1)
 
 @torch.inference_mode()
-def Middle_Spec(next_token, graph_engine, gamma, verbose, tokenizer):
-
+def Middle_Spec(next_token, graph_engine, gamma, verbose, tokenizer, confidence=None, stats=None):
+    """
+    confidence: stop the chain early once the draft gives its own sample a probability below it (after at
+        least one token). The unverified draft is dropped, so the output distribution is unchanged.
+    stats: dict accumulating retrieval verifications, rejected drafts and early exits.
+    """
+
+    profiler = graph_engine.profiler
     n = 0
     resample_count = 0
     accepted_count = 0
@@ -183,14 +248,26 @@ def Middle_Spec(next_token, graph_engine, gamma, verbose, tokenizer):
         speculation_prob = graph_engine.graph_draft_inference(input_ids=verify_tokens[:,:n+1], gamma_offset = n)
         
         pred_token_idx = sample(speculation_prob)
-        token_idx = pred_token_idx.item()
+        with profiler.phase("host_sync"):
+            if confidence is None:
+                token_idx = pred_token_idx.item()
+            else:
+                token_idx, draft_conf = torch.cat([pred_token_idx.float(), speculation_prob[pred_token_idx].float()]).tolist()
+                token_idx = int(token_idx)
+        if confidence is not None and n > 0 and draft_conf < confidence:
+            # a likely rejection, hand the chain to the target instead of verifying it
+            if stats is not None:
+                stats["early_exits"] = stats.get("early_exits", 0) + 1
+            break
         draft_count += 1
 
         verify_tokens[:, n+1:n+2] = pred_token_idx
         verify_prob = graph_engine.graph_verify(input_ids=verify_tokens, position_ids=position_ids)
 
         r = torch.rand(1, device = graph_engine.engine.model.device)
-        if r < torch.min(torch.tensor([1], device=r.device), (verify_prob[n, token_idx] / speculation_prob[token_idx])):
+        with profiler.phase("host_sync"):
+            accepted = bool(r < torch.min(torch.tensor([1], device=r.device), (verify_prob[n, token_idx] / speculation_prob[token_idx])))
+        if accepted:
             return_speculation_probs.append(verify_prob[n])
             return_generated_ids.append(token_idx)
             if verbose:
@@ -219,82 +296,292 @@ def Middle_Spec(next_token, graph_engine, gamma, verbose, tokenizer):
 
             verify_tokens[:, n:n+1] = pred_token_idx
     
+    if stats is not None:
+        stats["verified"] = stats.get("verified", 0) + draft_count
+        stats["rejected"] = stats.get("rejected", 0) + resample_count
+    profiler.count("draft_proposed", draft_count)
+    profiler.count("draft_accepted", accepted_count)
     acceptance_rate = accepted_count / draft_count
     return return_generated_ids, return_speculation_probs, acceptance_rate
 
 
+################### Batch Spec ####################
+
+@torch.inference_mode()
+def TriForce_Batch(tokenizer, engine, input_ids, gamma=4, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False):
+    """
+    TriForce over a batch of prompts of the same length, in eager mode (no cuda graphs).
+    engine is an InferenceEngine built on BatchFlashSimpleCache, RetrievalCache and StreamingLLMEvictionCache of batch size bsz.
+    Every row keeps its own length, retrieval selection, draft window and acceptance; a row stops at eos or after max_len tokens.
+    """
+    bsz = input_ids.shape[0]
+    device = engine.model.device
+    rows = torch.arange(bsz, device=device)
+
+    # reset all cache
+    engine.clear_kv()
+
+    engine.model_run(input_ids=input_ids[:,:-1])
+    logits = engine.model_run(input_ids=input_ids[:,-1:])
+    _ = engine.draft_run(input_ids=input_ids)
+
+    if verbose:
+        engine.prefill_planner.print_plan()
+        engine.kv_cache.print_status()
+        engine.graph_cache.print_status()
+        engine.draft_cache.print_status()
+
+    next_token = norm_sample(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p)[1]
+
+    generated_ids = [[token] for token in next_token[:, 0].tolist()]
+    produced = torch.ones(bsz, dtype=torch.long, device=device)
+    done = torch.zeros(bsz, dtype=torch.bool, device=device)
+    accepted_count = 0
+    draft_count = 0
+    acc_rate_middle_list = []
+
+    time1 = time.time()
+    while True:
+        # speculative decoding for draft (68m) and retrieval 7b model
+        generated, speculation_probs, num_generated, accepted_middle, drafted_middle = Middle_Spec_Batch(next_token, engine, gamma, temperature=temperature, top_p=top_p)
+
+        # speculative decoding retrieval 7b model and target model
+        verify_tokens = torch.cat([next_token, generated], dim=1)
+        position_ids = engine.kv_cache.seq_lens.unsqueeze(-1) + torch.arange(gamma + 2, device=device)
+        logits = engine.model(input_ids=verify_tokens, kv_cache=engine.kv_cache, graph_cache=None, position_ids=position_ids).logits
+        verify_probs = norm_logits(logits.flatten(0, 1), temperature=temperature ,top_k=top_k, top_p=top_p).view(bsz, gamma + 2, -1)
+
+        accept, new_token, eos = speculative_accept(generated, speculation_probs, verify_probs, num_draft=num_generated, eos_token_id=tokenizer.eos_token_id)
+        bonus = (accept == num_generated) & ~eos
+
+        # update 7b cache, finished rows keep their length
+        seq_lens = engine.kv_cache.seq_lens - (gamma + 2) + torch.where(done, 0, accept + 1)
+        engine.kv_cache.rollback(seq_lens)
+        engine.graph_cache.update_graph_cache_batch(engine.kv_cache)
+
+        # update cache for 68m
+        pass_tokens = torch.cat([verify_tokens, torch.full((bsz, 1), 100, device=device)], dim=1)
+        pass_tokens[rows, accept + 1] = new_token
+        engine.draft(input_ids=pass_tokens, kv_cache=engine.draft_cache, graph_cache=engine.draft_cache, gamma_offset=gamma + 2)
+        engine.draft_cache.evict_for_spec(engine.draft_cache.start_size + engine.draft_cache.recent_size + accept + bonus.long())
+
+        next_token = torch.where(done, next_token[:, 0], new_token).unsqueeze(-1)
+        produced += torch.where(done, 0, accept + (~eos).long())
+        active = ~done
+        done = done | eos | (produced >= max_len)
+
+        # single readback per round
+        stats = torch.stack([accept, new_token, eos.long(), active.long(), num_generated, accepted_middle, drafted_middle, done.long()], dim=1)
+        stats = torch.cat([generated, stats], dim=1).tolist()
+        for b, row in enumerate(stats):
+            row_accept, row_token, row_eos, row_active, row_drafted = row[gamma+1:gamma+6]
+            if not row_active:
+                continue
+            generated_ids[b].extend(row[:row_accept])
+            if not row_eos:
+                generated_ids[b].append(row_token)
+            accepted_count += row_accept
+            draft_count += row_drafted
+            acc_rate_middle_list.append(row[gamma+6] / row[gamma+7])
+        if all(row[-1] for row in stats):
+            break
+
+    time2 = time.time()
+    generated_ids = [ids[:max_len] for ids in generated_ids]
+    n = sum(len(ids) for ids in generated_ids)
+    acceptance_rate = accepted_count / draft_count
+    if verbose:
+        for b, ids in enumerate(generated_ids):
+            print(f"[{b}] {tokenizer.decode(ids, skip_special_tokens=True)}\n", flush=True)
+        print(f"Use {time2 - time1} sec to generate {n} tokens in {bsz} sequences, Tokens/s: {n / (time2 - time1)}", flush=True)
+        print(f"accepted rate {acceptance_rate}, middle accepted rate {np.array(acc_rate_middle_list).mean()}")
+
+    return acceptance_rate, n / (time2 - time1), generated_ids
+
+@torch.inference_mode()
+def Middle_Spec_Batch(next_token, engine, gamma, temperature=0.6, top_p=0.9):
+    """
+    Batched Middle_Spec: every row drafts with the 68m model and verifies with its retrieval cache
+    until it holds gamma or gamma + 1 tokens. Runs exactly gamma steps (each step adds 1 or 2 tokens
+    to an unfinished row) without host synchronization.
+    """
+    bsz = next_token.shape[0]
+    device = engine.model.device
+    rows = torch.arange(bsz, device=device)
+
+    # one spare column so a bonus token past gamma is dropped, as in Middle_Spec
+    verify_tokens = torch.full((bsz, gamma + 2), 100, device=device)
+    verify_tokens[:, 0] = next_token[:, 0]
+    generated = torch.full((bsz, gamma + 1), 100, device=device)
+    speculation_probs = None
+
+    n = torch.zeros(bsz, dtype=torch.long, device=device)
+    accepted = torch.zeros(bsz, dtype=torch.long, device=device)
+    drafted = torch.zeros(bsz, dtype=torch.long, device=device)
+
+    position_ids = engine.kv_cache.seq_lens.unsqueeze(-1) + torch.arange(gamma + 1, device=device)
+
+    for step in range(gamma):
+        active = n < gamma
+        # every active row holds at most min(2 * step, gamma - 1) tokens
+        offset = min(2 * step, gamma)
+        idx = n.clamp(max=offset)
+
+        logits = engine.draft(input_ids=verify_tokens[:, :offset+1], kv_cache=engine.draft_cache, graph_cache=engine.draft_cache, gamma_offset=offset).logits
+        speculation_prob = norm_logits(logits[rows, idx], temperature=temperature, top_k=-1, top_p=top_p)
+        pred_token_idx = sample(speculation_prob).squeeze(-1)
+        verify_tokens[rows, idx + 1] = torch.where(active, pred_token_idx, verify_tokens[rows, idx + 1])
+
+        logits = engine.model(input_ids=verify_tokens[:, :gamma+1], kv_cache=engine.kv_cache, graph_cache=engine.graph_cache, position_ids=position_ids, spec=True).logits
+        verify_probs = norm_logits(logits.flatten(0, 1), temperature=temperature, top_k=-1, top_p=top_p).view(bsz, gamma + 1, -1)
+        if speculation_probs is None:
+            speculation_probs = torch.zeros_like(verify_probs)
+
+        verify_prob = verify_probs[rows, idx]
+        r = torch.rand(bsz, device=device)
+        accept = active & (r < torch.clamp(verify_prob[rows, pred_token_idx] / speculation_prob[rows, pred_token_idx], max=1))
+        drafted += active.long()
+        accepted += accept.long()
+
+        # accepted: keep the draft and sample the next position, rejected: resample this position
+        bonus_prob = verify_probs[rows, (idx + 1).clamp(max=gamma)]
+        resampled = sample(torch.where(accept.unsqueeze(-1), bonus_prob, verify_prob)).squeeze(-1)
+        first = torch.where(accept, pred_token_idx, resampled)
+
+        slot = idx.clamp(max=gamma)
+        generated[rows, slot] = torch.where(active, first, generated[rows, slot])
+        speculation_probs[rows, slot] = torch.where(active.unsqueeze(-1), verify_prob, speculation_probs[rows, slot])
+        verify_tokens[rows, idx + 1] = torch.where(active, first, verify_tokens[rows, idx + 1])
+
+        slot = (idx + 1).clamp(max=gamma)
+        generated[rows, slot] = torch.where(accept, resampled, generated[rows, slot])
+        speculation_probs[rows, slot] = torch.where(accept.unsqueeze(-1), bonus_prob, speculation_probs[rows, slot])
+        verify_tokens[rows, (idx + 2).clamp(max=gamma + 1)] = torch.where(accept, resampled, verify_tokens[rows, (idx + 2).clamp(max=gamma + 1)])
+
+        n += active.long() + accept.long()
+
+    return generated, speculation_probs, n, accepted, drafted
+
+
 
 ################### Dist Spec ####################
 import torch.distributed as dist
 
-def sample_dist(probs):
+# Sync-free decoding: with seed=... every rank samples from its own copy of one seeded generator (shared_generator).
+# The probabilities are the same on every rank (all-reduced target logits, replicated draft), so every draw agrees
+# without communication. Only the per-round decision of the target is still broadcast, in one packed tensor that also
+# lets the other ranks check they drafted what rank 0 drafted (agree_dist). Without a seed rank 0 draws and broadcasts.
+
+def shared_generator(seed, device):
+    if seed is None:
+        return None
+    return torch.Generator(device=device).manual_seed(seed)
+
+def sample_dist(probs, generator=None):
+    if generator is not None:
+        return sample(probs, generator=generator)
     if torch.distributed.get_rank() == 0:
         next_token = sample(probs)
     else:
         next_token = torch.empty((1,1), dtype=torch.long, device=probs.device)
 
+    # the broadcast orders the ranks already, no barrier
     torch.distributed.broadcast(next_token, src=0)
-    dist.barrier()
     # assert next_token.item() <= probs.shape[-1], f"{next_token.item()} > {probs.shape[-1]}, probs: {probs}"
     return next_token
 
+def agree_dist(decision, proposal):
+    # one broadcast of rank 0's decision and the proposal it was taken on, every rank takes the decision
+    packed = torch.cat([decision.flatten(), proposal.flatten().to(decision.dtype)])
+    local = packed[decision.numel():].clone()
+    torch.distributed.broadcast(packed, src=0)
+    if not torch.equal(packed[decision.numel():], local):
+        raise RuntimeError(f"rank {torch.distributed.get_rank()} drafted other tokens than rank 0, the shared random streams diverged")
+    return packed[:decision.numel()].view_as(decision)
+
+def speculative_accept_dist(draft_tokens, draft_probs, target_probs, eos_token_id=None, generator=None):
+    # rank 0 decides, one broadcast of (accept, next_token, eos) per row
+    # with a shared generator every rank decides the same, the broadcast only keeps them in agreement
+    if generator is not None:
+        accept, next_token, eos = speculative_accept(draft_tokens, draft_probs, target_probs, eos_token_id=eos_token_id, generator=generator)
+        return agree_dist(torch.stack([accept, next_token, eos.long()], dim=1), draft_tokens)
+
+    if torch.distributed.get_rank() == 0:
+        accept, next_token, eos = speculative_accept(draft_tokens, draft_probs, target_probs, eos_token_id=eos_token_id)
+        result = torch.stack([accept, next_token, eos.long()], dim=1)
+    else:
+        result = torch.empty((draft_tokens.shape[0], 3), dtype=torch.long, device=draft_tokens.device)
+
+    torch.distributed.broadcast(result, src=0)
+    return result
+
 
 @torch.inference_mode()
-def Baseline_Dist(tokenizer, graph_engine, input_ids, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False, local_rank=0):
+def Baseline_Dist(tokenizer, graph_engine, input_ids, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False, local_rank=0, seed=None):
+    # seed: sync-free sampling, no collective besides the ones of the forwards
+    generator = shared_generator(seed, input_ids.device)
     bsz, prefill = input_ids.size()
     graph_engine.reset()
     logits = graph_engine.prefill(input_ids=input_ids)
     
-    next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p))
+    next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p), generator)
     
     gen_tokens = torch.zeros((input_ids.size(0), max_len), dtype=torch.long, device=input_ids.device)
 
     n = 0
-    pos = 0
-    generated_ids = []
-    generated_ids.extend(next_token[0].tolist())
+    detokenizer = IncrementalDetokenizer(tokenizer) if local_rank == 0 else None
+    if detokenizer is not None:
+        print(detokenizer.push(next_token[0].tolist()), end="", flush=True)
     
-    torch.cuda.synchronize()
+    if input_ids.is_cuda:
+        torch.cuda.synchronize()
     time1 = time.time()
     while n < max_len:
         logits = graph_engine.inference(input_ids=next_token)
         
-        next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p))
-        
-        generated_ids.extend(next_token[0].tolist())
-
-        generated_text = (
-            tokenizer.decode(
-            generated_ids,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=True,
-            spaces_between_special_tokens=False,
-        )
-        .strip()
-        .split(" ")
-        )
-
-        if local_rank == 0:
-            now = len(generated_text) - 1
-            if now > pos:
-                print(" ".join(generated_text[pos:now]), end=" ", flush=True)
-                pos = now
+        next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=top_k, top_p=top_p), generator)
+
+        if detokenizer is not None:
+            print(detokenizer.push(next_token[0].tolist()), end="", flush=True)
 
         gen_tokens[:, n] = next_token.squeeze()
         n += 1
-    torch.cuda.synchronize()
+    if input_ids.is_cuda:
+        torch.cuda.synchronize()
     time2 = time.time()
+    if detokenizer is not None:
+        print(detokenizer.flush(), flush=True)
     return 1000 * (time2 - time1) / n, gen_tokens
 
 
 @torch.inference_mode()
-def TriForce_Dist(tokenizer, llm, input_ids, gamma=4, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False, file_path=None, dataset=None, spec_args=None):
+def TriForce_Dist(tokenizer, llm, input_ids, gamma=4, max_len=256, top_k=-1, top_p=0.9, temperature=0.6, verbose=False, file_path=None, dataset=None, spec_args=None, prefix_store=None, refresh_policy=None, profiler=None, on_tokens=None, seed=None):
+    """
+    on_tokens: called as on_tokens(ids, eos) with the ids committed by the first sample and by every round, usually on rank 0 only.
+        Its return value is ignored, all ranks stop together at eos or max_len.
+    seed: sync-free decoding with a generator shared by all ranks (the same seed on every rank), one broadcast per round
+        instead of a broadcast per draft token and acceptance test.
+    """
+    generator = shared_generator(seed, llm.device)
+
+    profiler = profiler if profiler is not None else NULL_PROFILER
 
     ##### PREFILL #####
     llm.reset()
-    llm.prefill(input_ids=input_ids[:,:-1])
+    if refresh_policy is not None:
+        refresh_policy.reset()
+    if prefix_store is not None:
+        # every rank stores its own heads, all ranks restore the same length
+        restored = prefix_store.restore(llm.kv_cache, input_ids[:,:-1], device=llm.device, distributed=True)
+        if restored < input_ids.shape[1] - 1:
+            llm.prefill(input_ids=input_ids[:,restored:-1])
+        prefix_store.save(llm.kv_cache, input_ids[:,:-1])
+        if verbose:
+            prefix_store.print_status()
+    else:
+        llm.prefill(input_ids=input_ids[:,:-1])
     logits = llm.build_retrieval_cache(input_ids=input_ids[:,-1:])
-    next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=-1, top_p=top_p))
+    next_token = sample_dist(norm_logits(logits[:,-1,:], temperature=temperature ,top_k=-1, top_p=top_p), generator)
 
     if next_token.shape == torch.Size([1]):
         next_token = next_token.unsqueeze(0)
@@ -312,9 +599,10 @@ def TriForce_Dist(tokenizer, llm, input_ids, gamma=4, max_len=256, top_k=-1, top
     acc_rate_middle_list = []
     n = 0
 
-    pos = 0
-    print_ids = []
-    print_ids.extend(next_token[0].tolist())
+    detokenizer = IncrementalDetokenizer(tokenizer) if llm.local_rank == 0 else None
+    print_ids = next_token[0].tolist()
+    if on_tokens is not None:
+        on_tokens(print_ids[:], print_ids[-1] == tokenizer.eos_token_id)
 
     time1 = time.time()
     while n < max_len:
@@ -323,7 +611,8 @@ def TriForce_Dist(tokenizer, llm, input_ids, gamma=4, max_len=256, top_k=-1, top
         
         # speculative decoding for draft (68m) and retrieval 7b model
         pred_token_idx = next_token
-        verify_tokens, speculation_probs, acc_rate_middle = Middle_Spec_Dist(pred_token_idx, llm, gamma, False, tokenizer)
+        with profiler.phase("middle_spec"):
+            verify_tokens, speculation_probs, acc_rate_middle = Middle_Spec_Dist(pred_token_idx, llm, gamma, False, tokenizer, generator=generator)
         acc_rate_middle_list.append(acc_rate_middle)
         generated_ids = verify_tokens[1:]
         draft_count += len(speculation_probs)
@@ -331,105 +620,106 @@ def TriForce_Dist(tokenizer, llm, input_ids, gamma=4, max_len=256, top_k=-1, top
         gamma2 = len(generated_ids)
         
         # speculative decoding retrieval 7b model and target model
-        verify_tokens = torch.cat([next_token, torch.LongTensor([generated_ids]).to(llm.device)], dim=1)
-        logits = llm.inference(input_ids=verify_tokens)
-
-        count = 0
-        verify_probs = []
-    
-        probs = norm_logits(logits[0], temperature=temperature, top_k=top_k, top_p=top_p)
-        for i in range(gamma2 + 1):
-            verify_probs.append(probs[i])
+        with profiler.phase("target_verify", llm.offload_bytes):
+            verify_tokens = torch.cat([next_token, torch.LongTensor([generated_ids]).to(llm.device)], dim=1)
+            logits = llm.inference(input_ids=verify_tokens)
+
+            verify_probs = norm_logits(logits[0], temperature=temperature, top_k=top_k, top_p=top_p)
+
+            # all acceptance tests, the residual / bonus sample and eos in one pass, single broadcast and readback
+            result = speculative_accept_dist(verify_tokens[:, 1:], torch.stack(speculation_probs).unsqueeze(0), verify_probs.unsqueeze(0), eos_token_id=tokenizer.eos_token_id, generator=generator)
+            with profiler.phase("host_sync"):
+                count, token, eos = result[0].tolist()
+        profiler.count("rounds")
+        profiler.count("draft_proposed", len(speculation_probs))
+        profiler.count("middle_proposed", gamma2)
+        profiler.count("target_accepted", count)
+        if on_tokens is not None:
+            on_tokens(generated_ids[:count] if eos else generated_ids[:count] + [token], bool(eos) or token == tokenizer.eos_token_id)
 
         pass_tokens = torch.full((1, gamma2 + 2), 100, device=llm.device)
-        pass_tokens[:, 0] = next_token
-        
-        for i, speculation_prob, verify_prob in zip(generated_ids, speculation_probs, verify_probs):
-            r = torch.rand(1, device = llm.device)
-            # broadcast the random number
-            torch.distributed.broadcast(r, src=0)
-            dist.barrier()
-            if r <= torch.min(torch.tensor([1], device=r.device), (verify_prob[i] / speculation_prob[i])):
-                count += 1
-                accepted_count += 1
-                n += 1
-                pred_token_idx = torch.tensor([[i]]).to(llm.device)
-                pass_tokens[:, count] = pred_token_idx
-                if verbose:
-                    spec_stream(i, tokenizer, 'green')
-                print_ids.append(pred_token_idx.item())
-                # if eos
-                if tokenizer.eos_token_id == i:
-                    draft_count -= gamma2 - count
-                    if llm.local_rank == 0:
-                        print('[EOS]')
-                    break
-            else:
-                resample_count += 1
-                n += 1
-                pred_token_idx = sample_dist(max_fn(verify_prob-speculation_prob))
-                pass_tokens[:, count+1] = pred_token_idx
-                if verbose:
-                    spec_stream(pred_token_idx, tokenizer, 'red')
-                print_ids.append(pred_token_idx.item())
-                break
+        pass_tokens[:, :count+1] = verify_tokens[:, :count+1]
 
-            if tokenizer.eos_token_id == pred_token_idx:
-                if llm.local_rank == 0:
-                    print('[EOS]')
-                break
+        accepted_count += count
+        n += count
+        print_ids.extend(generated_ids[:count])
+        if verbose:
+            for i in generated_ids[:count]:
+                spec_stream(i, tokenizer, 'green')
 
-        if tokenizer.eos_token_id == pred_token_idx:
+        if eos:
+            draft_count -= gamma2 - count
+            if detokenizer is not None:
+                print(detokenizer.push(print_ids), '[EOS]', end="")
+            break
+
+        n += 1
+        pred_token_idx = result[:, 1:2]
+        pass_tokens[:, count+1] = pred_token_idx
+        print_ids.append(token)
+        if count < gamma2:
+            resample_count += 1
+            if verbose:
+                spec_stream(token, tokenizer, 'red')
+
+        if tokenizer.eos_token_id == token:
+            if detokenizer is not None:
+                print(detokenizer.push(print_ids), '[EOS]', end="")
             break
 
         # update 7b cache
         llm.kv_cache.seq_len -= (len(generated_ids) - count)
-        llm.retrieval_cache.update_graph_cache(llm.kv_cache)
+        tail_bytes = llm.retrieval_cache.tail_bytes
+        with profiler.phase("update_graph_cache"):
+            llm.retrieval_cache.update_graph_cache(llm.kv_cache)
+        profiler.add_bytes("update_graph_cache", llm.retrieval_cache.tail_bytes - tail_bytes)
+
+        # re-select retrieval chunks with the query of the last committed token, every rank takes the same decision
+        if refresh_policy is not None:
+            refresh_bytes = llm.retrieval_cache.refresh_bytes
+            with profiler.phase("refresh"):
+                refresh_policy.step(llm.retrieval_cache, llm.kv_cache, accepted=count + 1, acc_rate_middle=acc_rate_middle, position=count)
+            profiler.add_bytes("refresh", llm.retrieval_cache.refresh_bytes - refresh_bytes)
         
         if count == len(generated_ids):
             target_sample_count += 1
-            n += 1
-            pred_token_idx = sample_dist(verify_probs[-1])
-            pass_tokens[:, count+1] = pred_token_idx
             if verbose:
-                spec_stream(pred_token_idx, tokenizer, 'blue')
-            print_ids.append(pred_token_idx.item())
+                spec_stream(token, tokenizer, 'blue')
             count += 1
 
         # update cache for 68m
         # print(pass_tokens,pred_token_idx, flush=True)
-        llm.draft_run(input_ids=pass_tokens, gamma_offset = gamma2 + 1)
-        current_seq_len =llm.draft_cache.start_size + llm.draft_cache.recent_size + count
-        llm.draft_cache.evict_for_spec(current_seq_len)
-
-        generated_text = (
-            tokenizer.decode(
-            print_ids,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=True,
-            spaces_between_special_tokens=False,
-        )
-        .strip()
-        .split(" ")
-        )
-
-        if llm.local_rank == 0:
-            now = len(generated_text) - 1
-            if now > pos:
-                print(" ".join(generated_text[pos:now]), end=" ", flush=True)
-                pos = now
+        with profiler.phase("draft_update"):
+            llm.draft_run(input_ids=pass_tokens, gamma_offset = gamma2 + 1)
+        with profiler.phase("evict_for_spec"):
+            current_seq_len =llm.draft_cache.start_size + llm.draft_cache.recent_size + count
+            llm.draft_cache.evict_for_spec(current_seq_len)
+
+        if detokenizer is not None:
+            print(detokenizer.push(print_ids), end="", flush=True)
+        print_ids = []
 
         next_token = pred_token_idx
 
     time2 = time.time()
+    if detokenizer is not None:
+        print(detokenizer.flush(), flush=True)
     acceptance_rate = accepted_count / draft_count
     avg_tokens = accepted_count / draft_count * gamma
 
+    if verbose and llm.local_rank == 0:
+        llm.retrieval_cache.print_status()
+        if refresh_policy is not None:
+            refresh_summary = refresh_policy.summary()
+            print(f"retrieval refreshes {refresh_summary['refreshes']}, total refresh cost {refresh_summary['total_cost']} sec")
+        if profiler.enabled:
+            profiler.print_summary()
+
     return avg_tokens, (time2 - time1) / n
 
 
 @torch.inference_mode()
-def Middle_Spec_Dist(next_token, llm, gamma, verbose, tokenizer):
+def Middle_Spec_Dist(next_token, llm, gamma, verbose, tokenizer, generator=None):
     n = 0
     resample_count = 0
     accepted_count = 0
@@ -450,17 +740,19 @@ def Middle_Spec_Dist(next_token, llm, gamma, verbose, tokenizer):
     while n < gamma:
         speculation_prob = llm.draft_run(input_ids=verify_tokens[:,:n+1], gamma_offset = n)
         
-        pred_token_idx = sample_dist(speculation_prob)
+        pred_token_idx = sample_dist(speculation_prob, generator)
         token_idx = pred_token_idx.item()
         draft_count += 1
 
         verify_tokens[:, n+1:n+2] = pred_token_idx
         verify_prob = llm.retrieval_verify(input_ids=verify_tokens, position_ids=position_ids, temperature=llm.temperature, top_p=llm.top_p)
 
-        r = torch.rand(1, device = llm.device)
-        # broadcast the random number
-        torch.distributed.broadcast(r, src=0)
-        dist.barrier()
+        if generator is not None:
+            r = torch.rand(1, device = llm.device, generator=generator)
+        else:
+            r = torch.rand(1, device = llm.device)
+            # broadcast the random number
+            torch.distributed.broadcast(r, src=0)
         if r < torch.min(torch.tensor([1], device=llm.device), (verify_prob[n, token_idx] / speculation_prob[token_idx])):
             return_speculation_probs.append(verify_prob[n])
             return_generated_ids.append(token_idx)
@@ -469,7 +761,7 @@ def Middle_Spec_Dist(next_token, llm, gamma, verbose, tokenizer):
             accepted_count += 1
             n += 1
         
-            pred_token_idx = sample_dist(verify_prob[n])
+            pred_token_idx = sample_dist(verify_prob[n], generator)
             return_speculation_probs.append(verify_prob[n])
             return_generated_ids.append(pred_token_idx.item())
             if verbose:
@@ -480,7 +772,7 @@ def Middle_Spec_Dist(next_token, llm, gamma, verbose, tokenizer):
             verify_tokens[:, n:n+1] = pred_token_idx
         
         else:
-            pred_token_idx = sample_dist(verify_prob[n])
+            pred_token_idx = sample_dist(verify_prob[n], generator)
             return_speculation_probs.append(verify_prob[n])
             return_generated_ids.append(pred_token_idx.item())
             if verbose:
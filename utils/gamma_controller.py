@@ -0,0 +1,84 @@
+import numpy as np
+
+class GammaController:
+    """
+    Chooses the speculation length (gamma) of every TriForce round among `gammas` (verify graphs captured for each).
+
+    Over the last `window` rounds it keeps
+        a_target: acceptance of middle tokens by the target, accepted / (accepted + rejections)
+        a_middle: acceptance of draft tokens by the retrieval cache, every middle iteration yields 1 + a_middle tokens
+        t_iter / t_target: measured time of one middle iteration (draft step + retrieval verify) and of the target verify
+    and picks the gamma maximising expected tokens per second
+        (1 - a_target^(gamma+1)) / (1 - a_target)  /  (gamma / (1 + a_middle) * t_iter + t_target).
+    Until `warmup` rounds are recorded the initial gamma is used. Every change is logged in `events`.
+    """
+    def __init__(self, gammas, gamma=None, window=16, warmup=4, verbose=False) -> None:
+        self.gammas = sorted(set(gammas))
+        self.initial = gamma if gamma is not None else self.gammas[-1]
+        assert self.initial in self.gammas, f"initial gamma {self.initial} is not in {self.gammas}"
+        self.window = window
+        self.warmup = warmup
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.gamma = self.initial
+        self.round = 0
+        self.history = [] # (gamma, proposed, accepted, acc_rate_middle, middle_time, target_time)
+        self.events = []
+
+    def estimates(self):
+        recent = self.history[-self.window:]
+        accepted = sum(r[2] for r in recent)
+        rejections = sum(r[2] < r[1] for r in recent)
+        iterations = sum(r[0] / (1 + r[3]) for r in recent)
+        return {
+            "a_target": min(accepted / max(accepted + rejections, 1), 1 - 1e-3),
+            "a_middle": float(np.mean([r[3] for r in recent])),
+            "t_iter": sum(r[4] for r in recent) / max(iterations, 1e-9),
+            "t_target": float(np.mean([r[5] for r in recent])),
+        }
+
+    def throughput(self, gamma, est):
+        a = est["a_target"]
+        tokens = (1 - a ** (gamma + 1)) / (1 - a)
+        return tokens / (gamma / (1 + est["a_middle"]) * est["t_iter"] + est["t_target"])
+
+    def choose(self):
+        return self.gamma
+
+    def step(self, gamma, proposed, accepted, acc_rate_middle, middle_time, target_time):
+        """
+        Record one round and choose the gamma of the next one.
+
+        Args:
+            gamma (int): speculation length of the round.
+            proposed (int): middle tokens verified by the target, accepted (int): how many it accepted.
+            acc_rate_middle (float): draft acceptance of the middle level.
+            middle_time / target_time (float): seconds spent in Middle_Spec and in the target verify.
+        """
+        self.round += 1
+        self.history.append((gamma, proposed, accepted, acc_rate_middle, middle_time, target_time))
+        if len(self.history) < self.warmup:
+            return self.gamma
+
+        est = self.estimates()
+        scores = {g: self.throughput(g, est) for g in self.gammas}
+        best = max(scores, key=scores.get)
+        if best != self.gamma:
+            event = {"round": self.round, "from": self.gamma, "to": best, "tokens_per_sec": scores[best], **est}
+            self.events.append(event)
+            if self.verbose:
+                print(f"\n[Gamma Controller] round {self.round}: gamma {self.gamma} -> {best} | a_target {est['a_target']:.3f}, a_middle {est['a_middle']:.3f}, t_iter {1000 * est['t_iter']:.2f} ms, t_target {1000 * est['t_target']:.2f} ms | {scores[best]:.1f} tokens/s")
+            self.gamma = best
+        return self.gamma
+
+    def summary(self):
+        used = [r[0] for r in self.history]
+        return {
+            "rounds": self.round,
+            "changes": len(self.events),
+            "mean_gamma": float(np.mean(used)) if used else float(self.gamma),
+            "gamma_rounds": {g: used.count(g) for g in self.gammas},
+            "events": self.events,
+        }
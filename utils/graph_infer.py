@@ -10,6 +10,8 @@ import math
 from tqdm import tqdm
 
 from .sampling import norm_logits
+from .prefill import PrefillPlanner
+from .profiler import NULL_PROFILER
 
 class InferenceEngine:
     def __init__(self, model, cache, graph_cache, draft, draft_cache) -> None:
@@ -25,16 +27,28 @@ class InferenceEngine:
         self.draft.eval()
         self.draft_cache = draft_cache
 
+        ###### prefill slices ######
+        # an offloaded cache re-streams every layer's kv per slice
+        offload_bytes = cache.offload_bytes() if hasattr(cache, 'offload_bytes') else 0
+        self.offload_bytes = offload_bytes
+        self.prefill_planner = PrefillPlanner.from_config(model.config, dtype=model.dtype, offload_bytes=offload_bytes, device=model.device)
+        # draft slices are fixed at 64 tokens, as before the planner: every slice evicts the window down to
+        # recent_size - slice older tokens, so larger slices only degrade the draft kv
+        self.draft_prefill_planner = PrefillPlanner.from_config(draft.config, dtype=draft.dtype, multiple=16, min_slice=64, max_slice=64)
+
+    @torch.inference_mode()
+    def prefill(self, input_ids: torch.LongTensor):
+        # appends to the full cache whatever its length, e.g. a suffix after a restored prefix
+        return self.prefill_planner.run(
+            lambda input_ids: self.model(input_ids=input_ids, kv_cache=self.kv_cache, graph_cache=None).logits,
+            input_ids,
+            start=self.kv_cache.seq_len,
+        )
+
     @torch.inference_mode()
     def model_run(self, input_ids: torch.LongTensor):
         if input_ids.shape[-1] > 64: # prefill
-            iter_prefill = math.ceil(input_ids.shape[1] / 128)
-            for i in range(iter_prefill):
-                logits = self.model(
-                    input_ids=input_ids[:, i*128:(i+1)*128],
-                    kv_cache=self.kv_cache,
-                    graph_cache=None,
-                ).logits
+            logits = self.prefill(input_ids)
         else: # verification
             logits = self.model(input_ids=input_ids, kv_cache=self.kv_cache, graph_cache=self.graph_cache).logits
         return logits
@@ -42,14 +56,11 @@ class InferenceEngine:
     @torch.inference_mode()
     def draft_run(self, input_ids: torch.LongTensor, gamma_offset: int=0, probs=False, temperature=0.6, top_p=0.9):
         if input_ids.shape[-1] > 64: # prefill
-            iter_prefill = math.ceil(input_ids.shape[1] / 64)
-            for i in range(iter_prefill):
-                self.draft_cache.evict_prefill(64)
-                logits = self.draft(
-                    input_ids=input_ids[:, i*64:(i+1)*64],
-                    kv_cache=self.draft_cache,
-                    graph_cache=None,
-                ).logits
+            logits = self.draft_prefill_planner.run(
+                lambda input_ids: self.draft(input_ids=input_ids, kv_cache=self.draft_cache, graph_cache=None).logits,
+                input_ids,
+                before_slice=self.draft_cache.evict_prefill,
+            )
         else: # decoding
             logits = self.draft(input_ids=input_ids, kv_cache=self.draft_cache, graph_cache=self.draft_cache, gamma_offset=gamma_offset).logits
 
@@ -132,9 +143,13 @@ class GraphInferenceEngine:
         self.engine = InferenceEngine(model, cache, graph_cache, draft, draft_cache)
         self.callables = {}
         self.mempool = None
+        self.profiler = NULL_PROFILER
 
     @torch.inference_mode()
-    def initialize_cuda_graph(self, gamma=6, probs=False, temperature=0.6, top_p=0.9):
+    def initialize_cuda_graph(self, gamma=6, probs=False, temperature=0.6, top_p=0.9, gammas=None):
+        # gammas: speculation lengths (<= gamma) to capture verify graphs for, e.g. for a GammaController
+        gammas = sorted(set(gammas or []) | {gamma})
+        assert gammas[-1] == gamma, f"captured gammas {gammas} exceed the cache gamma {gamma}"
         gc.collect()
         self.mempool = torch.cuda.graphs.graph_pool_handle()
         
@@ -151,15 +166,28 @@ class GraphInferenceEngine:
                                                 top_p=top_p
                                             )
 
-        self.callable_model_verify = model_verify_capture_graph(
+        self.verify_callables = {}
+        for g in gammas:
+            self.verify_callables[g] = model_verify_capture_graph(
                                         engine=self.engine,
                                         mempool=self.mempool,
                                         n_warmups=3,
-                                        gamma=gamma,
+                                        gamma=g,
                                         probs=probs,
                                         temperature=temperature,
                                         top_p=top_p
                                     )
+        self.callable_model_verify = self.verify_callables[gamma]
+
+        self.engine.clear_kv()
+
+    def initialize_eager(self, gamma=6, probs=False, temperature=0.6, top_p=0.9, gammas=None):
+        # same entry points as initialize_cuda_graph without capture, for CPU (tests, tiny models) or debugging
+        gammas = sorted(set(gammas or []) | {gamma})
+        for gamma_offset in range(gamma+3):
+            self.callables[gamma_offset] = lambda input_ids, gamma_offset=gamma_offset: self.engine.draft_run(input_ids=input_ids, gamma_offset=gamma_offset, probs=probs, temperature=temperature, top_p=top_p)
+        self.verify_callables = {g: lambda input_ids, position_ids: self.engine.model_verify(input_ids=input_ids, position_ids=position_ids, probs=probs, temperature=temperature, top_p=top_p) for g in gammas}
+        self.callable_model_verify = self.verify_callables[gamma]
 
         self.engine.clear_kv()
 
@@ -169,26 +197,42 @@ class GraphInferenceEngine:
     @torch.inference_mode()
     def graph_draft_inference(self, input_ids: torch.LongTensor, gamma_offset: int=0):
         # draft run
-        return self.callables[gamma_offset](input_ids)
+        with self.profiler.phase("draft_step"):
+            return self.callables[gamma_offset](input_ids)
     
     @torch.inference_mode()
     def graph_draft_prefill(self, input_ids: torch.LongTensor):
         # draft run
-        logits = self.engine.draft_run(input_ids=input_ids)
+        with self.profiler.phase("draft_prefill"):
+            logits = self.engine.draft_run(input_ids=input_ids)
         return logits
 
+    @torch.inference_mode()
+    def prefill(self, input_ids: torch.LongTensor):
+        # model prefill
+        with self.profiler.phase("target_prefill"):
+            return self.engine.prefill(input_ids=input_ids)
+
     @torch.inference_mode()
     def inference(self, input_ids: torch.LongTensor):
-        # model run
-        return self.engine.model_run(input_ids=input_ids)
+        # model run, an offloaded cache streams every layer once
+        with self.profiler.phase("target_forward", self.engine.offload_bytes):
+            return self.engine.model_run(input_ids=input_ids)
 
     @torch.inference_mode()
     def graph_verify(self, input_ids: torch.LongTensor, position_ids: torch.LongTensor):
         # model verify
-        return self.callable_model_verify(input_ids, position_ids)
+        with self.profiler.phase("retrieval_verify"):
+            return self.verify_callables[input_ids.shape[1] - 1](input_ids, position_ids)
 
     def init_graph_cache(self):
-        self.engine.graph_cache.init_graph_cache(kv_cache=self.engine.kv_cache)
+        with self.profiler.phase("init_graph_cache"):
+            self.engine.graph_cache.init_graph_cache(kv_cache=self.engine.kv_cache)
 
     def update_graph_cache(self):
-        self.engine.graph_cache.update_graph_cache(kv_cache=self.engine.kv_cache)
+        # the tail is read from the full cache, over pcie when it is offloaded
+        kv_cache = self.engine.kv_cache
+        graph_cache = self.engine.graph_cache
+        nbytes = self.engine.offload_bytes * (kv_cache.seq_len - graph_cache.retrieval_end) // kv_cache.max_budget
+        with self.profiler.phase("update_graph_cache", nbytes):
+            graph_cache.update_graph_cache(kv_cache=kv_cache)
@@ -1,6 +1,7 @@
 from sympy import symbols, Eq, solve
 from termcolor import colored
 import random
+import re
 
 def spec_stream(pred_token_idx, tokenizer, color='blue'):
     decoded_token = tokenizer.decode(
@@ -10,7 +11,7 @@ def spec_stream(pred_token_idx, tokenizer, color='blue'):
             # spaces_between_special_tokens=False,
         )
 
-    decoded_token = decoded_token.replace("<0x0A>", "\n")
+    decoded_token = decode_byte_tokens(decoded_token)
 
     print(colored(decoded_token, color), flush=True, end=" ")
 
@@ -20,6 +21,53 @@ def batch_spec_stream(pred_token_idx, tokenizer):
         spec_stream(pred_token_idx[i], tokenizer, color_list[i])
     print()
 
+BYTE_TOKENS = re.compile(r"(?:<0x[0-9A-Fa-f]{2}>)+")
+
+def decode_byte_tokens(text):
+    # SentencePiece byte-fallback pieces left as text (<0x0A>, runs of <0xE2><0x82><0xAC>) -> utf-8, incomplete runs -> \ufffd
+    return BYTE_TOKENS.sub(lambda m: bytes.fromhex(m.group(0).replace("<0x", "").replace(">", "")).decode("utf-8", errors="replace"), text)
+
+class IncrementalDetokenizer:
+    """
+    Turns a growing list of token ids into text deltas in O(lookback + new ids) per push. The last `lookback` emitted ids
+    are decoded again as context, so SentencePiece word boundaries come out right, and text ending in an incomplete
+    utf-8 sequence (byte-fallback tokens) is held back until it completes.
+    """
+    def __init__(self, tokenizer, skip_special_tokens=True, lookback=6) -> None:
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.lookback = lookback
+        self.ids = []
+        self.text = ""
+        self.read_offset = 0 # ids[read_offset:] are not emitted yet
+
+    def decode(self, ids):
+        text = self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens, clean_up_tokenization_spaces=False, spaces_between_special_tokens=False)
+        return decode_byte_tokens(text)
+
+    def delta(self, final=False):
+        start = max(self.read_offset - self.lookback, 0)
+        prefix = self.decode(self.ids[start:self.read_offset])
+        while not prefix and start > 0:
+            # the context decodes to nothing (special tokens), widen it so the leading space of the new ids survives
+            start = max(start - self.lookback, 0)
+            prefix = self.decode(self.ids[start:self.read_offset])
+        full = self.decode(self.ids[start:])
+        if not final and (len(full) <= len(prefix) or full.endswith("\ufffd")):
+            return ""
+        new_text = full[len(prefix):]
+        self.read_offset = len(self.ids)
+        self.text += new_text
+        return new_text
+
+    def push(self, ids):
+        self.ids.extend(ids)
+        return self.delta()
+
+    def flush(self):
+        # whatever is held back, incomplete utf-8 included
+        return self.delta(final=True)
+
 def log_csv(file_path, header, entry):
     try:
         with open(file_path, 'r') as f:
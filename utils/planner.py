@@ -0,0 +1,281 @@
+import json
+import math
+import argparse
+import itertools
+
+# Cost model and grid search over the knobs of TriForce with KV offloading (on_chip_layers, retrieval budget,
+# gamma, chunk_size, draft cache budget). Pure python, no device is needed: timings are modelled from bandwidths
+# or taken from measurements (Timings), acceptance rates from a table or a saturating curve (AcceptanceModel).
+# test/planner.py checks the model and the search on a synthetic configuration.
+#
+#   python utils/planner.py --config NousResearch/Yarn-Llama-2-7b-128k --prefill 130048 --world_size 2 --device_gb 24 --host_gb 128
+
+GB = 1024**3
+
+class HardwareSpec:
+    def __init__(self, device_memory=24 * GB, host_memory=128 * GB, hbm_bandwidth=900e9, pcie_bandwidth=20e9,
+            allreduce_latency=30e-6, layer_overhead=100e-6, topk_rate=10e9, reserve=0.1) -> None:
+        self.device_memory = device_memory # per rank
+        self.host_memory = host_memory # shared by all ranks
+        self.hbm_bandwidth = hbm_bandwidth
+        self.pcie_bandwidth = pcie_bandwidth # effective host to device, per rank
+        self.allreduce_latency = allreduce_latency # one small all-reduce
+        self.layer_overhead = layer_overhead # kernel launches of one eager layer
+        self.topk_rate = topk_rate # scored chunk summaries per second of a top-k chunk selection
+        self.reserve = reserve # share of device memory left to the allocator / fragmentation
+
+class Timings:
+    """
+    Measured step latencies (seconds), each overrides the modelled one when set:
+    draft_step (one 68m decoding step), retrieval_step ({budget: seconds} of one retrieval verify, interpolated
+    linearly) and target_layer (compute of one target layer in a verify, without the PCIe copy).
+    """
+    def __init__(self, draft_step=None, retrieval_step=None, target_layer=None) -> None:
+        self.draft_step = draft_step
+        self.retrieval_step = {int(b): t for b, t in (retrieval_step or {}).items()}
+        self.target_layer = target_layer
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+def interpolate(table, x, log=False):
+    # piecewise linear over the sorted keys of table, clamped at both ends
+    keys = sorted(table)
+    if x <= keys[0]:
+        return table[keys[0]]
+    if x >= keys[-1]:
+        return table[keys[-1]]
+    for lo, hi in zip(keys[:-1], keys[1:]):
+        if lo <= x <= hi:
+            f = (math.log(x) - math.log(lo)) / (math.log(hi) - math.log(lo)) if log else (x - lo) / (hi - lo)
+            return table[lo] + f * (table[hi] - table[lo])
+
+class AcceptanceModel:
+    """
+    Acceptance rates of the two speculation levels.
+
+    retrieval(budget, chunk_size): retrieval cache drafts against the full target. From the measured table
+    {chunk_size: {budget: rate}} (log-budget interpolation, nearest chunk size) or a saturating curve
+    a_max - (a_max - a_min) * exp(-budget / budget_scale), lowered by chunk_penalty per doubling of chunk_size over 8
+    (chunks under 8 get no credit without a table, so only their cost counts).
+    draft(draft_cache_budget): 68m StreamingLLM draft against the retrieval cache, table {budget: rate} or a constant.
+    The curve parameters are placeholders, measure the tables on the target workload.
+    """
+    def __init__(self, retrieval_table=None, draft_table=None, a_max=0.95, a_min=0.6, budget_scale=2048, chunk_penalty=0.01, draft_rate=0.7) -> None:
+        self.retrieval_table = {int(c): {int(b): r for b, r in t.items()} for c, t in (retrieval_table or {}).items()}
+        self.draft_table = {int(b): r for b, r in (draft_table or {}).items()}
+        self.a_max = a_max
+        self.a_min = a_min
+        self.budget_scale = budget_scale
+        self.chunk_penalty = chunk_penalty
+        self.draft_rate = draft_rate
+
+    @classmethod
+    def from_json(cls, path):
+        # {"retrieval": {chunk_size: {budget: rate}}, "draft": {draft_cache_budget: rate}}
+        with open(path) as f:
+            tables = json.load(f)
+        return cls(retrieval_table=tables.get("retrieval"), draft_table=tables.get("draft"))
+
+    def retrieval(self, budget, chunk_size):
+        if self.retrieval_table:
+            chunk = min(self.retrieval_table, key=lambda c: abs(math.log2(c) - math.log2(chunk_size)))
+            return interpolate(self.retrieval_table[chunk], budget, log=True)
+        rate = self.a_max - (self.a_max - self.a_min) * math.exp(-budget / self.budget_scale)
+        return rate - self.chunk_penalty * max(math.log2(chunk_size / 8), 0)
+
+    def draft(self, draft_cache_budget):
+        if self.draft_table:
+            return interpolate(self.draft_table, draft_cache_budget, log=True)
+        return self.draft_rate
+
+class CostModel:
+    """
+    Expected per token latency of TriForce_Dist for one configuration.
+
+    A round runs gamma / (1 + a_draft) middle iterations (one draft step and one retrieval verify, yielding
+    1 + a_draft tokens on average) and one target verify of the gamma + 1 tokens, which accepts
+    (1 - a^(gamma+1)) / (1 - a) tokens for retrieval acceptance a. Decoding is memory bound: a layer reads its
+    weights and its kv once. Offloaded layers overlap their PCIe copy with compute (DistributedKVPrefetcher),
+    so they take max(copy, compute).
+
+    Smaller chunks select the retrieval budget more precisely but cost chunk summaries (on chip for every layer
+    with refresh, one layer at a time otherwise) and top-k time: one selection after prefill, amortized over
+    gen_len, plus one per refresh_every rounds with refresh. The draft is replicated on every rank, its kv
+    is sized from draft_hidden / draft_layers.
+    """
+    def __init__(self, config, prefill, gen_len=256, hardware=None, acceptance=None, timings=None,
+            dtype_bytes=2, kv_bits=None, prefetch_depth=2, draft_params=68e6, draft_layers=2, draft_hidden=768,
+            refresh_every=None) -> None:
+        self.config = config # DistributedOffloadingConfig
+        self.prefill = prefill
+        self.gen_len = gen_len
+        self.hw = hardware if hardware is not None else HardwareSpec()
+        self.acceptance = acceptance if acceptance is not None else AcceptanceModel()
+        self.timings = timings if timings is not None else Timings()
+        self.elt = dtype_bytes
+        self.kv_bits = kv_bits
+        self.prefetch_depth = prefetch_depth
+        self.draft_bytes = draft_params * dtype_bytes
+        self.draft_layers = draft_layers
+        self.draft_token_bytes = 2 * draft_hidden * dtype_bytes # one token of one draft layer, every rank
+        self.refresh_every = refresh_every # rounds between retrieval refreshes, None without refresh
+
+        ws = config.world_size
+        hidden = config.hidden_size
+        head_dim = hidden // config.num_attention_heads
+        kv_dim = config.num_key_value_heads * head_dim // ws
+        self.kv_heads = config.num_key_value_heads // ws
+        self.layers = config.num_hidden_layers
+        self.layer_bytes = (2 * hidden * hidden // ws + 2 * hidden * kv_dim + 3 * hidden * config.intermediate_size // ws) * dtype_bytes
+        self.embed_bytes = 2 * config.vocab_size * hidden * dtype_bytes # embedding and lm_head, replicated
+        self.kv_token_bytes = 2 * kv_dim * dtype_bytes # one token of one layer on chip
+        # offloaded values keep a scale and zero per head, keys per channel of every 32 tokens (KEY_GROUP of models/kv_quant.py)
+        self.offload_token_bytes = self.kv_token_bytes if kv_bits is None else 2 * kv_dim * kv_bits // 8 + 2 * (kv_dim // head_dim + kv_dim / 32) * dtype_bytes
+        self.act_bytes = 1.5 * (2 * hidden * (dtype_bytes + 4) + 4 * hidden // ws * dtype_bytes + 3 * config.intermediate_size // ws * dtype_bytes + config.vocab_size * (dtype_bytes + 4))
+        self.max_len = prefill + gen_len
+
+    def summary_bytes(self, chunk_size):
+        # key summaries of every chunk, kept for all layers only to refresh the selection
+        layers = self.layers if self.refresh_every is not None else 1
+        return layers * (self.max_len // chunk_size) * self.kv_token_bytes / 2
+
+    def memory(self, on_chip, budget, gamma, draft_cache_budget, chunk_size=8, slice_len=128):
+        # device bytes per rank and host bytes of all ranks
+        device = (self.layers * self.layer_bytes + self.embed_bytes + self.draft_bytes
+            + on_chip * self.max_len * self.kv_token_bytes
+            + (self.prefetch_depth * self.max_len * self.kv_token_bytes if on_chip < self.layers else 0)
+            + self.layers * (budget + gamma + 1) * self.kv_token_bytes
+            + self.summary_bytes(chunk_size)
+            + self.draft_layers * draft_cache_budget * self.draft_token_bytes
+            + slice_len * self.act_bytes)
+        host = (self.layers - on_chip) * self.max_len * self.offload_token_bytes * self.config.world_size
+        return device, host
+
+    def fits(self, on_chip, budget, gamma, draft_cache_budget, chunk_size=8):
+        device, host = self.memory(on_chip, budget, gamma, draft_cache_budget, chunk_size)
+        return device <= (1 - self.hw.reserve) * self.hw.device_memory and host <= self.hw.host_memory
+
+    def allreduce_time(self, layers):
+        return 0.0 if self.config.world_size == 1 else 2 * layers * self.hw.allreduce_latency
+
+    def target_layer_time(self):
+        if self.timings.target_layer is not None:
+            return self.timings.target_layer
+        return (self.layer_bytes + self.prefill * self.kv_token_bytes) / self.hw.hbm_bandwidth + self.hw.layer_overhead
+
+    def target_time(self, on_chip):
+        compute = self.target_layer_time()
+        copy = self.prefill * self.offload_token_bytes / self.hw.pcie_bandwidth
+        return (on_chip * compute + (self.layers - on_chip) * max(copy, compute)
+            + self.embed_bytes / 2 / self.hw.hbm_bandwidth + self.allreduce_time(self.layers))
+
+    def retrieval_time(self, budget):
+        if self.timings.retrieval_step:
+            return interpolate(self.timings.retrieval_step, budget)
+        return (self.layers * ((self.layer_bytes + budget * self.kv_token_bytes) / self.hw.hbm_bandwidth + self.hw.layer_overhead)
+            + self.embed_bytes / 2 / self.hw.hbm_bandwidth + self.allreduce_time(self.layers))
+
+    def draft_time(self, draft_cache_budget):
+        if self.timings.draft_step is not None:
+            return self.timings.draft_step
+        return (self.draft_bytes + self.draft_layers * draft_cache_budget * self.draft_token_bytes) / self.hw.hbm_bandwidth + self.draft_layers * self.hw.layer_overhead
+
+    def selection_time(self, chunk_size):
+        # score every chunk summary of the prefill against the query and take the top-k, every layer
+        chunks = self.prefill // chunk_size
+        return self.layers * (chunks * self.kv_token_bytes / 2 / self.hw.hbm_bandwidth + chunks * self.kv_heads / self.hw.topk_rate)
+
+    def evaluate(self, on_chip, budget, gamma, chunk_size, draft_cache_budget):
+        a_draft = self.acceptance.draft(draft_cache_budget)
+        a = min(self.acceptance.retrieval(budget, chunk_size), 1 - 1e-6)
+        iterations = gamma / (1 + a_draft)
+        middle = iterations * (self.draft_time(draft_cache_budget) + self.retrieval_time(budget))
+        target = self.target_time(on_chip)
+        selection = self.selection_time(chunk_size)
+        refresh = selection / self.refresh_every if self.refresh_every is not None else 0.0
+        tokens = (1 - a ** (gamma + 1)) / (1 - a)
+        device, host = self.memory(on_chip, budget, gamma, draft_cache_budget, chunk_size)
+        return {
+            "on_chip": on_chip, "budget": budget, "gamma": gamma, "chunk_size": chunk_size, "draft_cache_budget": draft_cache_budget,
+            "latency": (middle + target + refresh) / tokens + selection / self.gen_len, "tokens_per_round": tokens,
+            "middle_time": middle, "target_time": target, "selection_time": selection,
+            "acceptance": a, "draft_acceptance": a_draft, "device_bytes": device, "host_bytes": host,
+        }
+
+def grid_edges(result, **grid):
+    # knobs whose best value is the first or last of a searched grid of more than one value
+    return [name for name, values in grid.items() if len(values) > 1 and result[name] in (min(values), max(values))]
+
+def search(model: CostModel, on_chip=None, budgets=(2048, 4096, 6144, 8192, 12288, 16384), gammas=range(2, 25),
+        chunk_sizes=(4, 8, 16), draft_cache_budgets=None, draft_cache_budget=256, top=5):
+    """
+    Grid search of the configuration with the lowest expected per token latency that fits the device and host memory.
+    The draft cache budget only changes the draft acceptance through a measured draft table: without one it stays
+    at draft_cache_budget, with one the default grid is the budgets of the table. Warns when the best budget,
+    gamma or chunk size is on the edge of its grid, the optimum may lie outside.
+    Returns the best `top` configurations, best first ([] if nothing fits).
+    """
+    on_chip = range(model.layers + 1) if on_chip is None else on_chip
+    if draft_cache_budgets is None:
+        draft_cache_budgets = sorted(model.acceptance.draft_table) or [draft_cache_budget]
+    results = []
+    for b, c, g, d in itertools.product(budgets, chunk_sizes, gammas, draft_cache_budgets):
+        if b % c != 0 or model.prefill % c != 0 or b > model.prefill:
+            continue
+        # latency falls with every layer moved on chip, take the most that fit
+        fitting = [n for n in on_chip if model.fits(n, b, g, d, c)]
+        if fitting:
+            results.append(model.evaluate(max(fitting), b, g, c, d))
+    results = sorted(results, key=lambda r: r["latency"])[:top]
+    if results:
+        grid = {"budget": budgets, "gamma": gammas, "chunk_size": chunk_sizes, "draft_cache_budget": draft_cache_budgets}
+        for name in grid_edges(results[0], **grid):
+            print(f"[Planner] warning: best {name} {results[0][name]} is on the edge of the searched grid ({min(grid[name])} .. {max(grid[name])}), widen it")
+    return results
+
+def print_plan(results):
+    if not results:
+        print("[Planner] no configuration fits the memory")
+        return
+    for i, r in enumerate(results):
+        print(f"[Planner] #{i} --on_chip {r['on_chip']} --budget {r['budget']} --gamma {r['gamma']} --chunk_size {r['chunk_size']} --draft_cache_budget {r['draft_cache_budget']} | "
+            f"{1000 * r['latency']:.2f} ms/token | {r['tokens_per_round']:.2f} tokens/round (acc {r['acceptance']:.3f}, draft acc {r['draft_acceptance']:.3f}) | "
+            f"middle {1000 * r['middle_time']:.1f} ms, target {1000 * r['target_time']:.1f} ms | device {r['device_bytes'] / GB:.2f} GB, host {r['host_bytes'] / GB:.2f} GB")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='args for planner.py')
+    parser.add_argument('--config', type=str, required=True, help='model name / directory or config.json of the target')
+    parser.add_argument('--prefill', type=int, default=130048, help='prefill length')
+    parser.add_argument('--gen_len', type=int, default=256, help='generation length')
+    parser.add_argument('--world_size', type=int, default=1, help='tensor parallel ranks')
+    parser.add_argument('--device_gb', type=float, default=24, help='device memory per rank (GB)')
+    parser.add_argument('--host_gb', type=float, default=128, help='host memory (GB)')
+    parser.add_argument('--pcie_gbps', type=float, default=20, help='effective host to device bandwidth per rank (GB/s)')
+    parser.add_argument('--hbm_gbps', type=float, default=900, help='device memory bandwidth (GB/s)')
+    parser.add_argument('--kv_bits', type=int, default=None, choices=[4, 8], help='offloaded kv stored as int8 / int4')
+    parser.add_argument('--refresh_every', type=int, default=None, help='rounds between retrieval refreshes (default: no refresh)')
+    parser.add_argument('--draft_hidden', type=int, default=768, help='hidden size of the draft')
+    parser.add_argument('--timings', type=str, default=None, help='json of measured step latencies (Timings)')
+    parser.add_argument('--acceptance', type=str, default=None, help='json of measured acceptance tables (AcceptanceModel)')
+    parser.add_argument('--top', type=int, default=5, help='configurations to print')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    import os
+    import sys
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from models.config_yarn import LlamaConfig
+    from models.TP_layers import DistributedOffloadingConfig
+
+    args = parse_arguments()
+    model_config = LlamaConfig.from_json_file(args.config) if args.config.endswith(".json") else LlamaConfig.from_pretrained(args.config)
+    config = DistributedOffloadingConfig(model_config, 0, args.world_size)
+    hardware = HardwareSpec(device_memory=args.device_gb * GB, host_memory=args.host_gb * GB, hbm_bandwidth=args.hbm_gbps * 1e9, pcie_bandwidth=args.pcie_gbps * 1e9)
+    model = CostModel(config, args.prefill, gen_len=args.gen_len, hardware=hardware, kv_bits=args.kv_bits,
+        draft_hidden=args.draft_hidden, refresh_every=args.refresh_every,
+        acceptance=AcceptanceModel.from_json(args.acceptance) if args.acceptance else None,
+        timings=Timings.from_json(args.timings) if args.timings else None)
+    print_plan(search(model, top=args.top))
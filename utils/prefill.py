@@ -0,0 +1,131 @@
+import time
+import torch
+import torch.distributed as dist
+
+class PrefillPlanner:
+    """
+    Chooses the slice sizes used to prefill a prompt, instead of fixed 128 / 64 token slices.
+
+    A slice of s tokens written at kv length L needs about
+        s * act_bytes        hidden states, q / k / v, the MLP intermediate and the float logits
+        s * (L + s) * attn_bytes   attention workspace (0 with flash attention, 2 / 4 with a mask / scores)
+    on top of the caches that are already allocated. Every slice takes the largest multiple of
+    `multiple` (between min_slice and max_slice) that fits into the free device memory minus `reserve`.
+    With offloading, every slice streams offload_bytes of KV over PCIe, so the default cap is raised
+    to trade memory for fewer round trips. Without a device the plan only follows max_slice.
+    """
+    def __init__(self, hidden_size, intermediate_size, vocab_size, num_heads, world_size=1, dtype=torch.float16,
+            attn_bytes=0, offload_bytes=0, multiple=128, min_slice=128, max_slice=None, reserve=0.1, overhead=1.5,
+            device=None, distributed=False) -> None:
+
+        self.elt = torch.tensor([], dtype=dtype).element_size()
+        local_hidden = hidden_size // world_size
+        # residual + normed hidden (fp16 + fp32 norm), q / k / v / attn out, gate / up / act, logits (fp16 + fp32)
+        self.act_bytes = overhead * (
+            2 * hidden_size * (self.elt + 4)
+            + 4 * local_hidden * self.elt
+            + 3 * (intermediate_size // world_size) * self.elt
+            + vocab_size * (self.elt + 4)
+        )
+        self.attn_bytes = attn_bytes * (num_heads // world_size)
+        self.offload_bytes = offload_bytes
+
+        self.multiple = multiple
+        self.min_slice = min_slice
+        if max_slice is None:
+            max_slice = 16384 if offload_bytes > 0 else 4096
+        self.max_slice = max(max_slice, min_slice)
+        self.reserve = reserve
+        self.device = device
+        self.distributed = distributed
+
+        self.last_plan = None
+        self.timings = []
+
+    @classmethod
+    def from_config(cls, config, world_size=1, **kwargs):
+        return cls(config.hidden_size, config.intermediate_size, config.vocab_size, config.num_attention_heads, world_size=world_size, **kwargs)
+
+    def memory_budget(self):
+        if self.device is None or torch.device(self.device).type != 'cuda':
+            return None
+        free, total = torch.cuda.mem_get_info(self.device)
+        # blocks held by the caching allocator but unused are free for the slice as well
+        free += torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        budget = free - self.reserve * total
+        if self.distributed and dist.is_initialized():
+            # every rank has to run the same slices
+            budget = torch.tensor([budget], dtype=torch.float64, device=self.device)
+            dist.all_reduce(budget, dist.ReduceOp.MIN)
+            budget = budget.item()
+        return budget
+
+    def slice_bytes(self, s, kv_len):
+        return s * self.act_bytes + s * (kv_len + s) * self.attn_bytes
+
+    def fit(self, budget, kv_len, max_slice):
+        s = max_slice // self.multiple * self.multiple
+        if budget is None:
+            return max(s, self.min_slice)
+        while s > self.min_slice and self.slice_bytes(s, kv_len) > budget:
+            s -= self.multiple
+        return max(s, self.min_slice)
+
+    def plan(self, total_len, start=0, max_slice=None):
+        max_slice = self.max_slice if max_slice is None else min(self.max_slice, max_slice)
+        budget = self.memory_budget()
+        slices = []
+        pos = 0
+        while pos < total_len:
+            s = min(self.fit(budget, start + pos, max_slice), total_len - pos)
+            slices.append(s)
+            pos += s
+
+        self.last_plan = {
+            "tokens": total_len,
+            "start": start,
+            "budget": budget,
+            "slices": slices,
+            "peak_bytes": max(self.slice_bytes(s, start + sum(slices[:i+1]) - s) for i, s in enumerate(slices)) if slices else 0,
+            "offload_bytes": self.offload_bytes * len(slices),
+        }
+        return slices
+
+    def synchronize(self):
+        if self.device is not None and torch.device(self.device).type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def run(self, forward, input_ids, start=0, max_slice=None, before_slice=None):
+        """
+        Prefill input_ids slice by slice with forward(input_ids_slice) and time every slice.
+        before_slice(s) is called ahead of a slice of s tokens (e.g. draft cache eviction).
+        Returns the logits of the last slice.
+        """
+        slices = self.plan(input_ids.shape[1], start=start, max_slice=max_slice)
+        self.timings = []
+        offset = 0
+        logits = None
+        for s in slices:
+            if before_slice is not None:
+                before_slice(s)
+            self.synchronize()
+            t1 = time.perf_counter()
+            logits = forward(input_ids[:, offset:offset+s])
+            self.synchronize()
+            self.timings.append(time.perf_counter() - t1)
+            offset += s
+        return logits
+
+    def report(self):
+        report = dict(self.last_plan or {})
+        report["timings"] = list(self.timings)
+        report["total_time"] = sum(self.timings)
+        return report
+
+    def print_plan(self):
+        report = self.report()
+        if not report.get("slices"):
+            print("[Prefill Planner] no plan")
+            return
+        budget = "n/a" if report["budget"] is None else f"{report['budget'] / 1024**3:.2f} GB"
+        print(f"[Prefill Planner] Tokens: {report['tokens']} | Slices: {len(report['slices'])} (max {max(report['slices'])}) | Budget: {budget} | Peak Estimate: {report['peak_bytes'] / 1024**3:.2f} GB | Offload Traffic: {report['offload_bytes'] / 1024**3:.2f} GB | Time: {report['total_time']:.3f} s")
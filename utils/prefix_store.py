@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import torch
+import torch.distributed as dist
+
+_NUMPY_DTYPES = {
+    torch.float16: np.float16,
+    torch.float32: np.float32,
+    torch.uint8: np.uint8,
+    torch.bfloat16: np.int16, # stored as raw 16-bit words
+}
+
+class PrefixKVStore:
+    """
+    Content-addressed store of prefilled KV caches in memory-mapped files on local disk.
+
+    An entry holds the cache state (cache.prefix_state) of a token prefix whose length is a multiple
+    of block_size. Prefixes are addressed by a hash chain over their blocks, seeded with the namespace
+    and the cache layout, and every block boundary of an entry is registered, so a prompt sharing only
+    the first k blocks of a stored prefix restores those k blocks. Entries are evicted least recently
+    used first once the stored bytes exceed max_bytes.
+
+    Use one namespace per model (and per tensor-parallel rank) sharing the same root.
+    """
+    def __init__(self, root, max_bytes, block_size=1024, namespace="") -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.namespace = namespace
+        os.makedirs(root, exist_ok=True)
+
+        self.index_path = os.path.join(root, f"index{'-' + namespace if namespace else ''}.json")
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)["entries"]
+        # drop entries whose files are gone
+        self.entries = {eid: e for eid, e in self.entries.items() if os.path.isdir(self.entry_dir(eid))}
+        self.rebuild_hash_index()
+
+        self.hits = 0
+        self.misses = 0
+        self.restored_tokens = 0
+
+    def entry_dir(self, eid):
+        return os.path.join(self.root, eid)
+
+    def rebuild_hash_index(self):
+        # boundary hash --> (entry id, prefix length), the longest entry wins
+        self.hash_index = {}
+        for eid, entry in self.entries.items():
+            for i, h in enumerate(entry["hashes"]):
+                length = (i + 1) * self.block_size
+                if h not in self.hash_index or self.entries[self.hash_index[h][0]]["length"] < entry["length"]:
+                    self.hash_index[h] = (eid, length)
+
+    def flush(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"entries": self.entries}, f)
+        os.replace(tmp, self.index_path)
+
+    @property
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def signature(self, cache):
+        # layout of one block of cache state, so caches of other shapes / dtypes never match
+        state = cache.prefix_state(self.block_size)
+        return ";".join(f"{name}:{tuple(t.shape)}:{t.dtype}" for name, t in sorted(state.items()))
+
+    def block_hashes(self, cache, tokens):
+        tokens = tokens.flatten().cpu().numpy().astype(np.int64)
+        h = hashlib.blake2b(f"{self.namespace}|{self.signature(cache)}".encode(), digest_size=16)
+        hashes = []
+        for i in range(len(tokens) // self.block_size):
+            h = h.copy()
+            h.update(tokens[i*self.block_size:(i+1)*self.block_size].tobytes())
+            hashes.append(h.hexdigest())
+        return hashes
+
+    def lookup(self, cache, tokens):
+        # longest stored prefix of tokens, (entry id, length) or (None, 0)
+        for h in reversed(self.block_hashes(cache, tokens)):
+            if h in self.hash_index:
+                return self.hash_index[h]
+        return None, 0
+
+    def load(self, eid):
+        state = {}
+        for name, meta in self.entries[eid]["tensors"].items():
+            dtype = getattr(torch, meta["dtype"])
+            if 0 in meta["shape"]:
+                state[name] = torch.empty(meta["shape"], dtype=dtype)
+                continue
+            array = np.load(os.path.join(self.entry_dir(eid), f"{name}.npy"), mmap_mode="c")
+            tensor = torch.from_numpy(array)
+            state[name] = tensor.view(dtype) if dtype == torch.bfloat16 else tensor
+        return state
+
+    @torch.inference_mode()
+    def restore(self, cache, tokens, device=None, distributed=False):
+        """
+        Load the longest stored prefix of tokens into cache and return its length (0 on a miss).
+        With distributed=True all ranks restore the same (shortest) length.
+        """
+        eid, length = self.lookup(cache, tokens)
+        if distributed and dist.is_initialized():
+            length = torch.tensor([length], dtype=torch.long, device=device)
+            dist.all_reduce(length, dist.ReduceOp.MIN)
+            length = length.item()
+
+        if length == 0:
+            self.misses += 1
+            return 0
+
+        cache.load_prefix(self.load(eid), length)
+        self.entries[eid]["last_used"] = time.time()
+        self.flush()
+        self.hits += 1
+        self.restored_tokens += length
+        return length
+
+    @torch.inference_mode()
+    def save(self, cache, tokens):
+        """
+        Store the block-aligned prefix of tokens held by cache (cache.seq_len >= len(tokens)).
+        Returns the stored length, 0 if it is already stored or does not fit.
+        """
+        hashes = self.block_hashes(cache, tokens)
+        length = len(hashes) * self.block_size
+        if length == 0 or self.hash_index.get(hashes[-1], (None, 0))[1] >= length:
+            return 0
+
+        state = cache.prefix_state(length)
+        nbytes = sum(t.numel() * t.element_size() for t in state.values())
+        if nbytes > self.max_bytes:
+            return 0
+
+        # entries covered by the new prefix are superseded
+        for eid in [eid for eid, e in self.entries.items() if e["hashes"][-1] in hashes]:
+            self.evict(eid)
+        while self.entries and self.total_bytes + nbytes > self.max_bytes:
+            self.evict(min(self.entries, key=lambda eid: self.entries[eid]["last_used"]))
+
+        eid = hashes[-1]
+        os.makedirs(self.entry_dir(eid), exist_ok=True)
+        tensors = {}
+        for name, t in state.items():
+            tensors[name] = {"shape": list(t.shape), "dtype": str(t.dtype).replace("torch.", "")}
+            if t.numel() == 0:
+                continue
+            array = np.lib.format.open_memmap(os.path.join(self.entry_dir(eid), f"{name}.npy"), mode="w+", dtype=_NUMPY_DTYPES[t.dtype], shape=tuple(t.shape))
+            target = torch.from_numpy(array)
+            if t.dtype == torch.bfloat16:
+                target = target.view(torch.bfloat16)
+            # layer by layer, straight from the cache into the mapped file
+            for i in range(t.shape[0]):
+                target[i].copy_(t[i])
+            array.flush()
+            del array, target
+
+        self.entries[eid] = {"length": length, "bytes": nbytes, "last_used": time.time(), "hashes": hashes, "tensors": tensors}
+        self.rebuild_hash_index()
+        self.flush()
+        return length
+
+    def evict(self, eid):
+        shutil.rmtree(self.entry_dir(eid), ignore_errors=True)
+        del self.entries[eid]
+        self.rebuild_hash_index()
+
+    def print_status(self):
+        print(f"[Prefix KV Store] Entries: {len(self.entries)} | Stored: {self.total_bytes / 1024**3:.2f} / {self.max_bytes / 1024**3:.2f} GB | Block Size: {self.block_size} | Hits: {self.hits} | Misses: {self.misses} | Restored Tokens: {self.restored_tokens}")
@@ -0,0 +1,208 @@
+import json
+import time
+import numpy as np
+import torch
+
+class Phase:
+    # one timed region, see Profiler.phase
+    __slots__ = ("profiler", "name", "nbytes", "start", "start_event", "end_event")
+
+    def __init__(self, profiler, name, nbytes) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        if self.profiler.use_events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        end_event = None
+        if self.profiler.use_events:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+        self.profiler.record(self.name, self.start, end, self.start_event if self.profiler.use_events else None, end_event, self.nbytes)
+        return False
+
+class Profiler:
+    """
+    Opt-in profiler of the decoding hot path.
+
+    `with profiler.phase(name, nbytes):` times a region on the host (perf_counter) and, on CUDA, on the
+    device (CUDA events, resolved lazily in summary / export, so recording never syncs). Nested phases are
+    allowed. `count(name, n)` accumulates counters such as accepted tokens per level and `add_bytes`
+    attributes moved bytes to a phase. Results go to summary(), JSON (to_json) or a Chrome trace
+    (to_chrome_trace, open in chrome://tracing or Perfetto).
+    """
+    def __init__(self, device=None, max_events=1000000) -> None:
+        self.use_events = device is not None and torch.device(device).type == 'cuda' and torch.cuda.is_available()
+        self.max_events = max_events
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.events = [] # (name, host start, host end, start event, end event)
+        self.bytes = {}
+        self.counters = {}
+        self.origin = time.perf_counter()
+        self.origin_event = None
+        if self.use_events:
+            self.origin_event = torch.cuda.Event(enable_timing=True)
+            self.origin_event.record()
+
+    def phase(self, name, nbytes=0):
+        return Phase(self, name, nbytes)
+
+    def record(self, name, start, end, start_event, end_event, nbytes):
+        if len(self.events) < self.max_events:
+            self.events.append((name, start, end, start_event, end_event))
+        if nbytes:
+            self.add_bytes(name, nbytes)
+
+    def add_bytes(self, name, nbytes):
+        self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def resolve(self):
+        # (name, host start ms, host ms, device start ms or None, device ms or None) of every event
+        if self.use_events:
+            torch.cuda.synchronize()
+        resolved = []
+        for name, start, end, start_event, end_event in self.events:
+            device_start = device_ms = None
+            if start_event is not None:
+                device_start = self.origin_event.elapsed_time(start_event)
+                device_ms = start_event.elapsed_time(end_event)
+            resolved.append((name, 1000 * (start - self.origin), 1000 * (end - start), device_start, device_ms))
+        return resolved
+
+    @staticmethod
+    def histogram(samples):
+        # log2 buckets in microseconds: {"<=1us": n, "<=2us": n, ...}
+        buckets = {}
+        for ms in samples:
+            edge = 2 ** max(0, int(np.ceil(np.log2(max(ms * 1000, 1e-9)))))
+            buckets[edge] = buckets.get(edge, 0) + 1
+        return {f"<={edge}us": buckets[edge] for edge in sorted(buckets)}
+
+    @staticmethod
+    def stats(samples):
+        samples = np.array(samples)
+        return {
+            "total_ms": float(samples.sum()),
+            "mean_ms": float(samples.mean()),
+            "p50_ms": float(np.percentile(samples, 50)),
+            "p90_ms": float(np.percentile(samples, 90)),
+            "p99_ms": float(np.percentile(samples, 99)),
+            "max_ms": float(samples.max()),
+            "histogram": Profiler.histogram(samples),
+        }
+
+    def summary(self):
+        host, device = {}, {}
+        for name, _, host_ms, _, device_ms in self.resolve():
+            host.setdefault(name, []).append(host_ms)
+            if device_ms is not None:
+                device.setdefault(name, []).append(device_ms)
+        phases = {}
+        for name, samples in host.items():
+            phases[name] = {"calls": len(samples), "host": self.stats(samples), "bytes": self.bytes.get(name, 0)}
+            if name in device:
+                phases[name]["device"] = self.stats(device[name])
+        return {"phases": phases, "counters": dict(self.counters), "bytes": dict(self.bytes)}
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_chrome_trace(self, path):
+        # host regions on thread 0, device regions on thread 1, in microseconds
+        trace = []
+        for name, host_start, host_ms, device_start, device_ms in self.resolve():
+            trace.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": 1000 * host_start, "dur": 1000 * host_ms, "args": {"bytes": self.bytes.get(name, 0)}})
+            if device_ms is not None:
+                trace.append({"name": name, "ph": "X", "pid": 0, "tid": 1, "ts": 1000 * device_start, "dur": 1000 * device_ms})
+        trace.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "host"}})
+        trace.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": 1, "args": {"name": "device"}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms", "counters": self.counters}, f)
+
+    def print_summary(self):
+        summary = self.summary()
+        print("[Profiler]", " | ".join(f"{k}: {v}" for k, v in summary["counters"].items()))
+        for name, phase in sorted(summary["phases"].items(), key=lambda item: -item[1]["host"]["total_ms"]):
+            line = f"  {name:<22} calls {phase['calls']:>6} | host total {phase['host']['total_ms']:9.2f} ms, p50 {phase['host']['p50_ms']:.3f}, p99 {phase['host']['p99_ms']:.3f}"
+            if "device" in phase:
+                line += f" | device total {phase['device']['total_ms']:9.2f} ms, p50 {phase['device']['p50_ms']:.3f}, p99 {phase['device']['p99_ms']:.3f}"
+            if phase["bytes"]:
+                line += f" | {phase['bytes'] / 1024**2:.2f} MB"
+            print(line)
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class NullProfiler:
+    # the disabled profiler, every call is a no-op
+    enabled = False
+
+    def phase(self, name, nbytes=0):
+        return _NULL_PHASE
+
+    def add_bytes(self, name, nbytes):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def reset(self):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
+class CollectiveCounter:
+    """
+    Counts the torch.distributed collectives issued while installed (calls per name and tensor bytes).
+    Callers look the collectives up at call time (dist.all_reduce), so wrapping the module attributes sees them all.
+    """
+    NAMES = ("all_reduce", "broadcast", "barrier", "all_gather", "all_gather_into_tensor", "reduce_scatter_tensor")
+
+    def __init__(self, names=NAMES) -> None:
+        import torch.distributed as dist
+        self.dist = dist
+        self.originals = {name: getattr(dist, name) for name in names}
+        for name, fn in self.originals.items():
+            setattr(dist, name, self.wrap(name, fn))
+        self.reset()
+
+    def wrap(self, name, fn):
+        def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if args and torch.is_tensor(args[0]):
+                self.bytes += args[0].numel() * args[0].element_size()
+            return fn(*args, **kwargs)
+        return counted
+
+    def reset(self):
+        self.calls = {}
+        self.bytes = 0
+
+    def total(self, names=None):
+        return sum(n for name, n in self.calls.items() if names is None or name in names)
+
+    def restore(self):
+        for name, fn in self.originals.items():
+            setattr(self.dist, name, fn)
@@ -0,0 +1,93 @@
+import time
+import numpy as np
+import torch
+
+class RetrievalRefreshPolicy:
+    """
+    Decides when the retrieval draft cache re-selects its chunks during decoding.
+
+    A refresh is triggered when any enabled condition holds:
+        every (int): at least `every` tokens were committed since the last refresh.
+        acc_threshold (float): the mean middle acceptance rate of the last `window` rounds fell below it.
+        the recent-token tail is about to overwrite the first selected chunk (always enabled).
+    """
+    def __init__(self, every=None, acc_threshold=None, window=8, verbose=False) -> None:
+        self.every = every
+        self.acc_threshold = acc_threshold
+        self.window = window
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.round = 0
+        self.tokens_since = 0
+        self.acc_history = []
+        self.last_refresh_round = 0
+        self.events = []
+
+    def reason(self, graph_cache, kv_cache):
+        tail = graph_cache.tail_len(kv_cache)
+        if tail + graph_cache.gamma + 2 > graph_cache.max_budget - graph_cache.chunk_size:
+            return "overflow"
+        if self.every is not None and self.tokens_since >= self.every:
+            return "interval"
+        if self.acc_threshold is not None and self.round - self.last_refresh_round >= self.window:
+            if np.mean(self.acc_history[-self.window:]) < self.acc_threshold:
+                return "acceptance"
+        return None
+
+    def step(self, graph_cache, kv_cache, accepted, acc_rate_middle, position):
+        """
+        Record one speculation round and refresh `graph_cache` if needed.
+
+        Args:
+            accepted (int): tokens committed to `kv_cache` in this round.
+            acc_rate_middle (float): acceptance rate of the middle level in this round.
+            position (int): index of the last committed token in the verified sequence.
+        """
+        self.round += 1
+        self.tokens_since += accepted
+        self.acc_history.append(acc_rate_middle)
+
+        for event in self.events:
+            if event["acc_after"] is None and self.round - event["round"] >= self.window:
+                event["acc_after"] = float(np.mean(self.acc_history[event["round"]:event["round"] + self.window]))
+
+        reason = self.reason(graph_cache, kv_cache)
+        if reason is None:
+            return None
+
+        device = graph_cache.key_cache.device
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t1 = time.time()
+        graph_cache.refresh(kv_cache, position)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t2 = time.time()
+
+        event = {
+            "round": self.round,
+            "reason": reason,
+            "seq_len": kv_cache.seq_len,
+            "cost": t2 - t1,
+            "acc_before": float(np.mean(self.acc_history[-self.window:])),
+            "acc_after": None,
+        }
+        self.events.append(event)
+        self.tokens_since = 0
+        self.last_refresh_round = self.round
+
+        if self.verbose:
+            print(f"\n[Retrieval Refresh] round {self.round} ({reason}), seq_len {kv_cache.seq_len}, cost {1000 * (t2 - t1):.2f} ms, acc before {event['acc_before']:.3f}")
+        return event
+
+    def summary(self):
+        for event in self.events:
+            if event["acc_after"] is None and self.round > event["round"]:
+                event["acc_after"] = float(np.mean(self.acc_history[event["round"]:]))
+        return {
+            "refreshes": len(self.events),
+            "total_cost": sum(event["cost"] for event in self.events),
+            "events": self.events,
+        }
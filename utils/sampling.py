@@ -4,6 +4,7 @@ from torch.nn import functional as F
 # copy from https://github.com/LeeSinLiang/microGPT/blob/ed40cf9780dbeb180adfe94c227d4aa97e69250e/gpt.py
 def top_k_top_p_filter(logits: torch.Tensor, top_k: int = 0, top_p: float = 0.0):
     """
+    Sort-based reference of filter_probs, kept for test/sampling_bench.py.
 
     Args:
         logits (torch.Tensorpe_): 2D tensor with shape (batch, vocab)
@@ -26,44 +27,90 @@ def top_k_top_p_filter(logits: torch.Tensor, top_k: int = 0, top_p: float = 0.0)
         logits[indices_to_remove] = float('-inf')
     return logits
 
-def get_sampling_logits(logits :torch.Tensor, top_p:float, T: float, replicate = False):
-    if replicate:
-        logits = logits.clone()
-    if top_p < 1.0:
-                sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-                cumulative_probs = torch.cumsum(
-                torch.nn.functional.softmax(sorted_logits / T, dim=-1), dim=-1)
-                filter = cumulative_probs > top_p
-                filter[..., 1:] = filter[..., :-1].clone()
-                filter[..., 0] = 0
-                indices_to_remove = filter.scatter(-1, sorted_indices, filter)
-                logits[indices_to_remove] = float('-inf')
-    return logits
+def top_p_threshold(probs: torch.Tensor, top_p: float):
+    """
+    Sort-free nucleus threshold, batched over rows and without host syncs (CUDA graph safe).
+
+    The smallest set of tokens whose mass reaches top_p is {probs >= t}, t the largest value with mass(probs >= t) >= top_p.
+    Non-negative float32 values order like their int32 bit patterns, so t is found byte by byte: every pass scatter-adds
+    the mass of the 256 values of the next byte among the tokens that match the bytes found so far, and keeps the byte
+    where the suffix mass crosses top_p. After 4 passes t is exact; masses are summed in float64 so that rounding does
+    not move the cutoff (test/sampling_bench.py checks against a float64 sort). Ties at t are all kept, the sort-based
+    filter keeps them in sort order.
+
+    Args:
+        probs (torch.Tensor): (rows, vocab) float32 probabilities
+        top_p (float): nucleus mass in (0, 1)
+
+    Returns:
+        torch.Tensor: (rows, 1) threshold
+    """
+    rows = probs.shape[0]
+    bits = probs.float().view(torch.int32).long()
+    mass = probs.double()
+    t = torch.zeros(rows, 1, dtype=torch.long, device=probs.device)
+    above = torch.zeros(rows, 1, dtype=torch.float64, device=probs.device) # mass(probs > bytes found so far)
+    for shift in (24, 16, 8, 0):
+        # tokens whose higher bytes match t, binned by their byte at shift; the others go to the dropped bin
+        idx = torch.where((bits >> (shift + 8)) == (t >> (shift + 8)), (bits >> shift) & 255, 256)
+        hist = torch.zeros(rows, 257, dtype=torch.float64, device=probs.device).scatter_add_(1, idx, mass)
+        # tail[:, j] = mass of the matching tokens with byte >= j, plus above; tail[:, 256] = above
+        tail = torch.cat([hist[:, :256].flip(-1).cumsum(-1).flip(-1) + above, above], dim=-1)
+        j = ((tail[:, :256] >= top_p).sum(-1, keepdim=True) - 1).clamp(min=0)
+        above = tail.gather(-1, j + 1)
+        t = t | (j << shift)
+    return t.int().view(torch.float32).to(probs.dtype)
+
+def filter_probs(probs: torch.Tensor, top_k: int = -1, top_p: float = 0.9):
+    """
+    Top-k / top-p filtering of (rows, vocab) float32 probabilities, renormalized. Sort-free and sync-free.
+    """
+    if top_k > 0 and top_k < probs.shape[-1]:
+        kth = torch.topk(probs, top_k, dim=-1)[0][:, -1:]
+        probs = probs * (probs >= kth)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+    if 0.0 < top_p < 1.0:
+        probs = probs * (probs >= top_p_threshold(probs, top_p))
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+    return probs
 
 def norm_logits(logits : torch.Tensor, temperature=0.6, top_k=-1, top_p=0.9) -> torch.Tensor:
     """
 
     Args:
-        logits (torch.Tensor): shape (1, vocab)
+        logits (torch.Tensor): shape (rows, vocab)
         temperature (float): temperature
         top_k (float): top_k
         top_p (float): top_p
 
     Returns:
-        torch.Tensor: next token with shape as (batch,  1)
+        torch.Tensor: filtered probabilities with shape as (rows, vocab)
     """
     assert logits.dim() == 2
-    logits = logits / temperature
-    logits = top_k_top_p_filter(logits, top_k=top_k, top_p=top_p)
+    probs = F.softmax(logits.float() / temperature, dim=-1)
+    return filter_probs(probs, top_k=top_k, top_p=top_p).to(logits.dtype)
 
-    probs = F.softmax(logits, dim=-1)
-    return probs
+def norm_sample(logits : torch.Tensor, temperature=0.6, top_k=-1, top_p=0.9, generator=None):
+    """
+    norm_logits and a sample of every row in one pass.
+
+    Returns:
+        probs (torch.Tensor): (rows, vocab) filtered probabilities
+        tokens (torch.Tensor): (rows, 1) sampled tokens
+    """
+    probs = norm_logits(logits, temperature=temperature, top_k=top_k, top_p=top_p)
+    return probs, sample_race(probs, generator=generator)
 
 
-def sample(probs : torch.Tensor, num_samples=1):
-    idx_next = torch.multinomial(probs, num_samples=num_samples, replacement=True)
+def sample(probs : torch.Tensor, num_samples=1, generator=None):
+    idx_next = torch.multinomial(probs, num_samples=num_samples, replacement=True, generator=generator)
     return idx_next
 
+def sample_race(probs : torch.Tensor, generator=None):
+    # exponential race, argmax(p / E) with E ~ Exp(1) is distributed as p; no multinomial and no host sync
+    noise = torch.empty(probs.shape, dtype=torch.float32, device=probs.device).exponential_(1, generator=generator)
+    return (probs.float() / noise).argmax(dim=-1, keepdim=True)
+
 
 def max_fn(x):
     """
@@ -73,4 +120,54 @@ def max_fn(x):
     x_max_sum = torch.sum(x_max, dim=-1, keepdim=True) 
     if x_max_sum == 0:
         print(x.max(), x.min(), x.shape)
-    return x_max / x_max_sum
\ No newline at end of file
+    return x_max / x_max_sum
+
+def speculative_accept(draft_tokens : torch.Tensor, draft_probs : torch.Tensor, target_probs : torch.Tensor, num_draft=None, eos_token_id=None, generator=None):
+    """
+        Speculative sampling of a batch of drafts with tensor ops only.
+
+    Args:
+        draft_tokens (torch.Tensor): (batch, gamma) proposed tokens
+        draft_probs (torch.Tensor): (batch, gamma, vocab) distributions the proposals were drawn from
+        target_probs (torch.Tensor): (batch, gamma + 1, vocab) target distributions, the last row is the bonus position
+        num_draft (torch.Tensor, optional): (batch,) valid proposals per row, defaults to gamma
+        eos_token_id (int, optional): nothing after an accepted eos is accepted
+        generator (torch.Generator, optional): source of the acceptance tests and the final sample
+
+    Returns:
+        accept (torch.Tensor): (batch,) number of accepted proposals
+        next_token (torch.Tensor): (batch,) residual sample at the first rejection, or the bonus sample
+        eos (torch.Tensor): (batch,) an eos was accepted, next_token should be dropped
+    """
+    bsz, gamma = draft_tokens.shape
+    device = draft_tokens.device
+    rows = torch.arange(bsz, device=device)
+    positions = torch.arange(gamma, device=device)
+
+    token_idx = draft_tokens.unsqueeze(-1)
+    p = target_probs[:, :gamma].gather(-1, token_idx).squeeze(-1)
+    q = draft_probs.gather(-1, token_idx).squeeze(-1)
+    r = torch.rand(bsz, gamma, device=device, generator=generator)
+    ok = r < torch.clamp(p / q, max=1)
+
+    if num_draft is None:
+        num_draft = torch.full((bsz,), gamma, device=device, dtype=torch.long)
+    ok &= positions < num_draft.unsqueeze(-1)
+    if eos_token_id is not None:
+        is_eos = draft_tokens == eos_token_id
+        ok &= (is_eos.long().cumsum(-1) - is_eos.long()) == 0
+
+    accept = ok.long().cumprod(-1).sum(-1)
+    if eos_token_id is not None:
+        eos = (accept > 0) & (draft_tokens[rows, (accept - 1).clamp(min=0)] == eos_token_id)
+    else:
+        eos = torch.zeros(bsz, dtype=torch.bool, device=device)
+
+    # norm(max(p - q, 0)) at the first rejection, plain p after a full acceptance
+    p_next = target_probs[rows, accept]
+    residual = torch.clamp(p_next - draft_probs[rows, accept.clamp(max=gamma - 1)], min=0)
+    residual = residual / residual.sum(dim=-1, keepdim=True)
+    rejected = (accept < num_draft) & ~eos
+    next_token = sample(torch.where(rejected.unsqueeze(-1), residual, p_next), generator=generator).squeeze(-1)
+
+    return accept, next_token, eos
@@ -0,0 +1,297 @@
+import asyncio
+import http.client
+import json
+import socket
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import torch
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+from utils.streaming import triforce_stream
+
+class AdmissionError(Exception):
+    def __init__(self, status, message) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class KVAdmission:
+    """
+    Admission control on the target KV cache. A request needs prompt + max_len + gamma + 2 tokens of it (a round may
+    overshoot max_len by gamma + 1). Requests that can never fit are refused (413), the rest wait for the engine in a
+    queue bounded by max_queue requests and by max_queued_tokens KV tokens (503 when full).
+    """
+    def __init__(self, capacity_tokens, bytes_per_token, gamma, max_queue=16, max_queued_tokens=None) -> None:
+        self.capacity_tokens = capacity_tokens
+        self.bytes_per_token = bytes_per_token
+        self.gamma = gamma
+        self.max_queue = max_queue
+        self.max_queued_tokens = max_queued_tokens if max_queued_tokens is not None else max_queue * capacity_tokens
+        self.queued = 0
+        self.queued_tokens = 0
+        self.running = 0
+        self.served = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_cache(cls, kv_cache, gamma, **kwargs):
+        capacity_tokens = kv_cache.max_budget
+        if getattr(kv_cache, 'paged', False):
+            capacity_tokens = min(capacity_tokens, kv_cache.pool.num_blocks * kv_cache.pool.block_size)
+            element_size = kv_cache.pool.key_blocks.element_size()
+        else:
+            element_size = kv_cache.key_cache.element_size()
+        bytes_per_token = 2 * kv_cache.layers * kv_cache.num_heads * kv_cache.head_dim * element_size
+        return cls(capacity_tokens, bytes_per_token, gamma, **kwargs)
+
+    def need(self, prompt_len, max_len):
+        return prompt_len + max_len + self.gamma + 2
+
+    def admit(self, prompt_len, max_len):
+        tokens = self.need(prompt_len, max_len)
+        if tokens > self.capacity_tokens:
+            self.rejected += 1
+            raise AdmissionError(413, f"request needs {tokens} kv tokens ({tokens * self.bytes_per_token / 1024**3:.2f} GB), the cache holds {self.capacity_tokens}")
+        if self.queued >= self.max_queue or self.queued_tokens + tokens > self.max_queued_tokens:
+            self.rejected += 1
+            raise AdmissionError(503, f"queue full: {self.queued} requests, {self.queued_tokens} kv tokens waiting")
+        self.queued += 1
+        self.queued_tokens += tokens
+        return tokens
+
+    def leave(self, tokens):
+        self.queued -= 1
+        self.queued_tokens -= tokens
+
+    def start(self, tokens):
+        self.leave(tokens)
+        self.running += 1
+
+    def finish(self):
+        self.running -= 1
+        self.served += 1
+
+    def status(self):
+        return {
+            "capacity_tokens": self.capacity_tokens,
+            "kv_gb": self.capacity_tokens * self.bytes_per_token / 1024**3,
+            "queued": self.queued,
+            "queued_tokens": self.queued_tokens,
+            "running": self.running,
+            "served": self.served,
+            "rejected": self.rejected,
+        }
+
+class TriForceServer:
+    """
+    Long-running TriForce front-end: one warm GraphInferenceEngine (graphs captured once) serves requests one at a time
+    in arrival order, over local HTTP or a Unix socket.
+
+        POST /generate {"prompt": str | "input_ids": [int], "max_len": int, "stream": bool}
+            stream: NDJSON lines {"token_ids", "text", "eos", "finished"}, the last one with "metrics" (ttft, itl)
+            otherwise one JSON {"text", "token_ids", "metrics"}
+        GET /health: admission and queue status
+
+    Sampling (temperature, top_p) and gamma are fixed by the captured graphs. The retrieval range of every request is its
+    prompt rounded down to chunk_size, so prompts must be longer than the retrieval budget and the generated tail must fit in it.
+    """
+    def __init__(self, tokenizer, graph_engine, gamma=6, temperature=0.6, top_p=0.9, top_k=-1, max_len=256, admission=None, verbose=False) -> None:
+        self.tokenizer = tokenizer
+        self.graph_engine = graph_engine
+        self.gamma = gamma
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.max_len = max_len
+        self.verbose = verbose
+        self.device = graph_engine.engine.model.device
+        self.admission = admission if admission is not None else KVAdmission.from_cache(graph_engine.engine.kv_cache, gamma)
+        self.lock = None # asyncio.Lock of the serving loop, FIFO
+        self.executor = ThreadPoolExecutor(max_workers=1) # the engine is used from a single worker thread
+
+    def parse(self, request):
+        sampling = {"temperature": self.temperature, "top_p": self.top_p}
+        for key, value in sampling.items():
+            if key in request and request[key] != value:
+                raise AdmissionError(400, f"{key} is fixed to {value} by the captured graphs")
+        if "input_ids" in request:
+            input_ids = [int(i) for i in request["input_ids"]]
+        elif "prompt" in request:
+            input_ids = self.tokenizer.encode(request["prompt"])
+        else:
+            raise AdmissionError(400, "prompt or input_ids is required")
+        max_len = int(request.get("max_len", self.max_len))
+        graph_cache = self.graph_engine.engine.graph_cache
+        retrieval_end = (len(input_ids) // graph_cache.chunk_size) * graph_cache.chunk_size
+        if retrieval_end <= graph_cache.max_budget:
+            raise AdmissionError(400, f"prompt of {len(input_ids)} tokens, the retrieval budget needs more than {graph_cache.max_budget + graph_cache.chunk_size - 1}")
+        if len(input_ids) - retrieval_end + max_len + self.gamma + 2 > graph_cache.max_budget:
+            # the generated tail is kept inside the retrieval cache
+            raise AdmissionError(400, f"max_len {max_len} exceeds the retrieval budget {graph_cache.max_budget}")
+        return input_ids, max_len, retrieval_end
+
+    async def generate(self, request):
+        # async iterator of stream chunks, raises AdmissionError before the first one
+        submitted = time.perf_counter()
+        input_ids, max_len, retrieval_end = self.parse(request)
+        tokens = self.admission.admit(len(input_ids), max_len)
+        started = False
+        try:
+            async with self.lock:
+                self.admission.start(tokens)
+                started = True
+                queue_time = time.perf_counter() - submitted
+                graph_cache = self.graph_engine.engine.graph_cache
+                graph_cache.prefill = graph_cache.retrieval_end = retrieval_end
+                stream = triforce_stream(self.tokenizer, self.graph_engine, torch.tensor([input_ids], device=self.device), executor=self.executor, submitted=submitted,
+                                         gamma=self.gamma, max_len=max_len, top_k=self.top_k, top_p=self.top_p, temperature=self.temperature)
+                try:
+                    async for chunk in stream:
+                        if chunk["finished"]:
+                            chunk["metrics"]["queue_time"] = queue_time
+                        yield chunk
+                finally:
+                    await stream.aclose()
+        finally:
+            if started:
+                self.admission.finish()
+            else: # cancelled while waiting
+                self.admission.leave(tokens)
+
+    async def respond(self, writer, status, body):
+        payload = json.dumps(body).encode()
+        writer.write(f"HTTP/1.1 {status} {http.client.responses.get(status, '')}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/health":
+                await self.respond(writer, 200, self.admission.status())
+                return
+            if method != "POST" or path != "/generate":
+                await self.respond(writer, 404, {"error": f"{method} {path}"})
+                return
+
+            request = json.loads(body or b"{}")
+            chunks = self.generate(request)
+            try:
+                first = await chunks.__anext__()
+            except AdmissionError as e:
+                await self.respond(writer, e.status, {"error": e.message})
+                return
+
+            start = time.perf_counter()
+            if request.get("stream", True):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+                chunk = first
+                try:
+                    while True:
+                        writer.write(json.dumps(chunk).encode() + b"\n")
+                        await writer.drain() # a closed connection raises here and ends the generation
+                        if chunk["finished"]:
+                            break
+                        chunk = await chunks.__anext__()
+                finally:
+                    await chunks.aclose()
+            else:
+                token_ids, text, chunk = [], "", first
+                while True:
+                    token_ids.extend(chunk["token_ids"])
+                    text += chunk["text"]
+                    if chunk["finished"]:
+                        break
+                    chunk = await chunks.__anext__()
+                await self.respond(writer, 200, {"text": text, "token_ids": token_ids, "metrics": chunk["metrics"]})
+            if self.verbose:
+                metrics = chunk["metrics"]
+                print(f"[Server] {len(request.get('input_ids', [])) or 'prompt'} -> {metrics['tokens']} tokens in {time.perf_counter() - start:.2f} sec, ttft {metrics['ttft']:.3f} sec | {self.admission.status()}", flush=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                await self.respond(writer, 500, {"error": repr(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_path=None):
+        self.lock = asyncio.Lock()
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+            address = f"unix:{unix_path}"
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            address = f"http://{host}:{server.sockets[0].getsockname()[1]}"
+        print(f"[Server] listening on {address} | {self.admission.status()}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host="127.0.0.1", port=8000, unix_path=None):
+        asyncio.run(self.serve(host=host, port=port, unix_path=unix_path))
+
+############## Client ###############
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def connect(address, timeout=None):
+    # "http://host:port" or "unix:/path/to.sock"
+    if address.startswith("unix:"):
+        return UnixHTTPConnection(address[len("unix:"):], timeout=timeout)
+    url = urlparse(address)
+    return http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+def health(address):
+    conn = connect(address)
+    conn.request("GET", "/health")
+    return json.loads(conn.getresponse().read())
+
+def generate(address, prompt=None, input_ids=None, max_len=None, stream=True, timeout=None):
+    """
+    Client of TriForceServer. Yields the stream chunks (stream=True) or the single response; raises RuntimeError with
+    the server message on a refused request.
+    """
+    request = {"stream": stream}
+    if prompt is not None:
+        request["prompt"] = prompt
+    if input_ids is not None:
+        request["input_ids"] = list(input_ids)
+    if max_len is not None:
+        request["max_len"] = max_len
+    conn = connect(address, timeout=timeout)
+    conn.request("POST", "/generate", body=json.dumps(request), headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"{response.status}: {json.loads(response.read()).get('error')}")
+    try:
+        if not stream:
+            yield json.loads(response.read())
+            return
+        for line in response:
+            yield json.loads(line)
+    finally:
+        conn.close()
@@ -0,0 +1,82 @@
+import asyncio
+import time
+import numpy as np
+import os
+import sys
+root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(root_dir)
+
+from utils.misc import IncrementalDetokenizer
+from utils.decoding import TriForce
+
+def latency_stats(start, times, counts):
+    """
+    Time to first token and inter-token latency of one request.
+
+    Args:
+        start (float): perf_counter at submission.
+        times (list): perf_counter of every commit, counts (list): tokens committed at each.
+            A round commits several tokens at once, its gap is split evenly over them.
+    """
+    if not times:
+        return {"ttft": None, "itl_mean": None, "itl_p50": None, "itl_p99": None, "tokens": 0, "tokens_per_sec": 0.0}
+    itl = []
+    for prev, now, count in zip(times[:-1], times[1:], counts[1:]):
+        itl.extend([(now - prev) / max(count, 1)] * count)
+    tokens = sum(counts)
+    return {
+        "ttft": times[0] - start,
+        "itl_mean": float(np.mean(itl)) if itl else None,
+        "itl_p50": float(np.percentile(itl, 50)) if itl else None,
+        "itl_p99": float(np.percentile(itl, 99)) if itl else None,
+        "tokens": tokens,
+        "tokens_per_sec": (tokens - counts[0]) / (times[-1] - times[0]) if len(times) > 1 else 0.0,
+    }
+
+async def triforce_stream(tokenizer, engine, input_ids, decode=TriForce, executor=None, submitted=None, **kwargs):
+    """
+    Async generator over a TriForce generation.
+
+        async for chunk in triforce_stream(tokenizer, graph_engine, input_ids, gamma=6, max_len=256):
+            print(chunk["text"], end="", flush=True)
+
+    decode (TriForce or TriForce_Dist) runs in a worker thread, so the event loop is free while the device works. Every
+    committed round yields {"token_ids", "text", "eos", "finished": False}; the last chunk has "finished": True, the
+    decode return value in "result" and the latency of the request (latency_stats) in "metrics".
+    TriForce stops at eos or when the consumer closes the generator, TriForce_Dist only at eos or max_len.
+    submitted: perf_counter of the request arrival, ttft then includes the time it waited (default: now).
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    cancelled = False
+    start = submitted if submitted is not None else time.perf_counter()
+
+    def on_tokens(ids, eos):
+        loop.call_soon_threadsafe(queue.put_nowait, (time.perf_counter(), ids, eos))
+        return eos or cancelled
+
+    def run():
+        try:
+            return decode(tokenizer, engine, input_ids, on_tokens=on_tokens, **kwargs)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    task = loop.run_in_executor(executor, run)
+    times, counts = [], []
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            now, ids, eos = item
+            times.append(now)
+            counts.append(len(ids))
+            yield {"token_ids": ids, "text": detokenizer.push(ids), "eos": eos, "finished": False}
+        result = await task
+        yield {"token_ids": [], "text": detokenizer.flush(), "eos": False, "finished": True, "result": result, "metrics": latency_stats(start, times, counts)}
+    finally:
+        # a consumer that stops early ends the generation at the next round, the engine is free once it returns
+        cancelled = True
+        if not task.done():
+            await asyncio.wait([task])